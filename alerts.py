@@ -0,0 +1,137 @@
+"""Alertas de stock bajo mantenidas de forma incremental.
+
+``LowStockIndex`` guarda los IDs de los productos con stock igual o menor
+al mínimo. Igual que los índices de ``indexes.py`` se actualiza con cada
+cambio de la colección de productos (movimientos, ediciones, importaciones
+y cambios de otros workers), así el dashboard no recorre todos los
+productos.
+
+Cada vez que un producto cambia de estado (normal, bajo, crítico) se guarda
+un evento en la colección ``events`` para avisar a su responsable. El
+evento lo escribe el worker que hizo el cambio, dentro de la misma
+escritura: los demás lo reciben con ``store.sync`` como cualquier otra
+entidad, así que todos ven los mismos eventos con los mismos IDs. Las
+cargas masivas (``insert_many``) recargan la colección completa y no
+generan eventos.
+
+Se conservan los últimos ``max_events`` eventos: al guardar uno nuevo, el
+mismo worker borra los más antiguos. Los eventos se mantienen además
+ordenados por ID en memoria, así ``events_after`` no recorre la colección.
+"""
+import bisect
+from datetime import datetime
+
+
+def stock_status(product):
+    """``'bajo'``, ``'crítico'`` o ``None`` si el stock no está bajo el mínimo"""
+    if product is None or not product.get('has_stock', True):
+        return None
+    if product['current_stock'] > product['min_stock']:
+        return None
+    return 'crítico' if product['current_stock'] == 0 else 'bajo'
+
+
+class LowStockIndex:
+    def __init__(self, products, events, max_events=5000):
+        self.collection = products
+        self.events = events
+        self.max_events = max_events
+        self._ids = set()
+        self.stale = True
+        # IDs de los eventos ordenados y los eventos en el mismo orden
+        self._event_ids = []
+        self._events = []
+        self.events_stale = True
+        products.subscribe(self.on_change)
+        events.subscribe(self.on_event)
+
+    def alerts(self):
+        """Productos bajo el mínimo, por ID"""
+        with self.collection.store.lock:
+            if self.stale:
+                self.rebuild()
+            rows = [self.collection.get(product_id) for product_id in sorted(self._ids)]
+        return [
+            {
+                'product_name': product['name'],
+                'current_stock': product['current_stock'],
+                'min_stock': product['min_stock'],
+                'unit': product['unit'],
+                'status': stock_status(product)
+            }
+            for product in rows
+        ]
+
+    def events_after(self, after=0):
+        """Eventos con ID mayor que ``after``, del más antiguo al más reciente"""
+        with self.collection.store.lock:
+            if self.events_stale:
+                self.rebuild_events()
+            return self._events[bisect.bisect_right(self._event_ids, after):]
+
+    def rebuild(self):
+        self._ids = {product['id'] for product in self.collection if stock_status(product)}
+        self.stale = False
+
+    def rebuild_events(self):
+        self._events = sorted(self.events, key=lambda event: event['id'])
+        self._event_ids = [event['id'] for event in self._events]
+        self.events_stale = False
+
+    def prune(self):
+        """Borra los eventos más antiguos que exceden ``max_events``"""
+        excess = len(self.events) - self.max_events
+        if excess <= 0:
+            return
+        if self.events_stale:
+            self.rebuild_events()
+        for event_id in self._event_ids[:excess]:
+            self.events.delete(event_id)
+
+    def on_event(self, op, old, new):
+        if op == 'reset':
+            self.events_stale = True
+            return
+        if self.events_stale:
+            return
+        event_id = (new or old)['id']
+        position = bisect.bisect_left(self._event_ids, event_id)
+        found = position < len(self._event_ids) and self._event_ids[position] == event_id
+        if new is None:
+            if found:
+                del self._event_ids[position]
+                del self._events[position]
+        elif found:
+            self._events[position] = new
+        else:
+            # Los IDs son crecientes: casi siempre se agrega al final
+            self._event_ids.insert(position, event_id)
+            self._events.insert(position, new)
+
+    def on_change(self, op, old, new):
+        if op == 'reset':
+            self.stale = True
+            return
+        status = stock_status(new)
+        previous = stock_status(old)
+        if not self.stale:
+            if status:
+                self._ids.add(new['id'])
+            elif old is not None:
+                self._ids.discard(old['id'])
+        # Los cambios de otros workers traen su propio evento
+        if status == previous or new is None or self.collection.store.syncing:
+            return
+        self.events.insert({
+            'id': self.events.allocate_id(),
+            'date': datetime.now().isoformat(),
+            'product_id': new['id'],
+            'product_name': new['name'],
+            'responsible': new.get('responsible', ''),
+            'unit': new['unit'],
+            'current_stock': new['current_stock'],
+            'min_stock': new['min_stock'],
+            'status': status or 'normal',
+            'previous_status': previous or 'normal'
+        })
+        self.prune()
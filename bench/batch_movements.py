@@ -0,0 +1,86 @@
+"""Movimientos por segundo: ``POST /api/movimientos/batch`` vs. un POST por movimiento.
+
+Para cada backend (memoria, SQLite y journal con ``fsync``) carga la
+aplicación en un directorio temporal, registra ``BATCH`` movimientos de dos
+líneas en un solo lote y ``SINGLE`` con un POST cada uno, y mide el tiempo
+con el cliente de pruebas de Flask.
+
+    python bench/batch_movements.py [lote] [individuales]
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+BATCH = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+SINGLE = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+BACKENDS = ('memory', 'sqlite', 'journal')
+
+
+def load_app(backend, folder):
+    """Instancia nueva de ``main`` con el backend ``backend`` en ``folder``"""
+    os.environ.update({
+        'STORAGE_BACKEND': backend,
+        'DATABASE_PATH': os.path.join(folder, 'inventario.db'),
+        'JOURNAL_DIR': os.path.join(folder, 'journal'),
+        'JOURNAL_FSYNC': '1',
+        'SNAPSHOT_INTERVAL': '0'
+    })
+    sys.path.insert(0, str(ROOT))
+    spec = importlib.util.spec_from_file_location(f'main_{backend}', ROOT / 'main.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def movement(index, product_ids):
+    """Compra o uso de dos productos, repartido entre etapas y locaciones"""
+    first = product_ids[index % len(product_ids)]
+    second = product_ids[(index + 3) % len(product_ids)]
+    return {
+        'type': 'compra' if index % 3 == 0 else 'uso',
+        'products': [{'product_id': first, 'quantity': 0.01}, {'product_id': second, 'quantity': 0.01}],
+        'responsible': 'Bench', 'stage_id': 1 + index % 3, 'location_id': 1 + index % 3
+    }
+
+
+def run(backend):
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        app = load_app(backend, folder)
+        client = app.app.test_client()
+        product_ids = [client.post('/api/productos', json={
+            'name': f'Bench {index}', 'unit': 'kg', 'current_stock': 100000, 'initial_stock': 100000, 'price': 1
+        }).get_json()['id'] for index in range(6)]
+        # Estructuras derivadas ya construidas, como en un worker en uso
+        client.get('/api/dashboard')
+
+        items = [movement(index, product_ids) for index in range(BATCH)]
+        start = time.perf_counter()
+        response = client.post('/api/movimientos/batch', json=items)
+        batch_time = time.perf_counter() - start
+        assert response.status_code == 201, response.get_json()
+
+        start = time.perf_counter()
+        for index in range(SINGLE):
+            response = client.post('/api/movimientos', json=movement(index, product_ids))
+            assert response.status_code == 201, response.get_json()
+        single_time = time.perf_counter() - start
+
+        app.store.backend.close()
+        os.chdir(ROOT)
+    print(f'{backend:8} lote {BATCH / batch_time / 1000:5.1f}k mov/s, '
+          f'individual {SINGLE / single_time / 1000:5.1f}k mov/s')
+
+
+def main():
+    print(f'{BATCH} movimientos en un lote, {SINGLE} POST individuales (dos líneas cada uno)')
+    for backend in BACKENDS:
+        run(backend)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Codificación de las respuestas JSON de la aplicación.
+
+Carga la aplicación con el backend en memoria y hace crecer el historial
+repitiendo los movimientos iniciales (con fechas e IDs nuevos) hasta
+``MOVEMENTS``. Después pide ``PAYLOADS`` con el cliente de pruebas y guarda
+los objetos que cada vista entrega a ``jsonify``. Con esos objetos compara
+el proveedor por defecto de Flask, ``FastJSONProvider`` con orjson y su
+alternativa sin orjson (``json`` de la biblioteca estándar): mide
+``app.json.response`` (codificar) y ``app.json.loads`` (leer el mismo
+cuerpo) e informa el mejor de cinco.
+
+    python bench/json_encode.py [movimientos]
+
+Usa un directorio temporal.
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import json_provider
+from json_provider import FastJSONProvider
+
+MOVEMENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+PAYLOADS = (
+    '/api/movimientos',
+    '/api/movimientos?limit=500',
+    '/api/productos',
+    '/api/dashboard',
+)
+
+
+def load_app():
+    """``main`` con el backend en memoria (no toca ``data/``)"""
+    os.environ['STORAGE_BACKEND'] = 'memory'
+    spec = importlib.util.spec_from_file_location('main', ROOT / 'main.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def grow_history(app, count):
+    """Repite los movimientos iniciales hasta tener ``count``, uno cada 10 minutos"""
+    seed = app.movements.all()
+    first = app.movements.allocate_id(count)
+    start = datetime(2023, 1, 1)
+    rows = []
+    for offset in range(count - len(seed)):
+        row = dict(seed[offset % len(seed)], id=first + offset)
+        row['date'] = (start + timedelta(minutes=10 * offset)).isoformat()
+        row['products'] = [dict(line) for line in row['products']]
+        rows.append(row)
+    app.movements.insert_many(rows)
+
+
+def capture_payloads(app):
+    """``{url: objeto}`` con lo que cada vista entrega a ``jsonify``"""
+    captured = {}
+    provider = app.app.json
+    original = provider.response
+
+    def response(*args, **kwargs):
+        captured['last'] = args[0] if len(args) == 1 else args
+        return original(*args, **kwargs)
+
+    provider.response = response
+    client = app.app.test_client()
+    payloads = {}
+    try:
+        for url in PAYLOADS:
+            assert client.get(url).status_code == 200, url
+            payloads[url] = captured.pop('last')
+    finally:
+        del provider.response
+    return payloads
+
+
+def best(function, repeat=5):
+    """Mejor tiempo de ``repeat`` ejecuciones, en segundos"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench(label, provider, payload):
+    app = Flask(__name__)
+    app.json = provider(app)
+    with app.app_context():
+        encode = best(lambda: app.json.response(payload))
+        body = app.json.response(payload).get_data()
+        decode = best(lambda: app.json.loads(body))
+    print(f'  {label:24} codificar {encode * 1000:8.2f} ms, leer {decode * 1000:8.2f} ms, '
+          f'{len(body) / 1000:.1f} kB')
+
+
+def main():
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        app = load_app()
+        grow_history(app, MOVEMENTS)
+        payloads = capture_payloads(app)
+        os.chdir(ROOT)
+
+    fast = json_provider.orjson
+    print(f'{MOVEMENTS} movimientos')
+    for url, payload in payloads.items():
+        print(url)
+        bench('Flask por defecto', DefaultJSONProvider, payload)
+        if fast is not None:
+            json_provider.orjson = fast
+            bench('FastJSONProvider orjson', FastJSONProvider, payload)
+        json_provider.orjson = None
+        bench('FastJSONProvider json', FastJSONProvider, payload)
+    json_provider.orjson = fast
+    if fast is None:
+        print('orjson no está instalado')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Costo de interpretar las fechas por pedido vs. una vez al escribirlas.
+
+Compara, por entidad, ``datetime.fromisoformat`` + ``strftime``/``now()``
+(lo que hacían los gráficos en cada pedido) con la lectura del ``Period``
+que guarda ``TimestampIndex``, y mide los endpoints de gráficos que agrupan
+por fecha con ``MOVEMENTS`` movimientos y ``STAGES`` etapas en curso.
+
+    python bench/timestamps.py [movimientos] [etapas]
+
+Usa el backend en memoria dentro de un directorio temporal.
+"""
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+MOVEMENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+STAGES = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+REPEAT = 20
+
+
+def load_app():
+    """``main`` con el backend en memoria (no toca ``data/``)"""
+    os.environ['STORAGE_BACKEND'] = 'memory'
+    sys.path.insert(0, str(ROOT))
+    spec = importlib.util.spec_from_file_location('main', ROOT / 'main.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def best(function, repeat=5):
+    """Mejor tiempo de ``repeat`` ejecuciones, en segundos"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def per_request_months(rows):
+    return [datetime.fromisoformat(row['date'].replace('Z', '+00:00')).strftime('%Y-%m') for row in rows]
+
+
+def cached_months(index, rows):
+    return [index.period(row).month for row in rows]
+
+
+def per_request_elapsed(rows):
+    return [(datetime.now() - datetime.fromisoformat(row['start_time'])).days for row in rows]
+
+
+def cached_elapsed(main, rows):
+    now = main.now_micros()
+    return [main.elapsed_days(main.stage_start_times.period(row), now) for row in rows]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        app = load_app()
+        start = datetime(2023, 1, 1)
+        now = datetime.now()
+        with app.store.write():
+            app.movements.insert_many([{
+                'id': 1000 + i, 'date': (start + timedelta(minutes=7 * i)).isoformat(), 'type': ('uso', 'compra')[i % 2],
+                'products': [{'product_id': 1 + i % 4, 'product_name': f'Producto {1 + i % 4}', 'quantity': 1 + i % 5, 'unit': 'kg'}],
+                'stage_id': 1 + i % 3, 'substage_id': None, 'location_id': 1 + i % 3, 'responsible': 'Bench', 'observations': ''
+            } for i in range(MOVEMENTS)])
+            app.stages.insert_many([{
+                'id': 1000 + i, 'name': f'Etapa {i}', 'status': 'in_progress', 'expected_duration': 10, 'location_id': 1 + i % 3,
+                'start_time': (now - timedelta(days=i % 90, hours=i % 24, seconds=i)).isoformat(), 'responsible': 'Bench', 'description': ''
+            } for i in range(STAGES)])
+        movement_rows = list(app.movements)
+        stage_rows = [stage for stage in app.stages if stage.get('start_time')]
+        cached_months(app.movement_timestamps, movement_rows)
+        cached_elapsed(app, stage_rows)
+
+        print(f'{len(movement_rows)} movimientos, {len(stage_rows)} etapas con inicio')
+        for label, rows, before, after in (
+                ('mes de cada movimiento', movement_rows, per_request_months,
+                 lambda rows: cached_months(app.movement_timestamps, rows)),
+                ('días de cada etapa', stage_rows, per_request_elapsed, lambda rows: cached_elapsed(app, rows))):
+            parsed = best(lambda: before(rows)) / len(rows) * 1e6
+            cached = best(lambda: after(rows)) / len(rows) * 1e6
+            print(f'  {label}: por pedido {parsed:.2f} us, al escribir {cached:.2f} us')
+
+        client = app.app.test_client()
+        for name in ('consumo-mensual-producto', 'tiempo-etapas', 'tiempo-locacion'):
+            url = f'/api/graficos/{name}'
+            assert client.get(url).status_code == 200, url
+            start_time = time.perf_counter()
+            for _ in range(REPEAT):
+                client.get(url)
+            print(f'  {url}: {(time.perf_counter() - start_time) / REPEAT * 1000:.1f} ms (promedio de {REPEAT})')
+        app.store.backend.close()
+        os.chdir(ROOT)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""Archivos subidos guardados por contenido.
+
+Cada archivo se guarda una sola vez como ``<directorio>/<ab>/<sha256>``,
+aunque lo suban varias recetas o imágenes; los registros guardan el hash en
+``blob`` y el archivo se borra cuando ya no lo referencia ninguno.
+
+Las subidas se escriben a disco en bloques mientras se calcula el hash
+(``HashingFile``) y después se mueven a su lugar sin volver a copiarlas.
+Los archivos grandes pueden subirse por partes (``ChunkedUploads``): cada
+parte se agrega al final del archivo de la subida y, si se corta, el
+cliente consulta cuánto llegó y sigue desde ahí.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime
+
+# Tamaño de los bloques al leer o copiar archivos
+CHUNK_SIZE = 1024 * 1024
+
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+# Archivo ya escrito en disco: ruta temporal, hash y tamaño
+Upload = namedtuple('Upload', ['path', 'digest', 'size'])
+
+
+class UploadOffsetError(Exception):
+    """La parte no empieza donde terminó la anterior"""
+
+    def __init__(self, offset):
+        super().__init__(f"La subida va por el byte {offset}")
+        self.offset = offset
+
+
+class HashingFile:
+    """Archivo temporal que calcula el SHA-256 de lo que se escribe.
+
+    Se usa como destino de los archivos del formulario: el archivo queda en
+    el disco de los blobs y el hash se calcula en la misma pasada. Al
+    cerrarlo se borra si no se movió a su lugar.
+    """
+
+    def __init__(self, directory):
+        descriptor, self.name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        self.file = os.fdopen(descriptor, 'w+b')
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def upload(self):
+        self.file.flush()
+        return Upload(self.name, self.hash.hexdigest(), self.size)
+
+    def close(self):
+        self.file.close()
+        try:
+            os.remove(self.name)
+        except FileNotFoundError:
+            pass
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class BlobStore:
+    def __init__(self, directory):
+        # Absoluto: ``send_file`` resuelve las rutas relativas desde la app, no desde el cwd
+        self.directory = os.path.abspath(directory)
+        self.temporary_dir = os.path.join(directory, 'tmp')
+        os.makedirs(self.temporary_dir, exist_ok=True)
+
+    def temporary(self):
+        """Archivo temporal para recibir una subida"""
+        return HashingFile(self.temporary_dir)
+
+    def path(self, digest):
+        if not DIGEST.match(digest or ''):
+            raise ValueError("Hash de archivo inválido")
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def add(self, upload):
+        """Mueve ``upload`` a su lugar; devuelve ``False`` si ese contenido ya estaba"""
+        path = self.path(upload.digest)
+        if os.path.exists(path):
+            os.remove(upload.path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(upload.path, path)
+        return True
+
+    def remove(self, digest):
+        try:
+            os.remove(self.path(digest))
+        except OSError:
+            pass
+
+    def stats(self):
+        blobs = 0
+        size = 0
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir() or entry.path == self.temporary_dir:
+                continue
+            for blob in os.scandir(entry.path):
+                blobs += 1
+                size += blob.stat().st_size
+        return {'blobs': blobs, 'bytes': size}
+
+
+class ChunkedUploads:
+    """Subidas por partes reanudables.
+
+    El estado de cada subida es ``<directorio>/<id>.json`` y lo recibido
+    hasta ahora ``<directorio>/<id>.part``, así que cualquier worker puede
+    recibir la siguiente parte. El hash se va calculando en el proceso que
+    recibe las partes; si una parte llegó a otro proceso se recalcula
+    leyendo el archivo al terminar.
+    """
+
+    def __init__(self, directory, max_size, max_age=24 * 60 * 60):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # id -> (bytes recibidos, hash parcial) de las partes de este proceso
+        self._hashes = {}
+
+    def start(self, filename, size):
+        if size < 0 or size > self.max_size:
+            raise ValueError(f"El tamaño debe estar entre 0 y {self.max_size} bytes")
+        self.evict()
+        upload = {
+            'id': uuid.uuid4().hex,
+            'filename': filename,
+            'size': size,
+            'created_at': datetime.now().isoformat()
+        }
+        open(self._part(upload['id']), 'wb').close()
+        with open(self._state(upload['id']), 'w', encoding='utf-8') as f:
+            json.dump(upload, f, ensure_ascii=False)
+        return self.get(upload['id'])
+
+    def get(self, upload_id):
+        """Estado de una subida con los bytes recibidos (``None`` si no existe)"""
+        if not upload_id.isalnum():
+            return None
+        try:
+            with open(self._state(upload_id), encoding='utf-8') as f:
+                upload = json.load(f)
+            upload['offset'] = os.path.getsize(self._part(upload_id))
+        except (OSError, ValueError):
+            return None
+        return upload
+
+    def append(self, upload, offset, stream):
+        """Agrega al archivo lo que se lee de ``stream`` a partir de ``offset``.
+
+        El archivo parcial queda bloqueado (``flock``) desde que se compara
+        ``offset`` hasta que termina la escritura: dos partes con el mismo
+        offset, en este u otro worker, no pueden intercalarse. Si otra parte
+        se está escribiendo se responde con ``UploadOffsetError``.
+        """
+        upload_id = upload['id']
+        with open(self._part(upload_id), 'ab') as part:
+            try:
+                fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise UploadOffsetError(os.fstat(part.fileno()).st_size)
+            # Con el lock tomado: el tamaño ya no cambia hasta terminar
+            current = part.seek(0, os.SEEK_END)
+            if offset != current:
+                raise UploadOffsetError(current)
+            # Si la parte se corta, el hash parcial deja de corresponder al archivo
+            with self._lock:
+                received, digest = self._hashes.pop(upload_id, (None, None))
+            if received != current:
+                digest = hashlib.sha256() if current == 0 else None
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                current += len(chunk)
+                if current > upload['size']:
+                    part.truncate(offset)
+                    raise ValueError("La parte supera el tamaño declarado de la subida")
+                part.write(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+        if digest is not None:
+            with self._lock:
+                self._hashes[upload_id] = (current, digest)
+        return current
+
+    def complete(self, upload):
+        """Archivo terminado de una subida (``ValueError`` si faltan partes)"""
+        path = self._part(upload['id'])
+        with open(path, 'rb') as part:
+            # Espera a que termine una parte que se esté escribiendo
+            fcntl.flock(part, fcntl.LOCK_SH)
+            complete = os.fstat(part.fileno()).st_size == upload['size']
+        if not complete:
+            raise ValueError("La subida no está completa")
+        with self._lock:
+            received, digest = self._hashes.pop(upload['id'], (None, None))
+        if received != upload['size']:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        return Upload(path, digest.hexdigest(), upload['size'])
+
+    def discard(self, upload_id):
+        with self._lock:
+            self._hashes.pop(upload_id, None)
+        for path in (self._part(upload_id), self._state(upload_id)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def evict(self):
+        """Descarta las subidas abandonadas"""
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            upload_id, extension = os.path.splitext(entry.name)
+            try:
+                # La fecha del archivo parcial es la de la última parte recibida
+                if extension == '.part' and now - entry.stat().st_mtime >= self.max_age:
+                    self.discard(upload_id)
+            except OSError:
+                pass
+
+    def _state(self, upload_id):
+        return os.path.join(self.directory, f'{upload_id}.json')
+
+    def _part(self, upload_id):
+        return os.path.join(self.directory, f'{upload_id}.part')
@@ -0,0 +1,132 @@
+"""Cambios de las colecciones para enviarlos a los navegadores (SSE).
+
+``ChangeFeed`` se suscribe a las colecciones y guarda los últimos cambios
+en memoria, cada uno con la secuencia del backend que lo produjo. La
+secuencia es la misma en todos los workers: un cliente que se reconecta a
+otro worker envía la última que recibió (``Last-Event-ID``) y recibe lo que
+le faltó. Si eso ya no está en memoria recibe ``reload`` y vuelve a cargar
+todo.
+
+Cada cambio es compacto: ``insert`` lleva la entidad completa, ``update``
+solo los campos que cambiaron y ``delete`` solo el ID. Las cargas masivas
+(``insert_many``) y las recargas de una colección se envían como
+``reload`` de esa entidad.
+"""
+import functools
+import threading
+from collections import deque, namedtuple
+
+# Cambio ya registrado: posición en el feed de este proceso, secuencia del backend y datos
+Change = namedtuple('Change', 'index seq data')
+
+
+class ChangeFeed:
+    def __init__(self, store, collections, render=None, max_changes=5000):
+        """``collections`` es ``{entidad: colección}``; ``render`` es
+        ``{entidad: función}`` para enviar las entidades como las devuelve la API"""
+        self.store = store
+        self.collections = collections
+        self.render = render or {}
+        self._changes = deque(maxlen=max_changes)
+        self._condition = threading.Condition()
+        self._index = 0
+        self._last_seq = 0
+        # Secuencia desde la que el feed está completo (``None``: todavía no se usó)
+        self._floor = None
+        # Colecciones ya cargadas alguna vez: las siguientes cargas son recargas
+        self._seen = set()
+        self._streams = 0
+        for entity, collection in collections.items():
+            if collection.loaded:
+                self._seen.add(entity)
+            collection.subscribe(functools.partial(self.on_change, entity, collection))
+
+    def start(self):
+        """Carga las colecciones para recibir también los cambios de otros workers.
+
+        Las colecciones que no están en memoria no reciben esos cambios
+        (``store.sync`` las saltea), así que el feed solo está completo a
+        partir de este momento.
+        """
+        with self.store.lock:
+            if self._floor is None:
+                self._floor = self.store.backend.last_seq()
+            for collection in self.collections.values():
+                if not collection.loaded:
+                    len(collection)
+
+    def acquire(self, limit):
+        """Reserva uno de los ``limit`` streams de este proceso (``False`` si no hay)"""
+        with self._condition:
+            if self._streams >= limit:
+                return False
+            self._streams += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self._streams -= 1
+
+    def since_seq(self, seq):
+        """``(cambios, posición)``: los cambios desde la secuencia ``seq`` inclusive
+        (``None`` si faltan algunos o ``seq`` es ``None``) y la última posición del feed.
+
+        Se incluye el cambio con esa misma secuencia: una recarga puede
+        compartirla con el cambio anterior, y repetir un cambio no tiene
+        efecto en el cliente.
+        """
+        with self._condition:
+            if seq is None or self._floor is None or seq < self._floor:
+                return None, self._index
+            if len(self._changes) == self._changes.maxlen and self._changes[0].seq > seq:
+                return None, self._index
+            return [change for change in self._changes if change.seq >= seq], self._index
+
+    @property
+    def last_seq(self):
+        with self._condition:
+            return max(self._last_seq, self._floor or 0)
+
+    def wait(self, index, timeout):
+        """``(cambios, posición)``: los cambios posteriores a la posición ``index``
+        (espera hasta ``timeout`` si no hay) y la última posición del feed.
+
+        Los cambios son ``None`` si se descartaron algunos que el stream no llegó a enviar.
+        """
+        with self._condition:
+            if self._index == index:
+                self._condition.wait(timeout)
+            if self._changes and self._changes[0].index > index + 1:
+                return None, self._index
+            return [change for change in self._changes if change.index > index], self._index
+
+    def on_change(self, entity, collection, op, old, new):
+        if op == 'reset':
+            # La primera carga no es un cambio; las siguientes reemplazan la colección completa
+            if entity in self._seen:
+                self._append(self._last_seq, {'entity': entity, 'op': 'reload'})
+            elif collection.loaded:
+                self._seen.add(entity)
+            return
+        seq = collection.version
+        render = self.render.get(entity)
+        if op == 'delete':
+            data = {'entity': entity, 'op': 'delete', 'id': old['id']}
+        elif op == 'insert':
+            data = {'entity': entity, 'op': 'insert', 'id': new['id'], 'fields': render(new) if render else dict(new)}
+        else:
+            before = render(old) if render else old
+            after = render(new) if render else new
+            fields = {key: value for key, value in after.items() if key not in before or before[key] != value}
+            if not fields:
+                return
+            data = {'entity': entity, 'op': 'update', 'id': new['id'], 'fields': fields}
+        self._append(seq, data)
+
+    def _append(self, seq, data):
+        with self._condition:
+            # Una colección cargada después puede tener una versión mayor que la del cambio
+            self._last_seq = max(self._last_seq, seq)
+            self._index += 1
+            self._changes.append(Change(self._index, self._last_seq, data))
+            self._condition.notify_all()
@@ -0,0 +1,133 @@
+"""Compresión de respuestas según ``Accept-Encoding`` (Brotli o gzip).
+
+Las respuestas JSON y de texto se comprimen al enviarlas si superan un
+tamaño mínimo. ``CompressionCache`` guarda el resultado por hash del
+contenido: un listado que no cambió entre dos pedidos se comprime una sola
+vez. Los archivos estáticos se comprimen una vez con el nivel máximo y las
+copias quedan en disco (``StaticCompressor``).
+
+Brotli es opcional; sin el paquete ``brotli`` se usa solo gzip.
+"""
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Tipos de contenido que vale la pena comprimir (las imágenes y los xlsx ya lo están)
+COMPRESSIBLE = {
+    'application/json', 'application/javascript', 'text/javascript', 'text/css',
+    'text/html', 'text/plain', 'text/csv', 'image/svg+xml'
+}
+EXTENSIONS = {'br': 'br', 'gzip': 'gz'}
+
+# Niveles: al vuelo se prioriza la velocidad, los estáticos se comprimen una vez
+DYNAMIC_LEVELS = {'br': 5, 'gzip': 6}
+STATIC_LEVELS = {'br': 11, 'gzip': 9}
+
+
+def negotiate(accept_encodings):
+    """Codificación a usar según ``Accept-Encoding`` (``None``: sin comprimir)"""
+    if brotli is not None and accept_encodings.quality('br') > 0:
+        return 'br'
+    if accept_encodings.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    # mtime=0: el mismo contenido da siempre los mismos bytes
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+class CompressionCache:
+    """Resultados de compresión recientes por ``(hash del contenido, codificación)``"""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, data, encoding):
+        key = (hashlib.blake2b(data, digest_size=16).digest(), encoding)
+        with self._lock:
+            compressed = self._entries.get(key)
+            if compressed is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return compressed
+            self.misses += 1
+        compressed = compress(data, encoding, DYNAMIC_LEVELS[encoding])
+        if len(compressed) > self.max_bytes:
+            return compressed
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = compressed
+                self._bytes += len(compressed)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+        return compressed
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class StaticCompressor:
+    """Copias comprimidas de los archivos estáticos.
+
+    Cada copia se llama ``<hash de la ruta>-<mtime>-<tamaño>.<br|gz>``: si
+    el archivo cambia se genera otra y se borra la anterior. Se generan en
+    el primer pedido y las comparten todos los workers.
+    """
+
+    def __init__(self, directory, min_size=1024):
+        self.directory = directory
+        self.min_size = min_size
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def get(self, path, encoding):
+        """Ruta de la copia de ``path`` con ``encoding`` (``None`` si no conviene comprimirlo)"""
+        stat = os.stat(path)
+        if stat.st_size < self.min_size:
+            return None
+        prefix = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+        extension = EXTENSIONS[encoding]
+        target = os.path.join(self.directory, f'{prefix}-{stat.st_mtime_ns}-{stat.st_size}.{extension}')
+        if os.path.exists(target):
+            return target
+        with self._lock:
+            if os.path.exists(target):
+                return target
+            with open(path, 'rb') as f:
+                data = f.read()
+            temporary = f'{target}.tmp'
+            with open(temporary, 'wb') as f:
+                f.write(compress(data, encoding, STATIC_LEVELS[encoding]))
+            os.replace(temporary, target)
+            # Copias de versiones anteriores del mismo archivo
+            for entry in os.scandir(self.directory):
+                if entry.name.startswith(prefix) and entry.name.endswith(f'.{extension}') and entry.path != target:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+        return target
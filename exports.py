@@ -0,0 +1,51 @@
+"""Exportación de colecciones a Excel y CSV fila por fila.
+
+No se arma ninguna tabla en memoria: las filas llegan de un iterable que se
+recorre una sola vez; en xlsx se usa el modo write-only de openpyxl (cada
+hoja se escribe a un archivo temporal a medida que se agregan filas) y en
+CSV un generador que entrega el archivo en bloques.
+
+Las columnas de cada hoja son fijas (ver ``EXPORT_SHEETS`` en ``main``):
+el encabezado se escribe sin recorrer antes las filas.
+"""
+import csv
+import io
+
+from openpyxl import Workbook
+
+# Tamaño aproximado de cada bloque de la respuesta CSV
+CSV_CHUNK_SIZE = 64 * 1024
+
+
+def cell_value(value):
+    """Valor para una celda: listas y dicts se escriben como texto"""
+    if isinstance(value, (list, tuple, dict)):
+        return str(value)
+    return value
+
+
+def write_xlsx(sheets, target):
+    """Escribe las hojas ``[(título, columnas, filas)]`` en ``target`` (archivo binario)"""
+    workbook = Workbook(write_only=True)
+    for title, columns, rows in sheets:
+        worksheet = workbook.create_sheet(title)
+        worksheet.append(list(columns))
+        for row in rows:
+            worksheet.append([cell_value(row.get(column)) for column in columns])
+    workbook.save(target)
+
+
+def iter_csv(columns, rows):
+    """Genera el CSV de ``rows`` con las columnas ``columns`` en bloques de texto"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM para que Excel reconozca el UTF-8
+    buffer.write('\ufeff')
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([cell_value(row.get(column)) for column in columns])
+        if buffer.tell() >= CSV_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
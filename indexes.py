@@ -0,0 +1,241 @@
+"""Índices secundarios sobre las colecciones del ``Store``.
+
+Igual que los agregados de ``rollups.py``, se mantienen suscritos a los
+cambios de la colección y se reconstruyen completos solo cuando la
+colección se (re)carga.
+"""
+from bisect import bisect_left, bisect_right, insort
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+DAY_MICROS = 24 * 60 * 60 * 1000000
+
+# Fecha ya interpretada: microsegundos desde 1970 y claves de día, mes
+# (``año * 12 + mes - 1``) y año
+Period = namedtuple('Period', 'micros day month year')
+
+
+def parse_date(date):
+    """Fecha ISO como ``datetime`` sin zona (hora tal como se registró)"""
+    return datetime.fromisoformat(date.replace('Z', '+00:00')).replace(tzinfo=None)
+
+
+def period_of(date):
+    """``Period`` de una fecha ISO"""
+    parsed = parse_date(date)
+    micros = (parsed - EPOCH) // timedelta(microseconds=1)
+    return Period(micros, micros // DAY_MICROS, parsed.year * 12 + parsed.month - 1, parsed.year)
+
+
+def now_micros():
+    """Hora local actual en microsegundos desde 1970"""
+    return (datetime.now() - EPOCH) // timedelta(microseconds=1)
+
+
+def elapsed_days(period, now):
+    """Días completos transcurridos desde ``period`` (como ``timedelta.days``)"""
+    return (now - period.micros) // DAY_MICROS
+
+
+def month_key(month):
+    """Clave ``YYYY-MM`` de un mes codificado como ``año * 12 + mes - 1``"""
+    return '%04d-%02d' % (month // 12, month % 12 + 1)
+
+
+GRANULARITIES = ('day', 'week', 'month', 'quarter', 'year')
+
+
+def bucket_label(day, granularity):
+    """Etiqueta del periodo que contiene el día ``day`` (días desde 1970)"""
+    date = EPOCH.date() + timedelta(days=day)
+    if granularity == 'day':
+        return date.isoformat()
+    if granularity == 'week':
+        year, week, _ = date.isocalendar()
+        return '%04d-W%02d' % (year, week)
+    if granularity == 'month':
+        return '%04d-%02d' % (date.year, date.month)
+    if granularity == 'quarter':
+        return '%04d-Q%d' % (date.year, (date.month - 1) // 3 + 1)
+    return str(date.year)
+
+
+class HashIndex:
+    """Índice ``clave -> IDs`` para filtros por igualdad.
+
+    ``keys(row)`` devuelve las claves de una entidad; puede ser más de una
+    (por ejemplo, todos los productos de un movimiento).
+    """
+
+    def __init__(self, collection, keys):
+        self.collection = collection
+        self.keys = keys
+        self._ids = {}
+        self.stale = True
+        collection.subscribe(self.on_change)
+
+    def lookup(self, key):
+        """IDs de las entidades con esa clave.
+
+        Devuelve el conjunto interno (sin copiarlo): no debe modificarse y
+        solo es estable mientras se tenga ``store.lock``.
+        """
+        with self.collection.store.lock:
+            if self.stale:
+                self.rebuild()
+            try:
+                return self._ids.get(key, frozenset())
+            except TypeError:
+                return frozenset()
+
+    def rebuild(self):
+        self._ids = {}
+        for row in self.collection:
+            self._add(row)
+        self.stale = False
+
+    def on_change(self, op, old, new):
+        if op == 'reset':
+            self.stale = True
+            return
+        if self.stale:
+            return
+        if old is not None:
+            self._remove(old)
+        if new is not None:
+            self._add(new)
+
+    def _add(self, row):
+        for key in self.keys(row):
+            try:
+                self._ids.setdefault(key, set()).add(row['id'])
+            except TypeError:
+                # Valores no hashables recibidos desde JSON: no se indexan
+                pass
+
+    def _remove(self, row):
+        for key in self.keys(row):
+            try:
+                ids = self._ids.get(key)
+            except TypeError:
+                continue
+            if ids is not None:
+                ids.discard(row['id'])
+                if not ids:
+                    del self._ids[key]
+
+
+class SortedIndex:
+    """Lista ordenada de ``(clave, id)`` para rangos y paginación por cursor"""
+
+    def __init__(self, collection, key):
+        self.collection = collection
+        self.key = key
+        self._entries = []
+        self.stale = True
+        collection.subscribe(self.on_change)
+
+    def rebuild(self):
+        self._entries = sorted((self.key(row), row['id']) for row in self.collection)
+        self.stale = False
+
+    def on_change(self, op, old, new):
+        if op == 'reset':
+            self.stale = True
+            return
+        if self.stale:
+            return
+        if old is not None:
+            entry = (self.key(old), old['id'])
+            position = bisect_left(self._entries, entry)
+            if position < len(self._entries) and self._entries[position] == entry:
+                del self._entries[position]
+        if new is not None:
+            insort(self._entries, (self.key(new), new['id']))
+
+    def descending(self, before=None, lower=None, upper=None, candidates=None, limit=None):
+        """IDs en orden descendente por ``(clave, id)``.
+
+        ``before`` excluye esa entrada y todo lo posterior (cursor);
+        ``lower``/``upper`` acotan la clave (ambos inclusivos);
+        ``candidates`` limita el resultado a ese conjunto de IDs.
+        """
+        with self.collection.store.lock:
+            if self.stale:
+                self.rebuild()
+            entries = self._entries
+            end = len(entries)
+            if upper is not None:
+                end = bisect_right(entries, (upper, float('inf')))
+            if before is not None:
+                end = min(end, bisect_left(entries, before))
+            start = 0
+            if lower is not None:
+                start = bisect_left(entries, (lower, float('-inf')))
+
+            span = end - start
+            if candidates is not None and span > 0:
+                # Recorrer el rango visita ~limit/densidad entradas; si los
+                # candidatos son pocos, ordenarlos directamente es más barato
+                density = max(len(candidates), 1) / span
+                scan_cost = span if limit is None else min(span, limit / density)
+                use_candidates = len(candidates) * 8 < scan_cost
+            else:
+                use_candidates = False
+
+            if use_candidates:
+                selected = sorted(
+                    entry for entry in ((self.key(row), row['id'])
+                                        for row in map(self.collection.get, candidates)
+                                        if row is not None)
+                    if (lower is None or entry[0] >= lower)
+                    and (upper is None or entry[0] <= upper)
+                    and (before is None or entry < before)
+                )
+                selected.reverse()
+                return [entry[1] for entry in selected[:limit]]
+
+            result = []
+            for position in range(end - 1, start - 1, -1):
+                row_id = entries[position][1]
+                if candidates is None or row_id in candidates:
+                    result.append(row_id)
+                    if limit is not None and len(result) >= limit:
+                        break
+            return result
+
+
+class TimestampIndex:
+    """Fechas de una colección interpretadas una sola vez, al escribirlas.
+
+    ``period(row)`` devuelve el ``Period`` del campo ``field`` de la entidad;
+    se recalcula solo si el valor del campo cambió.
+    """
+
+    def __init__(self, collection, field):
+        self.collection = collection
+        self.field = field
+        # id -> (valor del campo, Period)
+        self._periods = {}
+        collection.subscribe(self.on_change)
+
+    def period(self, row):
+        """``Period`` de la entidad (``None`` si el campo está vacío)"""
+        value = row.get(self.field)
+        if not value:
+            return None
+        cached = self._periods.get(row['id'])
+        if cached is not None and cached[0] == value:
+            return cached[1]
+        period = period_of(value)
+        self._periods[row['id']] = (value, period)
+        return period
+
+    def on_change(self, op, old, new):
+        if op == 'reset':
+            self._periods = {}
+        elif op == 'delete':
+            self._periods.pop(old['id'], None)
+        else:
+            self.period(new)
@@ -0,0 +1,168 @@
+"""Trabajos en segundo plano (exportaciones y reportes) con resultado en disco.
+
+Los trabajos corren en un pool de hilos acotado y la cola también: con
+``max_pending`` trabajos en cola o en curso, ``submit`` lanza ``QueueFull``
+en lugar de encolar otro. El estado de cada uno se
+guarda como JSON en ``<directorio>/jobs/<id>.json`` y su archivo en
+``<directorio>/<clave>.<extensión>``, así que cualquier worker puede
+responder el estado o entregar el archivo, no solo el que lo generó.
+
+La clave del archivo identifica el trabajo y la versión de los datos que
+lee: si ya existe un archivo con esa clave el trabajo termina al instante
+sin volver a generarlo. Los archivos se eliminan por antigüedad y, si
+ocupan más de ``max_bytes``, desde el usado hace más tiempo.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFull(Exception):
+    """La cola ya tiene ``max_pending`` trabajos sin terminar"""
+
+
+class JobQueue:
+    def __init__(self, directory, workers=2, max_age=24 * 60 * 60, max_bytes=500 * 1024 * 1024,
+                 max_pending=16):
+        self.directory = directory
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.max_pending = max_pending
+        self._jobs_dir = os.path.join(directory, 'jobs')
+        os.makedirs(self._jobs_dir, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        # clave -> ID del trabajo de este proceso que está generando ese archivo
+        self._building = {}
+        self.evict()
+
+    def submit(self, kind, key, extension, build, filename):
+        """Encola un trabajo y devuelve su estado.
+
+        ``build(path)`` escribe el archivo; ``key`` debe cambiar si cambian
+        los parámetros o los datos. Si el archivo ya existe el trabajo se
+        devuelve terminado (``cached``); si otro trabajo igual está en curso
+        se devuelve ese. Si no, y ya hay ``max_pending`` trabajos sin
+        terminar, lanza ``QueueFull``.
+        """
+        artifact = f'{key}.{extension}'
+        with self._lock:
+            if key in self._building:
+                job = self.get(self._building[key])
+                if job is not None:
+                    return job
+            job = {
+                'id': uuid.uuid4().hex,
+                'kind': kind,
+                'status': PENDING,
+                'artifact': artifact,
+                'filename': filename,
+                'created_at': datetime.now().isoformat(),
+                'cached': False
+            }
+            path = self.artifact_path(job)
+            if self._fresh(path):
+                # Marca el archivo como usado recientemente (límite de tamaño)
+                os.utime(path)
+                job.update(status=DONE, cached=True, size=os.path.getsize(path),
+                           finished_at=job['created_at'])
+                self._save(job)
+                return job
+            if len(self._building) >= self.max_pending:
+                raise QueueFull(f"Hay {len(self._building)} trabajos en curso; intente más tarde")
+            self._building[key] = job['id']
+            self._save(job)
+        self._executor.submit(self._run, job, key, build)
+        return job
+
+    def get(self, job_id):
+        """Estado de un trabajo (``None`` si no existe)"""
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self._jobs_dir, f'{job_id}.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def artifact_path(self, job):
+        return os.path.join(self.directory, job['artifact'])
+
+    def _fresh(self, path):
+        try:
+            return time.time() - os.path.getmtime(path) < self.max_age
+        except OSError:
+            return False
+
+    def _run(self, job, key, build):
+        path = self.artifact_path(job)
+        temporary = f'{path}.{job["id"]}.tmp'
+        job.update(status=RUNNING, started_at=datetime.now().isoformat())
+        self._save(job)
+        try:
+            build(temporary)
+            os.replace(temporary, path)
+            job.update(status=DONE, size=os.path.getsize(path))
+        except Exception as e:
+            job.update(status=FAILED, error=str(e))
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        job['finished_at'] = datetime.now().isoformat()
+        with self._lock:
+            self._save(job)
+            self._building.pop(key, None)
+        self.evict()
+
+    def _save(self, job):
+        path = os.path.join(self._jobs_dir, f'{job["id"]}.json')
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(temporary, path)
+
+    def evict(self):
+        """Elimina archivos y estados vencidos y, si hace falta, los menos usados"""
+        now = time.time()
+        with self._lock:
+            for name in os.listdir(self._jobs_dir):
+                path = os.path.join(self._jobs_dir, name)
+                try:
+                    if now - os.path.getmtime(path) >= self.max_age:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+            artifacts = []
+            for entry in os.scandir(self.directory):
+                if not entry.is_file() or entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if now - stat.st_mtime >= self.max_age:
+                    self._remove(entry.path)
+                else:
+                    artifacts.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in artifacts)
+            for _, size, path in sorted(artifacts):
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
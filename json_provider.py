@@ -0,0 +1,69 @@
+"""Proveedor JSON de Flask con orjson cuando está instalado.
+
+orjson serializa dicts y listas varias veces más rápido que ``json`` y
+escribe directamente fechas (ISO 8601) y tipos de NumPy. Sin orjson se usa
+``json`` con las mismas conversiones, así que las respuestas son
+equivalentes: claves ordenadas, fechas ISO, escalares y arrays de NumPy
+como números y listas, ``Decimal`` como texto.
+"""
+import dataclasses
+import decimal
+import uuid
+from datetime import date, datetime, time
+
+import numpy as np
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_default(value):
+    """Tipos que el codificador no serializa por sí mismo"""
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    if hasattr(value, '__html__'):
+        return str(value.__html__())
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """``app.json`` con orjson; vuelve al proveedor de Flask si no está o si se
+    piden opciones de ``json`` (``indent``, ``cls``, ...)"""
+
+    default = staticmethod(encode_default)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self._encode(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        # Bytes directamente, sin pasar por str
+        return self._app.response_class(self._encode(obj, indent=self._app.debug) + b'\n', mimetype=self.mimetype)
+
+    def _encode(self, obj, indent=False):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option)
@@ -0,0 +1,299 @@
+"""Libro columnar de líneas de movimiento para analítica.
+
+Cada línea de producto de un movimiento ocupa una fila en arreglos NumPy
+(una columna por campo), así los agregados se calculan con operaciones
+vectorizadas en lugar de recorrer los dicts anidados de ``movements``.
+
+El libro es de solo-agregado: editar o eliminar un movimiento marca sus
+filas como eliminadas (``alive=False``) y, al editar, agrega las nuevas.
+Cuando las filas eliminadas superan a las vivas se compacta.
+
+Los valores a nivel de movimiento (``cost``) se guardan solo en la primera
+fila de cada movimiento (``head=True``); un movimiento sin productos ocupa
+una fila con ``line=False`` para conservar su costo.
+"""
+import numpy as np
+
+from indexes import TimestampIndex
+
+# Sin valor (None, '', IDs no enteros) en las columnas de IDs
+MISSING = -1
+
+
+def as_id(value):
+    """ID entero de una columna, o ``MISSING`` si no es un entero"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    return MISSING
+
+
+# Máximo de combinaciones de claves para agrupar con un bincount denso
+DENSE_GROUPS = 1 << 22
+
+
+def factorize(column):
+    """Valores distintos de una columna entera y el código de cada fila.
+
+    Si el rango es chico el código es un desplazamiento (sin ordenar); si no,
+    se usa ``np.unique``.
+    """
+    low, high = int(column.min()), int(column.max())
+    if high - low < DENSE_GROUPS:
+        return np.arange(low, high + 1), column.astype(np.int64) - low
+    values, codes = np.unique(column, return_inverse=True)
+    return values, codes.ravel()
+
+
+class Categories:
+    """Codifica valores arbitrarios (nombres, tipos) como enteros"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def encode(self, value):
+        try:
+            code = self.codes.get(value)
+        except TypeError:
+            # Valores no hashables recibidos desde JSON: se tratan como vacíos
+            return self.encode(None)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def lookup(self, value):
+        """Código de un valor ya visto (``None`` si nunca apareció)"""
+        try:
+            return self.codes.get(value)
+        except TypeError:
+            return None
+
+
+class MovementLedger:
+    """Columnas por línea de producto, mantenidas junto a ``movements``"""
+
+    COLUMNS = {
+        'movement_id': np.int64,
+        'product_id': np.int64,
+        'stage_id': np.int64,
+        'substage_id': np.int64,
+        'location_id': np.int64,
+        'location': np.int32,      # código de Categories (nombre de la locación)
+        'type': np.int8,           # código de Categories ('uso', 'compra', ...)
+        'responsible': np.int32,   # código de Categories
+        'timestamp': np.int64,     # microsegundos desde 1970 (hora del registro)
+        'day': np.int32,           # días desde 1970
+        'month': np.int32,         # año * 12 + mes - 1
+        'year': np.int16,
+        'index': np.int32,         # posición de la línea dentro del movimiento
+        'quantity': np.float64,
+        'cost': np.float64,        # costo del movimiento (solo en la fila head)
+        'line': np.bool_,          # es una línea de producto real
+        'head': np.bool_,          # primera fila del movimiento
+        'alive': np.bool_,
+    }
+    CATEGORICAL = ('location', 'type', 'responsible')
+
+    def __init__(self, movements, timestamps=None, capacity=1024):
+        self.movements = movements
+        self.timestamps = timestamps or TimestampIndex(movements, 'date')
+        self.categories = {name: Categories() for name in self.CATEGORICAL}
+        self._reset(capacity)
+        self.stale = True
+        movements.subscribe(self.on_change)
+
+    def _reset(self, capacity):
+        self.columns = {name: np.zeros(capacity, dtype) for name, dtype in self.COLUMNS.items()}
+        self.size = 0
+        self.dead = 0
+        # movement_id -> (inicio, fin) de sus filas
+        self._rows = {}
+
+    # Mantenimiento
+
+    def rebuild(self):
+        """Recarga todas las filas desde la colección"""
+        self.categories = {name: Categories() for name in self.CATEGORICAL}
+        self._reset(max(1024, len(self.movements) * 2))
+        for movement in self.movements:
+            self._append(movement)
+        self.stale = False
+
+    def on_change(self, op, old, new):
+        if op == 'reset':
+            self.stale = True
+            return
+        if self.stale:
+            return
+        if old is not None and new is not None and self._key(old) == self._key(new):
+            # Solo cambiaron campos que el libro no guarda
+            return
+        if old is not None:
+            self._remove(old['id'])
+        if new is not None:
+            self._append(new)
+        if self.dead > max(1024, self.size - self.dead):
+            self._compact()
+
+    @staticmethod
+    def _key(movement):
+        return (movement.get('date'), movement.get('type'), movement.get('stage_id'),
+                movement.get('substage_id'), movement.get('location_id'), movement.get('location'),
+                movement.get('responsible'), movement.get('cost'),
+                [(p['product_id'], p['quantity']) for p in movement.get('products', [])])
+
+    def _append(self, movement):
+        lines = movement.get('products') or [None]
+        start = self.size
+        stop = start + len(lines)
+        if stop > len(self.columns['alive']):
+            self._grow(stop)
+
+        period = self.timestamps.period(movement)
+        columns = self.columns
+        rows = slice(start, stop)
+        columns['movement_id'][rows] = movement['id']
+        columns['stage_id'][rows] = as_id(movement.get('stage_id'))
+        columns['substage_id'][rows] = as_id(movement.get('substage_id'))
+        columns['location_id'][rows] = as_id(movement.get('location_id'))
+        columns['location'][rows] = self.categories['location'].encode(movement.get('location'))
+        columns['type'][rows] = self.categories['type'].encode(movement['type'])
+        columns['responsible'][rows] = self.categories['responsible'].encode(movement.get('responsible'))
+        columns['timestamp'][rows] = period.micros
+        columns['day'][rows] = period.day
+        columns['month'][rows] = period.month
+        columns['year'][rows] = period.year
+        columns['cost'][rows] = 0
+        columns['cost'][start] = movement.get('cost', 0)
+        columns['head'][rows] = False
+        columns['head'][start] = True
+        columns['alive'][rows] = True
+        columns['index'][rows] = np.arange(len(lines))
+        for position, line in enumerate(lines, start):
+            columns['line'][position] = line is not None
+            columns['product_id'][position] = as_id(line['product_id']) if line else MISSING
+            columns['quantity'][position] = line['quantity'] if line else 0
+
+        self._rows[movement['id']] = (start, stop)
+        self.size = stop
+
+    def _remove(self, movement_id):
+        rows = self._rows.pop(movement_id, None)
+        if rows is not None:
+            self.columns['alive'][rows[0]:rows[1]] = False
+            self.dead += rows[1] - rows[0]
+
+    def _grow(self, needed):
+        capacity = max(needed, len(self.columns['alive']) * 2)
+        for name, column in self.columns.items():
+            grown = np.zeros(capacity, column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+
+    def _compact(self):
+        """Descarta las filas eliminadas"""
+        alive = self.columns['alive'][:self.size]
+        keep = np.flatnonzero(alive)
+        capacity = max(1024, len(keep) * 2)
+        for name, column in self.columns.items():
+            compacted = np.zeros(capacity, column.dtype)
+            compacted[:len(keep)] = column[keep]
+            self.columns[name] = compacted
+        self.size = len(keep)
+        self.dead = 0
+        # Las filas de cada movimiento siguen siendo contiguas
+        ids = self.columns['movement_id'][:self.size]
+        heads = np.flatnonzero(self.columns['head'][:self.size])
+        stops = np.append(heads[1:], self.size)
+        self._rows = {int(ids[start]): (int(start), int(stop)) for start, stop in zip(heads, stops)}
+
+    # Consultas
+
+    def _ensure(self):
+        if self.stale:
+            self.rebuild()
+
+    def _mask(self, conditions):
+        columns = self.columns
+        mask = columns['alive'][:self.size].copy()
+        for name, expected in conditions.items():
+            if name in self.CATEGORICAL:
+                expected = self.categories[name].lookup(expected)
+                if expected is None:
+                    return np.zeros(self.size, np.bool_)
+            column = columns[name][:self.size]
+            if isinstance(expected, (list, tuple, set, frozenset)):
+                mask &= np.isin(column, list(expected))
+            else:
+                mask &= column == expected
+        return mask
+
+    def select(self, names, **conditions):
+        """Copias de las columnas ``names`` de las filas que cumplen ``conditions``.
+
+        Las columnas categóricas se devuelven codificadas.
+        """
+        with self.movements.store.lock:
+            self._ensure()
+            mask = self._mask(conditions)
+            return {name: self.columns[name][:self.size][mask] for name in names}
+
+    def group_sum(self, keys, value=None, **conditions):
+        """Suma ``value`` por combinación de columnas ``keys``.
+
+        ``conditions`` filtran filas por igualdad (o pertenencia si el valor
+        es una lista). Devuelve ``{clave: (total, filas)}``; la clave es una
+        tupla con un valor por columna, o el valor solo si hay una columna.
+        Las columnas categóricas se devuelven decodificadas.
+        """
+        with self.movements.store.lock:
+            self._ensure()
+            mask = self._mask(conditions)
+            key_columns = [self.columns[name][:self.size][mask] for name in keys]
+            values = self.columns[value][:self.size][mask] if value else None
+
+        if not len(key_columns[0]):
+            return {}
+        # Cada columna se convierte en códigos 0..n-1 y las combinaciones en
+        # un único índice; bincount suma cada grupo sin recorrer en Python
+        uniques, combined, size = [], np.zeros(len(key_columns[0]), np.int64), 1
+        for column in key_columns:
+            values_of_column, codes = factorize(column)
+            combined = combined * len(values_of_column) + codes
+            size *= len(values_of_column)
+            uniques.append(values_of_column)
+        if size <= DENSE_GROUPS:
+            counts = np.bincount(combined, minlength=size)
+            totals = np.bincount(combined, weights=values, minlength=size) if values is not None else counts
+            groups = np.flatnonzero(counts)
+            counts, totals = counts[groups], totals[groups]
+        else:
+            # Demasiadas combinaciones posibles: reducir sobre las presentes
+            groups, inverse = np.unique(combined, return_inverse=True)
+            counts = np.bincount(inverse)
+            totals = np.bincount(inverse, weights=values) if values is not None else counts
+
+        # Recuperar el valor de cada columna a partir del índice combinado
+        parts = []
+        for values_of_column in reversed(uniques):
+            parts.append(values_of_column[groups % len(values_of_column)].tolist())
+            groups = groups // len(values_of_column)
+        parts.reverse()
+
+        decoders = [self.categories[name].values if name in self.CATEGORICAL else None for name in keys]
+        result = {}
+        for index, (total, count) in enumerate(zip(totals.tolist(), counts.tolist())):
+            key = tuple(decoder[part[index]] if decoder is not None else part[index]
+                        for part, decoder in zip(parts, decoders))
+            result[key if len(key) > 1 else key[0]] = (total, count)
+        return result
+
+    def stats(self):
+        with self.movements.store.lock:
+            return {
+                'rows': self.size - self.dead,
+                'dead_rows': self.dead,
+                'capacity': len(self.columns['alive']),
+                'bytes': sum(column.nbytes for column in self.columns.values())
+            }
@@ -1,15 +1,43 @@
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory
+from flask import Flask, Request, render_template, request, jsonify, send_file
 from flask_cors import CORS
 from datetime import datetime, timedelta
 import json
+import math
+import mimetypes
 import os
-import io
-import pandas as pd
 from decimal import Decimal
-from werkzeug.utils import secure_filename
-import uuid
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.security import safe_join
+import werkzeug.utils
+import base64
+import functools
+import threading
+import time
+from collections import OrderedDict
+import tempfile
+import hashlib
+from store import Store
+from storage import create_backend
+from rollups import MovementRollups, DailySeries, RunningTotal
+from ledger import MovementLedger
+from alerts import LowStockIndex
+from changes import ChangeFeed
+import stock as stock_balances
+import exports
+import imports
+from blobs import BlobStore, ChunkedUploads, UploadOffsetError
+from thumbnails import VARIANTS, VariantCache
+import compression
+from compression import CompressionCache, StaticCompressor
+from json_provider import FastJSONProvider
+import jobs
+from jobs import JobQueue
+from indexes import (HashIndex, SortedIndex, TimestampIndex, DAY_MICROS, GRANULARITIES, bucket_label,
+                     elapsed_days, month_key, now_micros, period_of)
 
 app = Flask(__name__)
+# JSON con orjson si está instalado (fechas y tipos de NumPy se serializan solos)
+app.json = FastJSONProvider(app)
 CORS(app)
 
 # Configuración para subida de archivos
@@ -23,15 +51,157 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(os.path.join(UPLOAD_FOLDER, 'recipes'), exist_ok=True)
 os.makedirs(os.path.join(UPLOAD_FOLDER, 'images'), exist_ok=True)
 
-# Configuración de la base de datos en memoria
-locations = [
+# Archivos guardados por contenido y subidas por partes (mismo disco que uploads)
+app.config['BLOBS_FOLDER'] = os.path.join(UPLOAD_FOLDER, 'blobs')
+app.config['CHUNKED_UPLOADS_FOLDER'] = os.path.join(UPLOAD_FOLDER, 'subidas')
+app.config['MAX_UPLOAD_SIZE'] = int(os.environ.get('MAX_UPLOAD_SIZE', 1024 * 1024 * 1024))  # subidas por partes
+blob_store = BlobStore(app.config['BLOBS_FOLDER'])
+chunked_uploads = ChunkedUploads(app.config['CHUNKED_UPLOADS_FOLDER'], app.config['MAX_UPLOAD_SIZE'])
+
+class UploadRequest(Request):
+    """Request que escribe los archivos del formulario en el disco de los blobs.
+
+    Werkzeug guarda cada archivo en un temporal propio; acá el temporal ya
+    calcula el hash y después se mueve a su lugar sin copiarlo.
+    """
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return blob_store.temporary()
+
+app.request_class = UploadRequest
+
+# Envío de archivos guardados: 'x-sendfile' (Apache, lighttpd) o 'x-accel'
+# (nginx) dejan que el proxy envíe los bytes sin ocupar un worker. Con
+# 'x-accel' la ruta interna es X_ACCEL_PREFIX + la ruta relativa a la
+# carpeta de la aplicación (en nginx: ``location /interno/ { internal; alias <carpeta>/; }``)
+app.config['SENDFILE_MODE'] = os.environ.get('SENDFILE_MODE', '')
+app.config['X_ACCEL_PREFIX'] = os.environ.get('X_ACCEL_PREFIX', '/interno/')
+app.config['X_ACCEL_ROOT'] = os.path.abspath(os.environ.get('X_ACCEL_ROOT', '.'))
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+def send_stored(path, etag=True, immutable=False, **kwargs):
+    """Envía un archivo del disco con ETag, ``Range`` y el modo de envío configurado.
+
+    ``etag`` es el hash del contenido cuando se conoce. ``immutable`` es
+    para URLs que incluyen ese hash: el navegador no vuelve a pedirlas.
+    Sin eso, se revalida con el ETag (``304``).
+    """
+    path = os.path.abspath(path)
+    mode = app.config['SENDFILE_MODE']
+    internal = None
+    if mode == 'x-accel':
+        relative = os.path.relpath(path, app.config['X_ACCEL_ROOT'])
+        if not relative.startswith('..'):
+            internal = app.config['X_ACCEL_PREFIX'] + relative.replace(os.sep, '/')
+    use_proxy = mode == 'x-sendfile' or internal is not None
+    try:
+        response = werkzeug.utils.send_file(
+            path, request.environ, etag=etag, max_age=IMMUTABLE_MAX_AGE if immutable else None,
+            use_x_sendfile=use_proxy, response_class=app.response_class,
+            # Con proxy los rangos los resuelve el proxy; acá solo el 304
+            conditional=not use_proxy, **kwargs
+        )
+    except RequestedRangeNotSatisfiable as e:
+        # 416 (los endpoints convierten las demás excepciones en 500)
+        return e.get_response()
+    if use_proxy:
+        response = response.make_conditional(request.environ)
+        if response.status_code == 304:
+            response.headers.pop('X-Sendfile', None)
+        elif internal is not None:
+            del response.headers['X-Sendfile']
+            response.headers['X-Accel-Redirect'] = internal
+    if immutable:
+        response.cache_control.immutable = True
+    # El navegador usa el tipo declarado, no el que deduce del contenido
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+# Compresión de respuestas (Brotli o gzip según Accept-Encoding)
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))  # bytes
+app.config['COMPRESS_CACHE_BYTES'] = int(os.environ.get('COMPRESS_CACHE_BYTES', 32 * 1024 * 1024))
+app.config['STATIC_COMPRESSED_FOLDER'] = os.environ.get('STATIC_COMPRESSED_FOLDER', os.path.join('data', 'estaticos'))
+compression_cache = CompressionCache(app.config['COMPRESS_CACHE_BYTES'])
+static_compressor = StaticCompressor(app.config['STATIC_COMPRESSED_FOLDER'], app.config['COMPRESS_MIN_SIZE'])
+
+@app.after_request
+def compress_response(response):
+    """Comprime las respuestas JSON y de texto (los archivos se envían tal cual)"""
+    if (request.method != 'GET' or response.status_code != 200 or response.direct_passthrough
+            or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.mimetype not in compression.COMPRESSIBLE):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = compression.negotiate(request.accept_encodings)
+    data = response.get_data()
+    if encoding is None or len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(compression_cache.get(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    # Otros bytes con el mismo contenido: el ETag pasa a ser débil
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+def send_static(filename):
+    """Archivos estáticos, con copias precomprimidas si el cliente las acepta"""
+    path = safe_join(app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": "Archivo no encontrado"}), 404
+    mimetype = mimetypes.guess_type(path)[0]
+    if mimetype not in compression.COMPRESSIBLE:
+        return send_stored(path)
+    encoding = compression.negotiate(request.accept_encodings)
+    compressed = static_compressor.get(path, encoding) if encoding else None
+    if compressed is None:
+        response = send_stored(path)
+    else:
+        stat = os.stat(path)
+        response = send_stored(compressed, etag=f'{stat.st_mtime_ns}-{stat.st_size}-{encoding}', mimetype=mimetype)
+        response.headers['Content-Encoding'] = encoding
+        # send_file lo nombra como la copia comprimida
+        response.headers.pop('Content-Disposition', None)
+    response.vary.add('Accept-Encoding')
+    return response
+
+app.view_functions['static'] = send_static
+
+# Miniaturas y versiones web de las imágenes (caché en disco, se regenera)
+app.config['VARIANTS_FOLDER'] = os.environ.get('VARIANTS_FOLDER', os.path.join('data', 'variantes'))
+app.config['VARIANTS_MAX_BYTES'] = int(os.environ.get('VARIANTS_MAX_BYTES', 200 * 1024 * 1024))
+variant_cache = VariantCache(app.config['VARIANTS_FOLDER'], max_bytes=app.config['VARIANTS_MAX_BYTES'])
+
+# Configuración de la persistencia: 'sqlite' (por defecto), 'journal' o 'memory'
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'sqlite')
+app.config['DATABASE_PATH'] = os.environ.get('DATABASE_PATH', os.path.join('data', 'inventario.db'))
+app.config['JOURNAL_DIR'] = os.environ.get('JOURNAL_DIR', os.path.join('data', 'journal'))
+app.config['SNAPSHOT_INTERVAL'] = int(os.environ.get('SNAPSHOT_INTERVAL', 300))  # segundos
+app.config['JOURNAL_FSYNC'] = os.environ.get('JOURNAL_FSYNC', '1') == '1'
+app.config['JOBS_FOLDER'] = os.environ.get('JOBS_FOLDER', os.path.join('data', 'trabajos'))
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOBS_MAX_AGE'] = int(os.environ.get('JOBS_MAX_AGE', 24 * 60 * 60))  # segundos
+app.config['JOBS_MAX_BYTES'] = int(os.environ.get('JOBS_MAX_BYTES', 500 * 1024 * 1024))
+app.config['JOBS_MAX_PENDING'] = int(os.environ.get('JOBS_MAX_PENDING', 16))  # trabajos en cola o en curso
+
+store = Store(create_backend(
+    app.config['STORAGE_BACKEND'],
+    path=app.config['DATABASE_PATH'],
+    journal_dir=app.config['JOURNAL_DIR'],
+    snapshot_interval=app.config['SNAPSHOT_INTERVAL'],
+    fsync=app.config['JOURNAL_FSYNC']
+))
+if app.config['STORAGE_BACKEND'] == 'journal':
+    app.logger.info("Journal recuperado: %s", store.backend.recovery)
+
+# Datos iniciales: se cargan solo la primera vez (base de datos vacía)
+locations = store.collection('locations', [
     {"id": 1, "name": "Invernadero Principal", "description": "Invernadero principal para cultivo", "responsible": "Juan Pérez", "created_at": "2024-01-01T00:00:00"},
     {"id": 2, "name": "Invernadero Secundario", "description": "Invernadero secundario para propagación", "responsible": "María García", "created_at": "2024-01-01T00:00:00"},
     {"id": 3, "name": "Área de Secado", "description": "Área especializada para secado y curado", "responsible": "Carlos López", "created_at": "2024-01-01T00:00:00"}
-]
+])
 
 # Productos con nuevas unidades y opción sin stock
-products = [
+products = store.collection('products', [
     {"id": 1, "name": "Fertilizante NPK", "unit": "kg", "initial_stock": 25, "current_stock": 70, "min_stock": 5, "price": 15.50, "has_stock": True, "responsible": "Juan Pérez", "created_at": "2024-01-01T00:00:00"},
     {"id": 2, "name": "Sustrato Coco", "unit": "kg", "initial_stock": 50, "current_stock": 50, "min_stock": 10, "price": 8.75, "has_stock": True, "responsible": "María García", "created_at": "2024-01-01T00:00:00"},
     {"id": 3, "name": "Semillas Tomate", "unit": "unidades", "initial_stock": 100, "current_stock": 100, "min_stock": 20, "price": 0.25, "has_stock": True, "responsible": "Carlos López", "created_at": "2024-01-01T00:00:00"},
@@ -39,62 +209,54 @@ products = [
     {"id": 5, "name": "Temperatura Sala A", "unit": "°C", "initial_stock": 0, "current_stock": 25, "min_stock": 0, "price": 0.00, "has_stock": False, "responsible": "Sistema Automático", "created_at": "2024-01-01T00:00:00"},
     {"id": 6, "name": "pH Solución Nutritiva", "unit": "pH", "initial_stock": 0, "current_stock": 6.2, "min_stock": 0, "price": 0.00, "has_stock": False, "responsible": "Sistema Automático", "created_at": "2024-01-01T00:00:00"},
     {"id": 7, "name": "Conductividad Eléctrica", "unit": "EC", "initial_stock": 0, "current_stock": 1.8, "min_stock": 0, "price": 0.00, "has_stock": False, "responsible": "Sistema Automático", "created_at": "2024-01-01T00:00:00"}
-]
+])
 
-stages = [
+stages = store.collection('stages', [
     {"id": 1, "name": "Germinación", "duration": 7, "description": "Proceso inicial de germinación de semillas", "location_id": 2, "expected_duration": 7, "start_time": None, "end_time": None, "actual_duration": None, "status": "pending", "responsible": "María García", "created_at": "2024-01-01T00:00:00"},
     {"id": 2, "name": "Crecimiento", "duration": 30, "description": "Fase de crecimiento vegetativo", "location_id": 1, "expected_duration": 30, "start_time": None, "end_time": None, "actual_duration": None, "status": "pending", "responsible": "Juan Pérez", "created_at": "2024-01-01T00:00:00"},
     {"id": 3, "name": "Floración", "duration": 45, "description": "Etapa de floración y fructificación", "location_id": 1, "expected_duration": 45, "start_time": None, "end_time": None, "actual_duration": None, "status": "pending", "responsible": "Carlos López", "created_at": "2024-01-01T00:00:00"}
-]
+])
 
-substages = [
+substages = store.collection('substages', [
     {"id": 1, "name": "Preparación de semillas", "duration": 2, "description": "Preparación y acondicionamiento de semillas", "stage_id": 1, "expected_duration": 2, "start_time": None, "end_time": None, "actual_duration": None, "status": "pending", "responsible": "María García", "created_at": "2024-01-01T00:00:00"},
     {"id": 2, "name": "Siembra", "duration": 5, "description": "Proceso de siembra en sustrato", "stage_id": 1, "expected_duration": 5, "start_time": None, "end_time": None, "actual_duration": None, "status": "pending", "responsible": "María García", "created_at": "2024-01-01T00:00:00"},
     {"id": 3, "name": "Crecimiento inicial", "duration": 15, "description": "Primeras semanas de crecimiento", "stage_id": 2, "expected_duration": 15, "start_time": None, "end_time": None, "actual_duration": None, "status": "pending", "responsible": "Juan Pérez", "created_at": "2024-01-01T00:00:00"},
     {"id": 4, "name": "Desarrollo vegetativo", "duration": 15, "description": "Desarrollo completo de la planta", "stage_id": 2, "expected_duration": 15, "start_time": None, "end_time": None, "actual_duration": None, "status": "pending", "responsible": "Juan Pérez", "created_at": "2024-01-01T00:00:00"}
-]
+])
 
-movements = [
+movements = store.collection('movements', [
     {"id": 1, "date": "2024-01-15T10:30:00", "type": "compra", "products": [{"product_id": 1, "quantity": 50, "unit": "kg"}], "stage_id": None, "substage_id": None, "responsible": "Juan Pérez", "location": "Invernadero Principal", "observations": "Compra inicial de fertilizante", "cost": 775.00},
     {"id": 2, "date": "2024-01-20T08:15:00", "type": "uso", "products": [{"product_id": 1, "quantity": 5, "unit": "kg"}], "stage_id": 2, "substage_id": 3, "responsible": "María García", "location": "Invernadero Principal", "observations": "Aplicación de fertilizante en crecimiento inicial", "cost": 77.50},
     {"id": 3, "date": "2024-02-10T14:20:00", "type": "uso", "products": [{"product_id": 4, "quantity": 12, "unit": "l"}], "stage_id": 1, "substage_id": 2, "responsible": "Carlos López", "location": "Invernadero Secundario", "observations": "Riego durante siembra", "cost": 14.40}
-]
+])
 
 # Nuevas estructuras de datos para Post-it y Recetas
-postits = [
+postits = store.collection('postits', [
     {"id": 1, "title": "Revisar pH del agua", "content": "Verificar que el pH del agua esté entre 6.0 y 6.5 antes del próximo riego", "color": "#ffeb3b", "created_at": "2024-01-01T10:00:00", "updated_at": "2024-01-01T10:00:00"},
     {"id": 2, "title": "Fertilización programada", "content": "Aplicar fertilizante NPK en el invernadero principal el viernes", "color": "#4caf50", "created_at": "2024-01-02T14:30:00", "updated_at": "2024-01-02T14:30:00"},
     {"id": 3, "title": "Inspección de plagas", "content": "Revisar las plantas en etapa de floración para detectar posibles plagas", "color": "#f44336", "created_at": "2024-01-03T09:15:00", "updated_at": "2024-01-03T09:15:00"}
-]
+])
 
-recipes = [
+recipes = store.collection('recipes', [
     {"id": 1, "name": "Manual de Cultivo Hidropónico", "filename": "manual_hidroponico.pdf", "file_type": "pdf", "file_path": "uploads/recipes/manual_hidroponico.pdf", "uploaded_at": "2024-01-01T12:00:00"},
     {"id": 2, "name": "Receta Fertilizante Orgánico", "filename": "fertilizante_organico.docx", "file_type": "docx", "file_path": "uploads/recipes/fertilizante_organico.docx", "uploaded_at": "2024-01-02T15:30:00"}
-]
+])
 
-recipe_images = [
+recipe_images = store.collection('recipe_images', [
     {"id": 1, "title": "Gorila Glue Etapa 4 Floración", "filename": "gorila_glue_floracion.jpg", "file_path": "uploads/images/gorila_glue_floracion.jpg", "comment": "Planta en semana 4 de floración, desarrollo excelente de tricomas", "uploaded_at": "2024-01-01T16:45:00"},
     {"id": 2, "title": "Receta Brownie Cannabis", "filename": "brownie_cannabis.jpg", "file_path": "uploads/images/brownie_cannabis.jpg", "comment": "Brownies con mantequilla de cannabis, perfecta textura y sabor", "uploaded_at": "2024-01-02T18:20:00"}
-]
+])
 
 # Responsables por locación
-location_responsibles = [
+location_responsibles = store.collection('location_responsibles', [
     {"id": 1, "name": "Juan Pérez", "role": "Supervisor Principal", "location_id": 1, "color": "#4caf50", "created_at": "2024-01-01T08:00:00"},
     {"id": 2, "name": "María García", "role": "Especialista en Germinación", "location_id": 2, "color": "#2196f3", "created_at": "2024-01-01T08:00:00"},
     {"id": 3, "name": "Carlos López", "role": "Técnico de Secado", "location_id": 3, "color": "#ff9800", "created_at": "2024-01-01T08:00:00"},
     {"id": 4, "name": "Ana Martín", "role": "Control de Calidad", "location_id": 1, "color": "#9c27b0", "created_at": "2024-01-01T08:00:00"}
-]
-
-# Contadores para IDs
-next_location_id = 4
-next_product_id = 8
-next_stage_id = 4
-next_substage_id = 5
-next_movement_id = 4
-next_postit_id = 4
-next_recipe_id = 3
-next_recipe_image_id = 3
-next_responsible_id = 5
+])
+
+# Cambios de estado del stock (ver alerts.py)
+stock_alerts = store.collection('stock_alerts')
 
 # Unidades disponibles
 AVAILABLE_UNITS = ['kg', 'g', 'l', 'ml', 'unidades', 'm', 'cm', 'pH', '°C', 'EC']
@@ -104,24 +266,37 @@ def allowed_file(filename):
 
 def get_location_name(location_id):
     """Obtiene el nombre de una locación por su ID"""
-    location = next((loc for loc in locations if loc["id"] == location_id), None)
+    location = locations.get(location_id)
     return location["name"] if location else "Desconocida"
 
 def get_product_by_id(product_id):
     """Obtiene un producto por su ID"""
-    return next((prod for prod in products if prod["id"] == product_id), None)
+    return products.get(product_id)
 
 def get_stage_by_id(stage_id):
     """Obtiene una etapa por su ID"""
-    return next((stage for stage in stages if stage["id"] == stage_id), None)
+    return stages.get(stage_id)
 
 def get_substage_by_id(substage_id):
     """Obtiene una sub-etapa por su ID"""
-    return next((substage for substage in substages if substage["id"] == substage_id), None)
+    return substages.get(substage_id)
 
 def get_location_by_id(location_id):
     """Obtiene una locación por su ID"""
-    return next((location for location in locations if location["id"] == location_id), None)
+    return locations.get(location_id)
+
+def stage_with_location(stage):
+    """Etapa con el nombre de su locación (como la devuelve la API)"""
+    stage_copy = stage.copy()
+    stage_copy['location_name'] = get_location_name(stage.get('location_id'))
+    return stage_copy
+
+def substage_with_stage(substage):
+    """Sub-etapa con el nombre de su etapa (como la devuelve la API)"""
+    substage_copy = substage.copy()
+    stage = get_stage_by_id(substage.get('stage_id'))
+    substage_copy['stage_name'] = stage['name'] if stage else 'Desconocida'
+    return substage_copy
 
 def is_location_available_for_stage(location_id, exclude_stage_id=None):
     """Verifica si una locación está disponible para asignar a una etapa"""
@@ -138,9 +313,9 @@ def is_substage_available_for_stage(substage_id, exclude_stage_id=None):
     if not substage_id:
         return True
     
-    for substage in substages:
-        if substage['id'] == substage_id and substage.get('stage_id') != exclude_stage_id:
-            return False
+    substage = substages.get(substage_id)
+    if substage and substage.get('stage_id') != exclude_stage_id:
+        return False
     return True
 
 def get_available_locations_for_stage(exclude_stage_id=None):
@@ -159,32 +334,154 @@ def get_available_substages_for_stage(exclude_stage_id=None):
             available.append(substage)
     return available
 
-def update_product_stock(product_id, quantity_used):
-    """Actualiza el stock de un producto"""
-    product = get_product_by_id(product_id)
-    if product and product.get('has_stock', True):
-        product['current_stock'] -= quantity_used
-        if product['current_stock'] < 0:
-            product['current_stock'] = 0
+def apply_stock(stock):
+    """Guarda el stock proyectado ``{product_id: estado}`` de los productos que cambiaron.
 
-def add_product_stock(product_id, quantity_added):
-    """Agrega stock a un producto"""
-    product = get_product_by_id(product_id)
-    if product and product.get('has_stock', True):
-        product['current_stock'] += quantity_added
+    Cada estado tiene ``current_stock`` y ``location_stock`` (ver ``stock.py``).
+    """
+    for product_id, state in stock.items():
+        product = get_product_by_id(product_id)
+        changes = {}
+        if product['current_stock'] != state['current_stock']:
+            changes['current_stock'] = state['current_stock']
+        if product.get('location_stock', {}) != state['location_stock']:
+            changes['location_stock'] = state['location_stock']
+        if changes:
+            products.update(product_id, changes)
+
+@app.before_request
+def sync_store():
+    """Incorpora los cambios hechos por otros workers antes de cada request"""
+    store.sync()
+
+class SerializedResponses:
+    """Respuestas JSON ya serializadas: ruta -> (ETag, bytes).
+
+    El ETag es la versión de las colecciones que lee el endpoint, así que
+    cualquier escritura (de este worker o de otro, vía ``store.sync``) hace
+    que el siguiente pedido la vuelva a serializar; mientras tanto se envían
+    los mismos bytes sin llamar a la vista.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, etag):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == etag:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, etag, data):
+        with self._lock:
+            self._entries[key] = (etag, data)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else None
+            }
+
+serialized_responses = SerializedResponses()
+
+def versioned(*names, cache=False):
+    """GET condicional según la versión de las colecciones ``names``.
+
+    La respuesta lleva un ETag con esas versiones; si el cliente envía el
+    mismo ETag en ``If-None-Match`` se responde 304 sin construir ni
+    serializar nada. Con ``cache=True`` (listados que cambian poco) los
+    bytes de la respuesta se guardan y se reutilizan mientras no cambie la
+    versión.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            etag = store.etag(names)
+            if request.if_none_match.contains_weak(etag):
+                response = app.response_class(status=304)
+            else:
+                data = serialized_responses.get(request.full_path, etag) if cache else None
+                if data is not None:
+                    response = app.response_class(data, mimetype='application/json')
+                elif cache:
+                    # Versión y datos del mismo momento: los bytes guardados corresponden al ETag
+                    with store.lock:
+                        etag = store.etag(names)
+                        response = app.make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    serialized_responses.put(request.full_path, etag, response.get_data())
+                else:
+                    response = app.make_response(view(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+def if_match(collection):
+    """PUT condicional según la ``version`` de la entidad.
+
+    Si el cliente envía ``If-Match`` con una versión que ya no es la actual
+    se responde 412 sin escribir nada. La comprobación y la escritura
+    ocurren dentro de la misma ``store.write()``: ningún otro hilo ni worker
+    puede escribir entre ambas. La respuesta lleva como ETag la versión
+    resultante.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            (row_id,) = kwargs.values()
+            with store.write():
+                row = collection.get(row_id)
+                if row is not None and request.if_match and not request.if_match.contains(str(row['version'])):
+                    return jsonify({
+                        "error": "El registro fue modificado por otro usuario; recargue e intente de nuevo",
+                        "current": row
+                    }), 412
+                response = app.make_response(view(**kwargs))
+                row = collection.get(row_id)
+                if response.status_code == 200 and row is not None:
+                    response.set_etag(str(row['version']))
+            return response
+        return wrapper
+    return decorator
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+# Productos con stock en cada locación (claves de ``location_stock``)
+products_by_location = HashIndex(products, lambda p: (p.get('location_stock') or {}).keys())
+# Productos bajo el stock mínimo y eventos de cambio de estado
+low_stock = LowStockIndex(products, stock_alerts)
+
 # Endpoints para productos
 @app.route('/api/productos', methods=['GET'])
+@versioned('products')
 def get_products():
-    return jsonify(products)
+    return jsonify(products.all())
 
 @app.route('/api/productos', methods=['POST'])
 def create_product():
-    global next_product_id
     try:
         data = request.get_json()
         
@@ -198,7 +495,7 @@ def create_product():
         has_stock = data.get('has_stock', True)
         
         new_product = {
-            "id": next_product_id,
+            "id": products.allocate_id(),
             "name": data['name'],
             "unit": data['unit'],
             "initial_stock": float(data.get('initial_stock', 0)) if has_stock else 0,
@@ -210,14 +507,14 @@ def create_product():
             "created_at": datetime.now().isoformat()
         }
         
-        products.append(new_product)
-        next_product_id += 1
+        products.insert(new_product)
         
         return jsonify(new_product), 201
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/productos/<int:product_id>', methods=['PUT'])
+@if_match(products)
 def update_product(product_id):
     try:
         data = request.get_json()
@@ -233,56 +530,131 @@ def update_product(product_id):
         has_stock = data.get('has_stock', product.get('has_stock', True))
         
         # Actualizar campos
+        changes = {}
         if 'name' in data:
-            product['name'] = data['name']
+            changes['name'] = data['name']
         if 'unit' in data:
-            product['unit'] = data['unit']
+            changes['unit'] = data['unit']
         if 'price' in data:
-            product['price'] = float(data['price'])
+            changes['price'] = float(data['price'])
         if 'responsible' in data:
-            product['responsible'] = data['responsible']
+            changes['responsible'] = data['responsible']
         
-        product['has_stock'] = has_stock
+        changes['has_stock'] = has_stock
         
         if has_stock:
             if 'initial_stock' in data:
-                product['initial_stock'] = float(data['initial_stock'])
+                changes['initial_stock'] = float(data['initial_stock'])
             if 'current_stock' in data:
-                product['current_stock'] = float(data['current_stock'])
+                changes['current_stock'] = float(data['current_stock'])
             if 'min_stock' in data:
-                product['min_stock'] = float(data['min_stock'])
+                changes['min_stock'] = float(data['min_stock'])
         else:
             # Para variables sin stock, usar current_stock como valor actual
             if 'current_value' in data:
-                product['current_stock'] = float(data['current_value'])
-            product['initial_stock'] = 0
-            product['min_stock'] = 0
-        
+                changes['current_stock'] = float(data['current_value'])
+            changes['initial_stock'] = 0
+            changes['min_stock'] = 0
+        
+        # Las locaciones no pueden sumar más que el stock total
+        state = stock_balances.stock_state(dict(product, **changes))
+        if not has_stock:
+            state['location_stock'] = {}
+        stock_balances.fit(state)
+        if state['location_stock'] != product.get('location_stock', {}):
+            changes['location_stock'] = state['location_stock']
+        
+        product = products.update(product_id, changes)
         return jsonify(product)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/productos/<int:product_id>/stock', methods=['GET'])
+@versioned('products', 'locations')
+def get_product_stock(product_id):
+    """Stock de un producto en cada locación y sin asignar"""
+    product = get_product_by_id(product_id)
+    if not product:
+        return jsonify({"error": "Producto no encontrado"}), 404
+
+    state = stock_balances.stock_state(product)
+    return jsonify({
+        "product_id": product_id,
+        "product_name": product['name'],
+        "unit": product['unit'],
+        "current_stock": product['current_stock'],
+        "unassigned": stock_balances.unassigned(state),
+        "locations": [
+            {"location_id": int(key), "location_name": get_location_name(int(key)), "quantity": quantity}
+            for key, quantity in sorted(state['location_stock'].items(), key=lambda item: int(item[0]))
+        ]
+    })
+
+@app.route('/api/stock', methods=['GET'])
+@versioned('products', 'movements')
+def get_stock_as_of():
+    """Stock de los productos a una fecha: ?fecha=2024-01-31&product_id=1,2
+
+    Con solo la fecha se toma el cierre de ese día; también acepta una hora
+    ISO (``2024-01-31T12:00:00``) y cuenta los movimientos hasta ese instante.
+    """
+    try:
+        date = request.args.get('fecha')
+        if not date:
+            return jsonify({"error": "El parámetro fecha es obligatorio (YYYY-MM-DD)"}), 400
+        try:
+            bound = period_of(date).micros
+        except ValueError:
+            return jsonify({"error": "La fecha debe tener formato YYYY-MM-DD"}), 400
+        bound += DAY_MICROS if 'T' not in date else 1
+
+        if request.args.get('product_id'):
+            try:
+                product_ids = [int(value) for value in request.args['product_id'].split(',')]
+            except ValueError:
+                return jsonify({"error": "product_id debe ser una lista de enteros"}), 400
+            selected = [product for product in map(get_product_by_id, product_ids) if product]
+        else:
+            selected = products.all()
+
+        result = []
+        # El stock actual y los movimientos deben leerse en el mismo estado
+        with store.lock:
+            for product in selected:
+                if not product.get('has_stock', True):
+                    continue
+                stock = product['current_stock'] - stock_history.change_after(product['id'], bound)
+                result.append({
+                    "product_id": product['id'],
+                    "product_name": product['name'],
+                    "unit": product['unit'],
+                    "stock": round(stock, 6),
+                    "current_stock": product['current_stock']
+                })
+        return jsonify({"date": date, "products": result})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/productos/<int:product_id>', methods=['DELETE'])
 def delete_product(product_id):
-    global products
     try:
         product = get_product_by_id(product_id)
         if not product:
             return jsonify({"error": "Producto no encontrado"}), 404
         
-        products = [p for p in products if p['id'] != product_id]
+        products.delete(product_id)
         return jsonify({"message": "Producto eliminado correctamente"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Endpoints para locaciones
 @app.route('/api/locaciones', methods=['GET'])
+@versioned('locations', cache=True)
 def get_locations():
-    return jsonify(locations)
+    return jsonify(locations.all())
 
 @app.route('/api/locaciones', methods=['POST'])
 def create_location():
-    global next_location_id
     try:
         data = request.get_json()
         
@@ -290,45 +662,46 @@ def create_location():
             return jsonify({"error": "Nombre es obligatorio"}), 400
         
         new_location = {
-            "id": next_location_id,
+            "id": locations.allocate_id(),
             "name": data['name'],
             "description": data.get('description', ''),
             "responsible": data.get('responsible', ''),
             "created_at": datetime.now().isoformat()
         }
         
-        locations.append(new_location)
-        next_location_id += 1
+        locations.insert(new_location)
         
         return jsonify(new_location), 201
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/locaciones/<int:location_id>', methods=['PUT'])
+@if_match(locations)
 def update_location(location_id):
     try:
         data = request.get_json()
-        location = next((loc for loc in locations if loc["id"] == location_id), None)
+        location = get_location_by_id(location_id)
         
         if not location:
             return jsonify({"error": "Locación no encontrada"}), 404
         
+        changes = {}
         if 'name' in data:
-            location['name'] = data['name']
+            changes['name'] = data['name']
         if 'description' in data:
-            location['description'] = data['description']
+            changes['description'] = data['description']
         if 'responsible' in data:
-            location['responsible'] = data['responsible']
+            changes['responsible'] = data['responsible']
         
+        location = locations.update(location_id, changes)
         return jsonify(location)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/locaciones/<int:location_id>', methods=['DELETE'])
 def delete_location(location_id):
-    global locations
     try:
-        location = next((loc for loc in locations if loc["id"] == location_id), None)
+        location = get_location_by_id(location_id)
         if not location:
             return jsonify({"error": "Locación no encontrada"}), 404
         
@@ -337,24 +710,46 @@ def delete_location(location_id):
         if associated_stages:
             return jsonify({"error": "No se puede eliminar la locación porque tiene etapas asociadas"}), 400
         
-        locations = [loc for loc in locations if loc['id'] != location_id]
+        with store.write():
+            # Su stock vuelve a quedar sin asignar
+            key = stock_balances.location_key(location_id)
+            for product_id in list(products_by_location.lookup(key)):
+                state = stock_balances.stock_state(get_product_by_id(product_id))
+                stock_balances.drop_location(state, key)
+                products.update(product_id, {'location_stock': state['location_stock']})
+            locations.delete(location_id)
         return jsonify({"message": "Locación eliminada correctamente"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/locaciones/<int:location_id>/stock', methods=['GET'])
+@versioned('products', 'locations')
+def get_location_stock(location_id):
+    """Productos con stock en una locación"""
+    location = get_location_by_id(location_id)
+    if not location:
+        return jsonify({"error": "Locación no encontrada"}), 404
+
+    key = stock_balances.location_key(location_id)
+    with store.lock:
+        items = [{
+            "product_id": product['id'],
+            "product_name": product['name'],
+            "unit": product['unit'],
+            "quantity": product['location_stock'][key]
+        } for product in map(products.get, products_by_location.lookup(key))]
+    items.sort(key=lambda item: item['product_name'])
+
+    return jsonify({"location_id": location_id, "location_name": location['name'], "products": items})
+
 # Endpoints para etapas
 @app.route('/api/etapas', methods=['GET'])
+@versioned('stages', 'locations', cache=True)
 def get_stages():
-    stages_with_location = []
-    for stage in stages:
-        stage_copy = stage.copy()
-        stage_copy['location_name'] = get_location_name(stage.get('location_id'))
-        stages_with_location.append(stage_copy)
-    return jsonify(stages_with_location)
+    return jsonify([stage_with_location(stage) for stage in stages])
 
 @app.route('/api/etapas', methods=['POST'])
 def create_stage():
-    global next_stage_id
     try:
         data = request.get_json()
         
@@ -365,12 +760,12 @@ def create_stage():
         # Solo validamos que la locación existe
         location_id = data.get('location_id')
         if location_id:
-            location = next((loc for loc in locations if loc["id"] == location_id), None)
+            location = get_location_by_id(location_id)
             if not location:
                 return jsonify({"error": "Locación no encontrada"}), 404
         
         new_stage = {
-            "id": next_stage_id,
+            "id": stages.allocate_id(),
             "name": data['name'],
             "description": data.get('description', ''),
             "location_id": location_id,
@@ -385,14 +780,14 @@ def create_stage():
             "is_completed": False  # Nuevo campo para marcar etapas completadas
         }
         
-        stages.append(new_stage)
-        next_stage_id += 1
+        stages.insert(new_stage)
         
         return jsonify(new_stage), 201
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/etapas/<int:stage_id>', methods=['PUT'])
+@if_match(stages)
 def update_stage(stage_id):
     try:
         data = request.get_json()
@@ -415,24 +810,25 @@ def update_stage(stage_id):
             if location_id and not is_location_available_for_stage(location_id, stage_id):
                 return jsonify({"error": "La locación seleccionada ya está asignada a otra etapa"}), 400
         
+        changes = {}
         if 'name' in data:
-            stage['name'] = data['name']
+            changes['name'] = data['name']
         if 'description' in data:
-            stage['description'] = data['description']
+            changes['description'] = data['description']
         if 'location_id' in data:
-            stage['location_id'] = data['location_id']
+            changes['location_id'] = data['location_id']
         if 'expected_duration' in data:
-            stage['expected_duration'] = int(data['expected_duration'])
+            changes['expected_duration'] = int(data['expected_duration'])
         if 'responsible' in data:
-            stage['responsible'] = data['responsible']
+            changes['responsible'] = data['responsible']
         
+        stage = stages.update(stage_id, changes)
         return jsonify(stage)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/etapas/<int:stage_id>', methods=['DELETE'])
 def delete_stage(stage_id):
-    global stages
     try:
         stage = get_stage_by_id(stage_id)
         if not stage:
@@ -443,7 +839,7 @@ def delete_stage(stage_id):
         if associated_substages:
             return jsonify({"error": "No se puede eliminar la etapa porque tiene sub-etapas asociadas"}), 400
         
-        stages = [s for s in stages if s['id'] != stage_id]
+        stages.delete(stage_id)
         return jsonify({"message": "Etapa eliminada correctamente"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -458,8 +854,10 @@ def start_stage(stage_id):
         if stage['status'] != 'pending':
             return jsonify({"error": "La etapa ya ha sido iniciada"}), 400
         
-        stage['status'] = 'in_progress'
-        stage['start_time'] = datetime.now().isoformat()
+        stage = stages.update(stage_id, {
+            'status': 'in_progress',
+            'start_time': datetime.now().isoformat()
+        })
         
         return jsonify(stage)
     except Exception as e:
@@ -475,32 +873,29 @@ def finish_stage(stage_id):
         if stage['status'] != 'in_progress':
             return jsonify({"error": "La etapa no está en progreso"}), 400
         
-        stage['status'] = 'completed'
-        stage['end_time'] = datetime.now().isoformat()
+        changes = {
+            'status': 'completed',
+            'end_time': datetime.now().isoformat()
+        }
         
         if stage['start_time']:
             start_date = datetime.fromisoformat(stage['start_time'])
-            end_date = datetime.fromisoformat(stage['end_time'])
-            stage['actual_duration'] = (end_date - start_date).days
+            end_date = datetime.fromisoformat(changes['end_time'])
+            changes['actual_duration'] = (end_date - start_date).days
         
+        stage = stages.update(stage_id, changes)
         return jsonify(stage)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Endpoints para sub-etapas
 @app.route('/api/sub-etapas', methods=['GET'])
+@versioned('substages', 'stages', cache=True)
 def get_substages():
-    substages_with_stage = []
-    for substage in substages:
-        substage_copy = substage.copy()
-        stage = get_stage_by_id(substage.get('stage_id'))
-        substage_copy['stage_name'] = stage['name'] if stage else 'Desconocida'
-        substages_with_stage.append(substage_copy)
-    return jsonify(substages_with_stage)
+    return jsonify([substage_with_stage(substage) for substage in substages])
 
 @app.route('/api/sub-etapas', methods=['POST'])
 def create_substage():
-    global next_substage_id
     try:
         data = request.get_json()
         
@@ -510,7 +905,7 @@ def create_substage():
         stage_id = int(data['stage_id'])
         
         # Verificar que la etapa existe
-        stage = next((s for s in stages if s["id"] == stage_id), None)
+        stage = get_stage_by_id(stage_id)
         if not stage:
             return jsonify({"error": "Etapa no encontrada"}), 404
         
@@ -520,7 +915,7 @@ def create_substage():
             return jsonify({"error": "La etapa ya tiene una subetapa activa. Finaliza la subetapa actual antes de crear una nueva."}), 400
         
         new_substage = {
-            "id": next_substage_id,
+            "id": substages.allocate_id(),
             "name": data['name'],
             "description": data.get('description', ''),
             "stage_id": stage_id,
@@ -533,14 +928,14 @@ def create_substage():
             "created_at": datetime.now().isoformat()
         }
         
-        substages.append(new_substage)
-        next_substage_id += 1
+        substages.insert(new_substage)
         
         return jsonify(new_substage), 201
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/sub-etapas/<int:substage_id>', methods=['PUT'])
+@if_match(substages)
 def update_substage(substage_id):
     try:
         data = request.get_json()
@@ -549,30 +944,31 @@ def update_substage(substage_id):
         if not substage:
             return jsonify({"error": "Sub-etapa no encontrada"}), 404
         
+        changes = {}
         if 'name' in data:
-            substage['name'] = data['name']
+            changes['name'] = data['name']
         if 'description' in data:
-            substage['description'] = data['description']
+            changes['description'] = data['description']
         if 'stage_id' in data:
-            substage['stage_id'] = int(data['stage_id'])
+            changes['stage_id'] = int(data['stage_id'])
         if 'expected_duration' in data:
-            substage['expected_duration'] = int(data['expected_duration'])
+            changes['expected_duration'] = int(data['expected_duration'])
         if 'responsible' in data:
-            substage['responsible'] = data['responsible']
+            changes['responsible'] = data['responsible']
         
+        substage = substages.update(substage_id, changes)
         return jsonify(substage)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/sub-etapas/<int:substage_id>', methods=['DELETE'])
 def delete_substage(substage_id):
-    global substages
     try:
         substage = get_substage_by_id(substage_id)
         if not substage:
             return jsonify({"error": "Sub-etapa no encontrada"}), 404
         
-        substages = [s for s in substages if s['id'] != substage_id]
+        substages.delete(substage_id)
         return jsonify({"message": "Sub-etapa eliminada correctamente"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -587,8 +983,10 @@ def start_substage(substage_id):
         if substage['status'] != 'pending':
             return jsonify({"error": "La sub-etapa ya ha sido iniciada"}), 400
         
-        substage['status'] = 'in_progress'
-        substage['start_time'] = datetime.now().isoformat()
+        substage = substages.update(substage_id, {
+            'status': 'in_progress',
+            'start_time': datetime.now().isoformat()
+        })
         
         return jsonify(substage)
     except Exception as e:
@@ -604,126 +1002,458 @@ def finish_substage(substage_id):
         if substage['status'] != 'in_progress':
             return jsonify({"error": "La sub-etapa no está en progreso"}), 400
         
-        substage['status'] = 'completed'
-        substage['end_time'] = datetime.now().isoformat()
+        changes = {
+            'status': 'completed',
+            'end_time': datetime.now().isoformat()
+        }
         
         if substage['start_time']:
             start_date = datetime.fromisoformat(substage['start_time'])
-            end_date = datetime.fromisoformat(substage['end_time'])
-            substage['actual_duration'] = (end_date - start_date).days
+            end_date = datetime.fromisoformat(changes['end_time'])
+            changes['actual_duration'] = (end_date - start_date).days
         
+        substage = substages.update(substage_id, changes)
         return jsonify(substage)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Endpoints para movimientos
-@app.route('/api/movimientos', methods=['GET'])
-def get_movements():
-    movements_with_details = []
-    for movement in movements:
+# Índices para filtrar y paginar sin recorrer todo el historial
+movement_indexes = {
+    'type': HashIndex(movements, lambda m: (m.get('type'),)),
+    'product_id': HashIndex(movements, lambda m: {p['product_id'] for p in m.get('products', [])}),
+    'stage_id': HashIndex(movements, lambda m: (m.get('stage_id'),)),
+    'substage_id': HashIndex(movements, lambda m: (m.get('substage_id'),)),
+    'location_id': HashIndex(movements, lambda m: (m.get('location_id'),)),
+    'responsible': HashIndex(movements, lambda m: (m.get('responsible'),)),
+}
+movements_by_date = SortedIndex(movements, lambda m: m['date'])
+movements_total_cost = RunningTotal(movements, 'cost')
+
+MOVEMENT_INT_FILTERS = ('product_id', 'stage_id', 'substage_id', 'location_id')
+MOVEMENT_FIELDS = ('id', 'version', 'date', 'type', 'products', 'stage_id', 'stage_name', 'substage_id',
+                   'substage_name', 'responsible', 'location', 'location_id', 'from_location_id',
+                   'to_location_id', 'observations', 'cost')
+MOVEMENTS_PAGE_SIZE = 50
+MOVEMENTS_MAX_PAGE_SIZE = 500
+
+def movement_filters(args):
+    """Filtros de movimientos de los parámetros de la URL.
+
+    Devuelve ``{nombre: valor}`` con los filtros por igualdad (los nombres de
+    ``movement_indexes``) más ``desde``/``hasta`` si se indicaron; lanza
+    ``ValueError`` si un ID no es entero.
+    """
+    filters = {}
+    for name in movement_indexes:
+        value = args.get(name)
+        if value is None or value == '':
+            continue
+        if name in MOVEMENT_INT_FILTERS:
+            try:
+                value = int(value)
+            except ValueError:
+                raise ValueError(f"{name} debe ser un número entero")
+        filters[name] = value
+    for name in ('desde', 'hasta'):
+        if args.get(name):
+            filters[name] = args[name]
+    return filters
+
+def find_movements(filters, before=None, limit=None):
+    """IDs de los movimientos que cumplen ``filters``, del más reciente al más antiguo"""
+    filters = dict(filters)
+    # Rango de fechas inclusivo; 'hasta' acepta un prefijo (ej. '2024-01-15')
+    lower = filters.pop('desde', None)
+    upper = filters.pop('hasta') + '\uffff' if 'hasta' in filters else None
+
+    # Filtros por igualdad: se intersectan los índices, del más chico al
+    # más grande; los conjuntos de los índices solo se leen con el lock
+    with store.lock:
+        matches = sorted((movement_indexes[name].lookup(value) for name, value in filters.items()), key=len)
+        candidates = None
+        for ids in matches:
+            candidates = ids if candidates is None else candidates & ids
+        return movements_by_date.descending(before=before, lower=lower, upper=upper,
+                                            candidates=candidates, limit=limit)
+
+def stored_movements(filters, before=None):
+    """Movimientos que cumplen ``filters`` leídos de la base, del más reciente al más antiguo.
+
+    No carga la colección: usa las tablas indexadas del backend. Cada fila se
+    vuelve a comprobar con las claves de ``movement_indexes`` para filtrar
+    exactamente igual que en memoria.
+    """
+    filters = dict(filters)
+    lower = filters.pop('desde', None)
+    upper = filters.pop('hasta') + '\uffff' if 'hasta' in filters else None
+    for movement in store.backend.movements_descending(filters, before=before, lower=lower, upper=upper):
+        if all(value in movement_indexes[name].keys(movement) for name, value in filters.items()):
+            movement.setdefault('version', 0)
+            yield movement
+
+def movements_page(filters, before=None, limit=None):
+    """Hasta ``limit`` movimientos que cumplen ``filters``, del más reciente al más antiguo.
+
+    Si la colección no está en memoria y el backend tiene los movimientos
+    indexados (SQLite) se leen de la base sin cargar todo el historial.
+    """
+    if movements.loaded or not store.backend.movement_queries:
+        return [movement for movement in map(movements.get, find_movements(filters, before=before, limit=limit))
+                if movement is not None]
+    page = []
+    for movement in stored_movements(filters, before=before):
+        if limit is not None and len(page) >= limit:
+            break
+        page.append(movement)
+    return page
+
+def movement_with_details(movement, fields=None):
+    """Movimiento con nombres de etapa, sub-etapa y productos.
+
+    ``fields`` limita la respuesta a esos campos; los nombres solo se
+    resuelven si se piden.
+    """
+    if fields is None:
         movement_copy = movement.copy()
-        
-        # Agregar nombres de etapa y sub-etapa
+    else:
+        movement_copy = {field: movement.get(field) for field in fields if field in movement}
+
+    # Agregar nombres de etapa y sub-etapa
+    if fields is None or 'stage_name' in fields:
         if movement.get('stage_id'):
             stage = get_stage_by_id(movement['stage_id'])
             movement_copy['stage_name'] = stage['name'] if stage else 'Desconocida'
         else:
             movement_copy['stage_name'] = None
-            
+
+    if fields is None or 'substage_name' in fields:
         if movement.get('substage_id'):
             substage = get_substage_by_id(movement['substage_id'])
             movement_copy['substage_name'] = substage['name'] if substage else 'Desconocida'
         else:
             movement_copy['substage_name'] = None
-        
-        # Agregar detalles de productos
+
+    # Agregar detalles de productos
+    if fields is None or 'products' in fields:
         products_with_names = []
         for product_movement in movement.get('products', []):
             product = get_product_by_id(product_movement['product_id'])
             product_detail = product_movement.copy()
             product_detail['product_name'] = product['name'] if product else 'Desconocido'
             products_with_names.append(product_detail)
-        
         movement_copy['products'] = products_with_names
-        movements_with_details.append(movement_copy)
-    
-    return jsonify(movements_with_details)
+
+    return movement_copy
+
+def encode_cursor(movement):
+    """Cursor opaco con la posición ``(fecha, id)`` de un movimiento"""
+    raw = json.dumps([movement['date'], movement['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_cursor(cursor):
+    date, movement_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    if not isinstance(date, str) or not isinstance(movement_id, int):
+        raise ValueError(cursor)
+    return date, movement_id
+
+@app.route('/api/movimientos', methods=['GET'])
+@versioned('movements', 'products', 'stages', 'substages')
+def get_movements():
+    try:
+        # Sin parámetros se mantiene la respuesta original: la lista completa
+        if not request.args:
+            return jsonify([movement_with_details(movement) for movement in movements])
+
+        args = request.args
+        try:
+            limit = int(args.get('limit', MOVEMENTS_PAGE_SIZE))
+        except ValueError:
+            return jsonify({"error": "limit debe ser un número entero"}), 400
+        if limit < 1 or limit > MOVEMENTS_MAX_PAGE_SIZE:
+            return jsonify({"error": f"limit debe estar entre 1 y {MOVEMENTS_MAX_PAGE_SIZE}"}), 400
+
+        before = None
+        if args.get('cursor'):
+            try:
+                before = decode_cursor(args['cursor'])
+            except (ValueError, TypeError):
+                return jsonify({"error": "Cursor inválido"}), 400
+
+        fields = None
+        if args.get('fields'):
+            fields = [field.strip() for field in args['fields'].split(',') if field.strip()]
+            unknown = [field for field in fields if field not in MOVEMENT_FIELDS]
+            if unknown:
+                return jsonify({"error": f"Campos desconocidos: {', '.join(unknown)}"}), 400
+
+        try:
+            filters = movement_filters(args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        page = movements_page(filters, before=before, limit=limit + 1)
+        has_more = len(page) > limit
+        page = page[:limit]
+
+        return jsonify({
+            "items": [movement_with_details(movement, fields) for movement in page],
+            "next_cursor": encode_cursor(page[-1]) if has_more else None,
+            "has_more": has_more
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+class MovementError(Exception):
+    """Movimiento inválido; ``status`` es el código HTTP de la respuesta"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def movement_location(location_id, required=False):
+    """Clave de stock de una locación de un movimiento (``None``: sin asignar).
+
+    Con ``required`` (transferencias) una locación inexistente es un error;
+    si no, se toma como stock sin asignar.
+    """
+    if not location_id:
+        return None
+    if get_location_by_id(location_id):
+        return stock_balances.location_key(location_id)
+    if required:
+        raise MovementError(f"Locación con ID {location_id} no encontrada", 404)
+    return None
+
+def prepare_movement(data, stock):
+    """Valida un movimiento y arma sus campos (sin ``id`` ni ``date``).
+
+    El stock se valida contra ``stock`` (estado proyectado por producto, que
+    se completa con el actual) y, si el movimiento es válido, se actualiza
+    con su efecto. Así un lote se valida completo antes de escribir nada.
+
+    Una compra suma en su locación y un uso descuenta de ella (ver
+    ``stock.remove``). Una transferencia mueve stock de
+    ``from_location_id`` a ``to_location_id`` (vacío: sin asignar) sin
+    cambiar el total del producto.
+    """
+    if not isinstance(data, dict) or not data.get('type') or not data.get('products') or not data.get('responsible'):
+        raise MovementError("Tipo, productos y responsable son obligatorios")
+
+    movement_type = data['type']
+    is_transfer = movement_type == 'transferencia'
+    if is_transfer:
+        from_location_id = data.get('from_location_id')
+        to_location_id = data.get('to_location_id', data.get('location_id'))
+        source = movement_location(from_location_id, required=True)
+        target = movement_location(to_location_id, required=True)
+        if source == target:
+            raise MovementError("Las locaciones de origen y destino deben ser distintas")
+        location_id = to_location_id
+    else:
+        location_id = data.get('location_id')
+        target = movement_location(location_id)
+
+    total_cost = 0
+    products_data = []
+    projected = {}
+
+    for position, product_data in enumerate(data['products']):
+        product_id = product_data['product_id']
+        try:
+            quantity = float(product_data['quantity'])
+        except (TypeError, ValueError):
+            quantity = math.nan
+        if not (math.isfinite(quantity) and quantity > 0):
+            raise MovementError(f"Cantidad inválida en el producto {position}: debe ser un número mayor que 0")
+
+        product = get_product_by_id(product_id)
+        if not product:
+            raise MovementError(f"Producto con ID {product_id} no encontrado", 404)
+
+        # Validar stock solo para productos que manejan stock
+        if product.get('has_stock', True):
+            state = projected.get(product_id)
+            if state is None:
+                state = projected[product_id] = stock_balances.copy_state(
+                    stock.get(product_id) or stock_balances.stock_state(product))
+            if is_transfer:
+                if stock_balances.available(state, source) < quantity:
+                    origin = get_location_name(from_location_id) if source else 'stock sin asignar'
+                    raise MovementError(f"Stock insuficiente para {product['name']} en {origin}")
+                stock_balances.transfer(state, source, target, quantity)
+            elif movement_type == 'uso':
+                if state['current_stock'] < quantity:
+                    raise MovementError(f"Stock insuficiente para {product['name']}")
+                stock_balances.remove(state, target, quantity)
+            elif movement_type == 'compra':
+                stock_balances.add(state, target, quantity)
+
+        products_data.append({
+            "product_id": product_id,
+            "quantity": quantity,
+            "unit": product['unit']
+        })
+
+        # Calcular costo
+        total_cost += quantity * product['price']
+
+    # Antes de escribir: un costo infinito o NaN no entra en los totales
+    if not math.isfinite(total_cost):
+        raise MovementError("El costo del movimiento no es un número válido")
+
+    # Obtener nombre de locación si se proporciona location_id
+    location_name = ''
+    if location_id:
+        location = get_location_by_id(location_id)
+        if location:
+            location_name = location['name']
+
+    stock.update(projected)
+    fields = {
+        "type": movement_type,
+        "products": products_data,
+        "stage_id": data.get('stage_id'),
+        "substage_id": data.get('substage_id'),
+        "responsible": data['responsible'],
+        "location": location_name,
+        "location_id": location_id,
+        "observations": data.get('observations', ''),
+        "cost": total_cost
+    }
+    if is_transfer:
+        fields['from_location_id'] = from_location_id or None
+        fields['to_location_id'] = to_location_id or None
+    return fields
+
+def relocate_movement(movement, location_id):
+    """Stock ``{product_id: estado}`` que resulta de cambiar la locación de un movimiento.
+
+    Equivale a revertirlo en la locación anterior y aplicarlo en la nueva,
+    sin cambiar el stock total: una compra se descuenta como un uso de la
+    anterior (hasta el stock que queda) y se suma en la nueva, un uso se
+    devuelve a la anterior y se descuenta de la nueva y una transferencia
+    cambia de destino.
+    """
+    is_transfer = movement['type'] == 'transferencia'
+    if is_transfer and 'from_location_id' not in movement:
+        # Anteriores al stock por locación: no movieron stock entre locaciones
+        return {}
+    source = movement_location(movement.get('location_id'))
+    target = movement_location(location_id, required=True)
+    if is_transfer:
+        if target is None:
+            raise MovementError("La transferencia necesita una locación de destino")
+        if target == movement_location(movement.get('from_location_id')):
+            raise MovementError("Las locaciones de origen y destino deben ser distintas")
+
+    stock = {}
+    if source == target:
+        return stock
+    for line in movement['products']:
+        product = get_product_by_id(line['product_id'])
+        if not product or not product.get('has_stock', True):
+            continue
+        state = stock.get(product['id'])
+        if state is None:
+            state = stock[product['id']] = stock_balances.stock_state(product)
+        quantity = line['quantity']
+        if movement['type'] == 'uso':
+            stock_balances.add(state, source, quantity)
+            stock_balances.remove(state, target, quantity)
+        elif movement['type'] == 'compra':
+            # Si parte de la compra ya se usó, solo se mueve lo que queda
+            moved = min(quantity, state['current_stock'])
+            if moved > stock_balances.EPSILON:
+                stock_balances.remove(state, source, moved)
+                stock_balances.add(state, target, moved)
+        else:
+            if stock_balances.available(state, source) < quantity - stock_balances.EPSILON:
+                origin = get_location_name(movement['location_id']) if source else 'stock sin asignar'
+                raise MovementError(f"Stock insuficiente para {product['name']} en {origin}")
+            stock_balances.transfer(state, source, target, quantity)
+    return stock
+
+def insert_movement(fields):
+    """Inserta un movimiento ya validado con ``prepare_movement``"""
+    return movements.insert({
+        "id": movements.allocate_id(),
+        "date": datetime.now().isoformat(),
+        **fields
+    })
 
 @app.route('/api/movimientos', methods=['POST'])
 def create_movement():
-    global next_movement_id
     try:
         data = request.get_json()
-        
-        if not data.get('type') or not data.get('products') or not data.get('responsible'):
-            return jsonify({"error": "Tipo, productos y responsable son obligatorios"}), 400
-        
-        total_cost = 0
-        products_data = []
-        
-        for product_data in data['products']:
-            product_id = product_data['product_id']
-            quantity = float(product_data['quantity'])
-            
-            product = get_product_by_id(product_id)
-            if not product:
-                return jsonify({"error": f"Producto con ID {product_id} no encontrado"}), 404
-            
-            # Validar stock solo para productos que manejan stock
-            if product.get('has_stock', True) and data['type'] in ['uso', 'transferencia']:
-                if product['current_stock'] < quantity:
-                    return jsonify({"error": f"Stock insuficiente para {product['name']}"}), 400
-            
-            product_movement = {
-                "product_id": product_id,
-                "quantity": quantity,
-                "unit": product['unit']
-            }
-            products_data.append(product_movement)
-            
-            # Calcular costo
-            cost = quantity * product['price']
-            total_cost += cost
-            
-            # Actualizar stock
-            if product.get('has_stock', True):
-                if data['type'] == 'compra':
-                    add_product_stock(product_id, quantity)
-                elif data['type'] in ['uso', 'transferencia']:
-                    update_product_stock(product_id, quantity)
-        
-        # Obtener nombre de locación si se proporciona location_id
-        location_name = ''
-        if data.get('location_id'):
-            location = get_location_by_id(data['location_id'])
-            if location:
-                location_name = location['name']
-        
-        new_movement = {
-            "id": next_movement_id,
-            "date": datetime.now().isoformat(),
-            "type": data['type'],
-            "products": products_data,
-            "stage_id": data.get('stage_id'),
-            "substage_id": data.get('substage_id'),
-            "responsible": data['responsible'],
-            "location": location_name,
-            "location_id": data.get('location_id'),
-            "observations": data.get('observations', ''),
-            "cost": total_cost
-        }
-        
-        movements.append(new_movement)
-        next_movement_id += 1
-        
+
+        # Validar y escribir en la misma transacción: el stock validado es
+        # el que se descuenta
+        with store.write():
+            stock = {}
+            fields = prepare_movement(data, stock)
+            apply_stock(stock)
+            new_movement = insert_movement(fields)
+
         return jsonify(new_movement), 201
+    except MovementError as e:
+        return jsonify({"error": str(e)}), e.status
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+MAX_BATCH_MOVEMENTS = 5000
+
+@app.route('/api/movimientos/batch', methods=['POST'])
+def create_movements_batch():
+    """Registra una lista de movimientos: se aplican todos o ninguno.
+
+    Cada movimiento se valida contra el stock que dejan los anteriores del
+    lote. Si alguno es inválido no se escribe nada y se devuelve el
+    resultado de cada uno.
+    """
+    try:
+        data = request.get_json()
+        items = data.get('movements') if isinstance(data, dict) else data
+        if not isinstance(items, list) or not items:
+            return jsonify({"error": "Se requiere una lista de movimientos"}), 400
+        if len(items) > MAX_BATCH_MOVEMENTS:
+            return jsonify({"error": f"Máximo {MAX_BATCH_MOVEMENTS} movimientos por lote"}), 400
+
+        with store.write():
+            stock = {}
+            prepared = []
+            results = []
+            for index, item in enumerate(items):
+                try:
+                    prepared.append(prepare_movement(item, stock))
+                    results.append({"index": index, "status": "ok"})
+                except MovementError as e:
+                    results.append({"index": index, "status": "error", "error": str(e)})
+                except KeyError as e:
+                    results.append({"index": index, "status": "error", "error": f"Falta el campo {e}"})
+                except (TypeError, ValueError) as e:
+                    results.append({"index": index, "status": "error", "error": f"Datos inválidos: {e}"})
+
+            failed = len(items) - len(prepared)
+            if failed:
+                return jsonify({
+                    "error": f"{failed} movimiento(s) inválido(s); no se registró ninguno",
+                    "results": results
+                }), 400
+
+            apply_stock(stock)
+            for result, fields in zip(results, prepared):
+                result['id'] = insert_movement(fields)['id']
+
+        return jsonify({"created": len(prepared), "results": results}), 201
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/movimientos/<int:movement_id>', methods=['PUT'])
+@if_match(movements)
 def update_movement(movement_id):
     try:
-        movement = next((m for m in movements if m["id"] == movement_id), None)
+        movement = movements.get(movement_id)
         if not movement:
             return jsonify({"error": "Movimiento no encontrado"}), 404
         
@@ -733,42 +1463,53 @@ def update_movement(movement_id):
             return jsonify({"error": "Responsable es obligatorio"}), 400
         
         # Actualizar campos básicos
+        changes = {}
         if 'stage_id' in data:
-            movement['stage_id'] = data['stage_id']
+            changes['stage_id'] = data['stage_id']
         if 'substage_id' in data:
-            movement['substage_id'] = data['substage_id']
+            changes['substage_id'] = data['substage_id']
         if 'responsible' in data:
-            movement['responsible'] = data['responsible']
+            changes['responsible'] = data['responsible']
         if 'observations' in data:
-            movement['observations'] = data['observations']
+            changes['observations'] = data['observations']
         
-        # Actualizar locación si se proporciona
+        # Actualizar locación si se proporciona: el stock del movimiento pasa
+        # de la locación anterior a la nueva
+        stock = {}
         if 'location_id' in data:
-            movement['location_id'] = data['location_id']
+            if (data['location_id'] or None) != movement.get('location_id'):
+                stock = relocate_movement(movement, data['location_id'])
+                if movement['type'] == 'transferencia' and 'from_location_id' in movement:
+                    changes['to_location_id'] = data['location_id']
+            changes['location_id'] = data['location_id']
             if data['location_id']:
                 location = get_location_by_id(data['location_id'])
                 if location:
-                    movement['location'] = location['name']
+                    changes['location'] = location['name']
         
+        apply_stock(stock)
+        movement = movements.update(movement_id, changes)
         return jsonify(movement)
+    except MovementError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/movimientos/<int:movement_id>', methods=['DELETE'])
 def delete_movement(movement_id):
-    global movements
     try:
-        movement = next((m for m in movements if m["id"] == movement_id), None)
+        movement = movements.get(movement_id)
         if not movement:
             return jsonify({"error": "Movimiento no encontrado"}), 404
         
-        movements = [m for m in movements if m['id'] != movement_id]
+        movements.delete(movement_id)
         return jsonify({"message": "Movimiento eliminado correctamente"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Endpoints para dashboard
 @app.route('/api/dashboard', methods=['GET'])
+@versioned('products', 'stages', 'locations', 'movements')
 def get_dashboard():
     try:
         # Calcular KPIs
@@ -776,21 +1517,10 @@ def get_dashboard():
         total_stages = len(stages)
         total_locations = len(locations)
         total_movements = len(movements)
-        total_cost = sum(movement['cost'] for movement in movements)
-        
-        # Alertas de stock bajo
-        low_stock_alerts = []
-        for product in products:
-            if product.get('has_stock', True):  # Solo para productos con stock
-                if product['current_stock'] <= product['min_stock']:
-                    status = 'crítico' if product['current_stock'] == 0 else 'bajo'
-                    low_stock_alerts.append({
-                        'product_name': product['name'],
-                        'current_stock': product['current_stock'],
-                        'min_stock': product['min_stock'],
-                        'unit': product['unit'],
-                        'status': status
-                    })
+        total_cost = movements_total_cost.value
+        
+        # Alertas de stock bajo (solo productos con stock)
+        low_stock_alerts = low_stock.alerts()
         
         return jsonify({
             'total_products': total_products,
@@ -803,444 +1533,341 @@ def get_dashboard():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-# Endpoints para gráficos (mantenidos del código original)
-@app.route('/api/graficos/consumo-producto', methods=['GET'])
-def get_consumption_by_product():
+ALERT_EVENTS_PAGE_SIZE = 100
+
+@app.route('/api/alertas/stock', methods=['GET'])
+@versioned('stock_alerts')
+def get_stock_alert_events():
+    """Cambios de estado del stock (normal, bajo, crítico) posteriores a ``after``"""
     try:
-        consumption = {}
-        for movement in movements:
-            if movement['type'] == 'uso':
-                for product_data in movement['products']:
-                    product = get_product_by_id(product_data['product_id'])
-                    if product:
-                        product_name = product['name']
-                        if product_name not in consumption:
-                            consumption[product_name] = 0
-                        consumption[product_name] += product_data['quantity']
-        return jsonify(consumption)
+        try:
+            after = int(request.args.get('after', 0))
+            limit = int(request.args.get('limit', ALERT_EVENTS_PAGE_SIZE))
+        except ValueError:
+            return jsonify({"error": "after y limit deben ser números enteros"}), 400
+        if limit < 1 or limit > ALERT_EVENTS_PAGE_SIZE:
+            return jsonify({"error": f"limit debe estar entre 1 y {ALERT_EVENTS_PAGE_SIZE}"}), 400
+
+        events = low_stock.events_after(after)
+        if request.args.get('responsible'):
+            events = [event for event in events if event['responsible'] == request.args['responsible']]
+        has_more = len(events) > limit
+        events = events[:limit]
+        return jsonify({
+            "items": events,
+            "last_id": events[-1]['id'] if events else after,
+            "has_more": has_more
+        })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/graficos/stock-productos', methods=['GET'])
-def get_stock_chart():
+# Endpoints para gráficos (mantenidos del código original)
+# Los agregados se mantienen en movement_rollups al crear/editar/eliminar
+# movimientos; aquí solo se traducen los IDs a los nombres actuales.
+# movement_ledger guarda las líneas de movimiento en columnas NumPy para
+# reconstruir los agregados y calcular resúmenes de forma vectorizada.
+# Las fechas se interpretan una sola vez al escribir (mes/año para los
+# agregados, inicio de etapas para los gráficos de tiempo).
+movement_timestamps = TimestampIndex(movements, 'date')
+stage_start_times = TimestampIndex(stages, 'start_time')
+substage_start_times = TimestampIndex(substages, 'start_time')
+movement_ledger = MovementLedger(movements, movement_timestamps)
+movement_rollups = MovementRollups(movements, movement_ledger, movement_timestamps)
+daily_series = DailySeries(movements, movement_ledger, movement_timestamps)
+# Cambios de stock por producto ordenados por fecha (stock a una fecha pasada)
+stock_history = stock_balances.StockHistory(movements, movement_timestamps, movement_ledger)
+
+def product_name_or_none(product_id):
+    product = get_product_by_id(product_id)
+    return product['name'] if product else None
+
+def substage_name_or_none(substage_id):
+    substage = get_substage_by_id(substage_id)
+    return substage['name'] if substage else None
+
+def location_name_or_default(location):
+    return 'Sin locación' if location is None else location
+
+def product_cost(product_id, quantity):
+    """Costo de una cantidad de producto al precio actual"""
+    return quantity * get_product_by_id(product_id)['price']
+
+def rollup_by_name(rollup_name, get_entity):
+    """Agrupa un contador por ID usando el nombre actual de cada entidad"""
+    result = {}
+    for entity_id, total in movement_rollups[rollup_name].items():
+        entity = get_entity(entity_id)
+        if entity:
+            result[entity['name']] = result.get(entity['name'], 0) + total
+    return result
+
+def nested_rollup(rollup_name, outer_name, inner_name, value=None):
+    """Convierte un contador de claves (externa, interna) en un dict anidado.
+
+    ``outer_name``/``inner_name`` traducen cada clave y devuelven ``None``
+    para descartarla; ``value(inner, total)`` transforma el total.
+    """
+    result = {}
+    for (outer, inner), total in movement_rollups[rollup_name].items():
+        outer_key = outer_name(outer)
+        if outer_key is None:
+            continue
+        group = result.setdefault(outer_key, {})
+        inner_key = inner_name(inner)
+        if inner_key is None:
+            continue
+        if value:
+            total = value(inner, total)
+        group[inner_key] = group.get(inner_key, 0) + total
+    return result
+
+# Registro de gráficos: nombre -> función que construye sus datos. Cada
+# gráfico se publica en /api/graficos/<nombre> y en /api/graficos/bundle.
+CHARTS = {}
+
+def chart(name):
+    """Registra un gráfico y su endpoint individual"""
+    def decorator(builder):
+        def view():
+            try:
+                return jsonify(builder())
+            except Exception as e:
+                return jsonify({"error": str(e)}), 500
+        app.add_url_rule(f'/api/graficos/{name}', builder.__name__, view, methods=['GET'])
+        CHARTS[name] = builder
+        return builder
+    return decorator
+
+@app.route('/api/graficos/bundle', methods=['GET'])
+def get_charts_bundle():
+    """Varios gráficos en una sola respuesta: ?graficos=consumo-producto,stock-productos"""
     try:
-        stock_data = []
-        for product in products:
-            if product.get('has_stock', True):  # Solo productos con stock
-                stock_data.append({
-                    'name': product['name'],
-                    'current_stock': product['current_stock'],
-                    'min_stock': product['min_stock'],
-                    'unit': product['unit']
-                })
-        return jsonify(stock_data)
+        names = [name for name in request.args.get('graficos', '').split(',') if name]
+        if not names:
+            names = list(CHARTS)
+        unknown = [name for name in names if name not in CHARTS]
+        if unknown:
+            return jsonify({"error": f"Gráficos desconocidos: {', '.join(unknown)}"}), 400
+        
+        return jsonify({name: CHARTS[name]() for name in names})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/graficos/consumo-locacion', methods=['GET'])
+@chart('consumo-producto')
+def get_consumption_by_product():
+    return rollup_by_name('qty_by_product', get_product_by_id)
+
+@chart('stock-productos')
+def get_stock_chart():
+    stock_data = []
+    for product in products:
+        if product.get('has_stock', True):  # Solo productos con stock
+            stock_data.append({
+                'name': product['name'],
+                'current_stock': product['current_stock'],
+                'min_stock': product['min_stock'],
+                'unit': product['unit']
+            })
+    return stock_data
+
+@chart('consumo-locacion')
 def get_consumption_by_location():
-    try:
-        consumption = {}
-        for movement in movements:
-            if movement['type'] == 'uso':
-                location = movement.get('location', 'Sin especificar')
-                if location not in consumption:
-                    consumption[location] = {}
-                
-                for product_data in movement['products']:
-                    product = get_product_by_id(product_data['product_id'])
-                    if product:
-                        product_name = product['name']
-                        if product_name not in consumption[location]:
-                            consumption[location][product_name] = 0
-                        consumption[location][product_name] += product_data['quantity']
-        return jsonify(consumption)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return nested_rollup(
+        'qty_by_location_product',
+        lambda location: 'Sin especificar' if location is None else location,
+        product_name_or_none
+    )
 
-@app.route('/api/graficos/gastos-etapa', methods=['GET'])
+@chart('gastos-etapa')
 def get_expenses_by_stage():
-    try:
-        expenses = {}
-        for movement in movements:
-            if movement.get('stage_id'):
-                stage = get_stage_by_id(movement['stage_id'])
-                if stage:
-                    stage_name = stage['name']
-                    if stage_name not in expenses:
-                        expenses[stage_name] = 0
-                    expenses[stage_name] += movement['cost']
-        return jsonify(expenses)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return rollup_by_name('all_cost_by_stage', get_stage_by_id)
 
-@app.route('/api/graficos/gastos-locacion', methods=['GET'])
+@chart('gastos-locacion')
 def get_expenses_by_location():
-    try:
-        expenses = {}
-        for movement in movements:
-            location = movement.get('location', 'Sin especificar')
-            if location not in expenses:
-                expenses[location] = 0
-            expenses[location] += movement['cost']
-        return jsonify(expenses)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    expenses = {}
+    for location, cost in movement_rollups['all_cost_by_location'].items():
+        location = 'Sin especificar' if location is None else location
+        expenses[location] = expenses.get(location, 0) + cost
+    return expenses
 
-@app.route('/api/graficos/tiempo-etapas', methods=['GET'])
+@chart('tiempo-etapas')
 def get_time_comparison_stages():
-    try:
-        time_data = []
-        for stage in stages:
-            actual_time = 0
-            if stage['status'] == 'completed' and stage.get('actual_duration'):
-                actual_time = stage['actual_duration']
-            elif stage['status'] == 'in_progress' and stage.get('start_time'):
-                start_date = datetime.fromisoformat(stage['start_time'])
-                actual_time = (datetime.now() - start_date).days
-            
-            time_data.append({
-                'name': stage['name'],
-                'expected': stage['expected_duration'],
-                'actual': actual_time
-            })
-        return jsonify(time_data)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    now = now_micros()
+    time_data = []
+    for stage in stages:
+        actual_time = 0
+        if stage['status'] == 'completed' and stage.get('actual_duration'):
+            actual_time = stage['actual_duration']
+        elif stage['status'] == 'in_progress' and stage.get('start_time'):
+            actual_time = elapsed_days(stage_start_times.period(stage), now)
+        
+        time_data.append({
+            'name': stage['name'],
+            'expected': stage['expected_duration'],
+            'actual': actual_time
+        })
+    return time_data
 
-@app.route('/api/graficos/tiempo-sub-etapas', methods=['GET'])
+@chart('tiempo-sub-etapas')
 def get_time_comparison_substages():
-    try:
-        time_data = []
-        for substage in substages:
-            actual_time = 0
-            if substage['status'] == 'completed' and substage.get('actual_duration'):
-                actual_time = substage['actual_duration']
-            elif substage['status'] == 'in_progress' and substage.get('start_time'):
-                start_date = datetime.fromisoformat(substage['start_time'])
-                actual_time = (datetime.now() - start_date).days
-            
-            time_data.append({
-                'name': substage['name'],
-                'expected': substage['expected_duration'],
-                'actual': actual_time
-            })
-        return jsonify(time_data)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    now = now_micros()
+    time_data = []
+    for substage in substages:
+        actual_time = 0
+        if substage['status'] == 'completed' and substage.get('actual_duration'):
+            actual_time = substage['actual_duration']
+        elif substage['status'] == 'in_progress' and substage.get('start_time'):
+            actual_time = elapsed_days(substage_start_times.period(substage), now)
+        
+        time_data.append({
+            'name': substage['name'],
+            'expected': substage['expected_duration'],
+            'actual': actual_time
+        })
+    return time_data
 
-@app.route('/api/graficos/tiempo-locacion', methods=['GET'])
+@chart('tiempo-locacion')
 def get_time_by_location():
-    try:
-        location_time = {}
-        for stage in stages:
-            if stage.get('location_id'):
-                location_name = get_location_name(stage['location_id'])
-                if location_name not in location_time:
-                    location_time[location_name] = {'expected': 0, 'actual': 0}
-                
-                location_time[location_name]['expected'] += stage['expected_duration']
-                
-                if stage['status'] == 'completed' and stage.get('actual_duration'):
-                    location_time[location_name]['actual'] += stage['actual_duration']
-                elif stage['status'] == 'in_progress' and stage.get('start_time'):
-                    start_date = datetime.fromisoformat(stage['start_time'])
-                    actual_time = (datetime.now() - start_date).days
-                    location_time[location_name]['actual'] += actual_time
-        
-        return jsonify(location_time)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    now = now_micros()
+    location_time = {}
+    for stage in stages:
+        if stage.get('location_id'):
+            location_name = get_location_name(stage['location_id'])
+            if location_name not in location_time:
+                location_time[location_name] = {'expected': 0, 'actual': 0}
+            
+            location_time[location_name]['expected'] += stage['expected_duration']
+            
+            if stage['status'] == 'completed' and stage.get('actual_duration'):
+                location_time[location_name]['actual'] += stage['actual_duration']
+            elif stage['status'] == 'in_progress' and stage.get('start_time'):
+                actual_time = elapsed_days(stage_start_times.period(stage), now)
+                location_time[location_name]['actual'] += actual_time
+    
+    return location_time
 
-@app.route('/api/graficos/consumo-sub-etapas', methods=['GET'])
+@chart('consumo-sub-etapas')
 def get_consumption_by_substage():
-    try:
-        substage_consumption = {}
-        for movement in movements:
-            if movement['type'] == 'uso' and movement.get('substage_id'):
-                substage = get_substage_by_id(movement['substage_id'])
-                if substage:
-                    substage_name = substage['name']
-                    if substage_name not in substage_consumption:
-                        substage_consumption[substage_name] = 0
-                    
-                    # Sumar el costo total del movimiento para esta sub-etapa
-                    substage_consumption[substage_name] += movement.get('cost', 0)
-        
-        return jsonify(substage_consumption)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    # Costo total de los movimientos de uso de cada sub-etapa
+    return rollup_by_name('cost_by_substage', get_substage_by_id)
 
 # ===== NUEVOS ENDPOINTS PARA GRÁFICOS AVANZADOS =====
 
-@app.route('/api/graficos/consumo-producto-subetapa', methods=['GET'])
+@chart('consumo-producto-subetapa')
 def get_consumption_by_product_substage():
     """Gráfico de consumo por producto por subetapa"""
-    try:
-        data = {}
-        for movement in movements:
-            if movement['type'] == 'uso' and movement.get('substage_id'):
-                substage = get_substage_by_id(movement['substage_id'])
-                if substage:
-                    substage_name = substage['name']
-                    if substage_name not in data:
-                        data[substage_name] = {}
-                    
-                    for product_usage in movement['products']:
-                        product = get_product_by_id(product_usage['product_id'])
-                        if product:
-                            product_name = product['name']
-                            if product_name not in data[substage_name]:
-                                data[substage_name][product_name] = 0
-                            data[substage_name][product_name] += product_usage['quantity']
-        
-        return jsonify(data)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return nested_rollup('qty_by_substage_product', substage_name_or_none, product_name_or_none)
 
-@app.route('/api/graficos/consumo-etapa', methods=['GET'])
+@chart('consumo-etapa')
 def get_consumption_by_stage():
     """Gráfico de consumo por etapa"""
-    try:
-        stage_consumption = {}
-        for movement in movements:
-            if movement['type'] == 'uso' and movement.get('stage_id'):
-                stage = get_stage_by_id(movement['stage_id'])
-                if stage:
-                    stage_name = stage['name']
-                    if stage_name not in stage_consumption:
-                        stage_consumption[stage_name] = 0
-                    stage_consumption[stage_name] += movement.get('cost', 0)
-        
-        return jsonify(stage_consumption)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return rollup_by_name('cost_by_stage', get_stage_by_id)
 
-@app.route('/api/graficos/gasto-subetapa', methods=['GET'])
+@chart('gasto-subetapa')
 def get_expense_by_substage():
     """Gráfico de gasto por subetapa"""
-    try:
-        substage_expenses = {}
-        for movement in movements:
-            if movement.get('substage_id'):
-                substage = get_substage_by_id(movement['substage_id'])
-                if substage:
-                    substage_name = substage['name']
-                    if substage_name not in substage_expenses:
-                        substage_expenses[substage_name] = 0
-                    substage_expenses[substage_name] += movement.get('cost', 0)
-        
-        return jsonify(substage_expenses)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return rollup_by_name('all_cost_by_substage', get_substage_by_id)
 
-@app.route('/api/graficos/consumo-mensual-producto', methods=['GET'])
+@chart('consumo-mensual-producto')
 def get_monthly_consumption_by_product():
     """Gráfico de consumo mensual por producto"""
-    try:
-        from datetime import datetime
-        monthly_data = {}
-        
-        for movement in movements:
-            if movement['type'] == 'uso':
-                date = datetime.fromisoformat(movement['date'].replace('Z', '+00:00'))
-                month_key = date.strftime('%Y-%m')
-                
-                if month_key not in monthly_data:
-                    monthly_data[month_key] = {}
-                
-                for product_usage in movement['products']:
-                    product = get_product_by_id(product_usage['product_id'])
-                    if product:
-                        product_name = product['name']
-                        if product_name not in monthly_data[month_key]:
-                            monthly_data[month_key][product_name] = 0
-                        monthly_data[month_key][product_name] += product_usage['quantity']
-        
-        return jsonify(monthly_data)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return nested_rollup('qty_by_month_product', month_key, product_name_or_none)
 
-@app.route('/api/graficos/gasto-mensual-producto', methods=['GET'])
+@chart('gasto-mensual-producto')
 def get_monthly_expense_by_product():
     """Gráfico de gasto mensual por producto"""
-    try:
-        from datetime import datetime
-        monthly_data = {}
-        
-        for movement in movements:
-            date = datetime.fromisoformat(movement['date'].replace('Z', '+00:00'))
-            month_key = date.strftime('%Y-%m')
-            
-            if month_key not in monthly_data:
-                monthly_data[month_key] = {}
-            
-            for product_usage in movement['products']:
-                product = get_product_by_id(product_usage['product_id'])
-                if product:
-                    product_name = product['name']
-                    if product_name not in monthly_data[month_key]:
-                        monthly_data[month_key][product_name] = 0
-                    
-                    cost_per_unit = product['price']
-                    total_cost = product_usage['quantity'] * cost_per_unit
-                    monthly_data[month_key][product_name] += total_cost
-        
-        return jsonify(monthly_data)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return nested_rollup('all_qty_by_month_product', month_key, product_name_or_none, product_cost)
 
-@app.route('/api/graficos/consumo-anual-producto', methods=['GET'])
+@chart('consumo-anual-producto')
 def get_yearly_consumption_by_product():
     """Gráfico de consumo anual por producto"""
-    try:
-        from datetime import datetime
-        yearly_data = {}
-        
-        for movement in movements:
-            if movement['type'] == 'uso':
-                date = datetime.fromisoformat(movement['date'].replace('Z', '+00:00'))
-                year_key = str(date.year)
-                
-                if year_key not in yearly_data:
-                    yearly_data[year_key] = {}
-                
-                for product_usage in movement['products']:
-                    product = get_product_by_id(product_usage['product_id'])
-                    if product:
-                        product_name = product['name']
-                        if product_name not in yearly_data[year_key]:
-                            yearly_data[year_key][product_name] = 0
-                        yearly_data[year_key][product_name] += product_usage['quantity']
-        
-        return jsonify(yearly_data)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return nested_rollup('qty_by_year_product', str, product_name_or_none)
 
-@app.route('/api/graficos/gasto-anual-producto', methods=['GET'])
+@chart('gasto-anual-producto')
 def get_yearly_expense_by_product():
     """Gráfico de gasto anual por producto"""
-    try:
-        from datetime import datetime
-        yearly_data = {}
-        
-        for movement in movements:
-            date = datetime.fromisoformat(movement['date'].replace('Z', '+00:00'))
-            year_key = str(date.year)
-            
-            if year_key not in yearly_data:
-                yearly_data[year_key] = {}
-            
-            for product_usage in movement['products']:
-                product = get_product_by_id(product_usage['product_id'])
-                if product:
-                    product_name = product['name']
-                    if product_name not in yearly_data[year_key]:
-                        yearly_data[year_key][product_name] = 0
-                    
-                    cost_per_unit = product['price']
-                    total_cost = product_usage['quantity'] * cost_per_unit
-                    yearly_data[year_key][product_name] += total_cost
-        
-        return jsonify(yearly_data)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return nested_rollup('all_qty_by_year_product', str, product_name_or_none, product_cost)
 
-@app.route('/api/graficos/consumo-mensual-locacion', methods=['GET'])
+@chart('consumo-mensual-locacion')
 def get_monthly_consumption_by_location():
     """Gráfico de consumo mensual por locación"""
-    try:
-        from datetime import datetime
-        monthly_data = {}
-        
-        for movement in movements:
-            if movement['type'] == 'uso':
-                date = datetime.fromisoformat(movement['date'].replace('Z', '+00:00'))
-                month_key = date.strftime('%Y-%m')
-                location_name = movement.get('location', 'Sin locación')
-                
-                if month_key not in monthly_data:
-                    monthly_data[month_key] = {}
-                
-                if location_name not in monthly_data[month_key]:
-                    monthly_data[month_key][location_name] = 0
-                
-                monthly_data[month_key][location_name] += movement.get('cost', 0)
-        
-        return jsonify(monthly_data)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return nested_rollup('cost_by_month_location', month_key, location_name_or_default)
 
-@app.route('/api/graficos/gasto-mensual-locacion', methods=['GET'])
+@chart('gasto-mensual-locacion')
 def get_monthly_expense_by_location():
     """Gráfico de gasto mensual por locación"""
-    try:
-        from datetime import datetime
-        monthly_data = {}
-        
-        for movement in movements:
-            date = datetime.fromisoformat(movement['date'].replace('Z', '+00:00'))
-            month_key = date.strftime('%Y-%m')
-            location_name = movement.get('location', 'Sin locación')
-            
-            if month_key not in monthly_data:
-                monthly_data[month_key] = {}
-            
-            if location_name not in monthly_data[month_key]:
-                monthly_data[month_key][location_name] = 0
-            
-            monthly_data[month_key][location_name] += movement.get('cost', 0)
-        
-        return jsonify(monthly_data)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return nested_rollup('all_cost_by_month_location', month_key, location_name_or_default)
 
-@app.route('/api/graficos/consumo-anual-locacion', methods=['GET'])
+@chart('consumo-anual-locacion')
 def get_yearly_consumption_by_location():
     """Gráfico de consumo anual por locación"""
-    try:
-        from datetime import datetime
-        yearly_data = {}
-        
-        for movement in movements:
-            if movement['type'] == 'uso':
-                date = datetime.fromisoformat(movement['date'].replace('Z', '+00:00'))
-                year_key = str(date.year)
-                location_name = movement.get('location', 'Sin locación')
-                
-                if year_key not in yearly_data:
-                    yearly_data[year_key] = {}
-                
-                if location_name not in yearly_data[year_key]:
-                    yearly_data[year_key][location_name] = 0
-                
-                yearly_data[year_key][location_name] += movement.get('cost', 0)
-        
-        return jsonify(yearly_data)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return nested_rollup('cost_by_year_location', str, location_name_or_default)
 
-@app.route('/api/graficos/gasto-anual-locacion', methods=['GET'])
+@chart('gasto-anual-locacion')
 def get_yearly_expense_by_location():
     """Gráfico de gasto anual por locación"""
+    return nested_rollup('all_cost_by_year_location', str, location_name_or_default)
+
+# Serie de tiempo genérica sobre los totales diarios de daily_series
+SERIES_METRICS = ('quantity', 'cost')
+
+def series_name(dimension, key):
+    """Nombre actual de una clave de la serie (``None`` para descartarla)"""
+    if dimension == 'product':
+        return product_name_or_none(key)
+    if dimension == 'location':
+        return location_name_or_default(key)
+    if dimension == 'stage':
+        stage = get_stage_by_id(key)
+        return stage['name'] if stage else None
+    if dimension == 'substage':
+        return substage_name_or_none(key)
+    return key or 'Sin responsable'
+
+@app.route('/api/graficos/serie', methods=['GET'])
+def get_time_series():
+    """Serie por periodo: ?metric=cost&dimension=product&granularity=month&desde=2024-01-01&hasta=2024-12-31"""
     try:
-        from datetime import datetime
-        yearly_data = {}
-        
-        for movement in movements:
-            date = datetime.fromisoformat(movement['date'].replace('Z', '+00:00'))
-            year_key = str(date.year)
-            location_name = movement.get('location', 'Sin locación')
+        metric = request.args.get('metric', 'cost')
+        dimension = request.args.get('dimension', 'product')
+        granularity = request.args.get('granularity', 'month')
+        if metric not in SERIES_METRICS:
+            return jsonify({"error": f"metric debe ser uno de: {', '.join(SERIES_METRICS)}"}), 400
+        if dimension not in DailySeries.DIMENSIONS:
+            return jsonify({"error": f"dimension debe ser uno de: {', '.join(DailySeries.DIMENSIONS)}"}), 400
+        if granularity not in GRANULARITIES:
+            return jsonify({"error": f"granularity debe ser uno de: {', '.join(GRANULARITIES)}"}), 400
+        
+        try:
+            first_day = period_of(request.args['desde']).day if request.args.get('desde') else None
+            last_day = period_of(request.args['hasta']).day if request.args.get('hasta') else None
+        except ValueError:
+            return jsonify({"error": "Las fechas deben tener formato YYYY-MM-DD"}), 400
+        
+        labels = {}
+        names = {}
+        series = {}
+        for day, key, quantity, cost in daily_series.query(dimension, first_day, last_day,
+                                                           request.args.get('type') or None):
+            if key not in names:
+                names[key] = series_name(dimension, key)
+            name = names[key]
+            if name is None:
+                continue
+            if day not in labels:
+                labels[day] = bucket_label(day, granularity)
             
-            if year_key not in yearly_data:
-                yearly_data[year_key] = {}
+            if metric == 'quantity':
+                value = quantity
+            elif dimension == 'product':
+                value = product_cost(key, quantity)
+            else:
+                value = cost
             
-            if location_name not in yearly_data[year_key]:
-                yearly_data[year_key][location_name] = 0
-            
-            yearly_data[year_key][location_name] += movement.get('cost', 0)
+            bucket = series.setdefault(labels[day], {})
+            bucket[name] = bucket.get(name, 0) + value
         
-        return jsonify(yearly_data)
+        return jsonify(series)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -1249,13 +1876,15 @@ def get_yearly_expense_by_location():
 def complete_stage(stage_id):
     """Marcar etapa como completada"""
     try:
-        stage = next((s for s in stages if s["id"] == stage_id), None)
+        stage = get_stage_by_id(stage_id)
         if not stage:
             return jsonify({"error": "Etapa no encontrada"}), 404
         
-        stage['is_completed'] = True
-        stage['end_time'] = datetime.now().isoformat()
-        stage['status'] = 'completed'
+        stage = stages.update(stage_id, {
+            'is_completed': True,
+            'end_time': datetime.now().isoformat(),
+            'status': 'completed'
+        })
         
         return jsonify(stage)
     except Exception as e:
@@ -1266,16 +1895,16 @@ def restart_stage(stage_id):
     """Reiniciar etapa para nuevo ciclo"""
     try:
         data = request.get_json()
-        stage = next((s for s in stages if s["id"] == stage_id), None)
+        stage = get_stage_by_id(stage_id)
         if not stage:
             return jsonify({"error": "Etapa no encontrada"}), 404
         
         # Crear nueva etapa basada en la anterior
-        global next_stage_id
-        new_cycle_name = data.get('cycle_name', f"{stage['name']} - Ciclo {next_stage_id}")
+        new_stage_id = stages.allocate_id()
+        new_cycle_name = data.get('cycle_name', f"{stage['name']} - Ciclo {new_stage_id}")
         
         new_stage = {
-            "id": next_stage_id,
+            "id": new_stage_id,
             "name": stage['name'],
             "description": stage['description'],
             "location_id": stage['location_id'],
@@ -1291,8 +1920,7 @@ def restart_stage(stage_id):
             "parent_stage_id": stage_id  # Referencia a la etapa original
         }
         
-        stages.append(new_stage)
-        next_stage_id += 1
+        stages.insert(new_stage)
         
         return jsonify(new_stage), 201
     except Exception as e:
@@ -1302,7 +1930,7 @@ def restart_stage(stage_id):
 def get_stage_summary(stage_id):
     """Generar resumen de etapa completada"""
     try:
-        stage = next((s for s in stages if s["id"] == stage_id), None)
+        stage = get_stage_by_id(stage_id)
         if not stage:
             return jsonify({"error": "Etapa no encontrada"}), 404
         
@@ -1312,8 +1940,14 @@ def get_stage_summary(stage_id):
         # Obtener sub-etapas de esta etapa
         stage_substages = [s for s in substages if s['stage_id'] == stage_id]
         
-        # Obtener movimientos de esta etapa
-        stage_movements = [m for m in movements if m.get('stage_id') == stage_id]
+        # Consumo por (sub-etapa, producto) de los movimientos de esta etapa
+        quantities = movement_ledger.group_sum(
+            ('substage_id', 'product_id'), 'quantity',
+            line=True, stage_id=stage_id, substage_id=[s['id'] for s in stage_substages]
+        )
+        product_ids_by_substage = {}
+        for substage_id, product_id in quantities:
+            product_ids_by_substage.setdefault(substage_id, []).append(product_id)
         
         # Calcular consumo por producto en cada sub-etapa
         consumption_by_substage = {}
@@ -1324,26 +1958,24 @@ def get_stage_summary(stage_id):
             substage_name = substage['name']
             consumption_by_substage[substage_name] = {}
             
-            substage_movements = [m for m in stage_movements if m.get('substage_id') == substage['id']]
-            
-            for movement in substage_movements:
-                for product_usage in movement['products']:
-                    product = get_product_by_id(product_usage['product_id'])
-                    if product:
-                        product_name = product['name']
-                        if product_name not in consumption_by_substage[substage_name]:
-                            consumption_by_substage[substage_name][product_name] = {
-                                'quantity': 0,
-                                'unit': product['unit'],
-                                'cost': 0
-                            }
-                        
-                        consumption_by_substage[substage_name][product_name]['quantity'] += product_usage['quantity']
-                        cost = product_usage['quantity'] * product['price']
-                        consumption_by_substage[substage_name][product_name]['cost'] += cost
-                        
-                        total_quantity += product_usage['quantity']
-                        total_cost += cost
+            for product_id in product_ids_by_substage.get(substage['id'], []):
+                product = get_product_by_id(product_id)
+                if product:
+                    product_name = product['name']
+                    if product_name not in consumption_by_substage[substage_name]:
+                        consumption_by_substage[substage_name][product_name] = {
+                            'quantity': 0,
+                            'unit': product['unit'],
+                            'cost': 0
+                        }
+                    
+                    quantity = quantities[(substage['id'], product_id)][0]
+                    consumption_by_substage[substage_name][product_name]['quantity'] += quantity
+                    cost = quantity * product['price']
+                    consumption_by_substage[substage_name][product_name]['cost'] += cost
+                    
+                    total_quantity += quantity
+                    total_cost += cost
         
         summary = {
             "stage_id": stage_id,
@@ -1359,7 +1991,7 @@ def get_stage_summary(stage_id):
                 "total_quantity": total_quantity,
                 "total_cost": total_cost
             },
-            "generated_at": datetime.now().isoformat()
+            "generated_at": datetime.now()
         }
         
         return jsonify(summary)
@@ -1368,12 +2000,12 @@ def get_stage_summary(stage_id):
 
 # Endpoints para Post-it (mantenidos del código original)
 @app.route('/api/postits', methods=['GET'])
+@versioned('postits', cache=True)
 def get_postits():
-    return jsonify(postits)
+    return jsonify(postits.all())
 
 @app.route('/api/postits', methods=['POST'])
 def create_postit():
-    global next_postit_id
     try:
         data = request.get_json()
         
@@ -1381,7 +2013,7 @@ def create_postit():
             return jsonify({"error": "Título y contenido son obligatorios"}), 400
         
         new_postit = {
-            "id": next_postit_id,
+            "id": postits.allocate_id(),
             "title": data['title'],
             "content": data['content'],
             "color": data.get('color', '#ffeb3b'),
@@ -1389,202 +2021,300 @@ def create_postit():
             "updated_at": datetime.now().isoformat()
         }
         
-        postits.append(new_postit)
-        next_postit_id += 1
+        postits.insert(new_postit)
         
         return jsonify(new_postit), 201
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/postits/<int:postit_id>', methods=['PUT'])
+@if_match(postits)
 def update_postit(postit_id):
     try:
         data = request.get_json()
-        postit = next((p for p in postits if p["id"] == postit_id), None)
+        postit = postits.get(postit_id)
         
         if not postit:
             return jsonify({"error": "Post-it no encontrado"}), 404
         
+        changes = {}
         if 'title' in data:
-            postit['title'] = data['title']
+            changes['title'] = data['title']
         if 'content' in data:
-            postit['content'] = data['content']
+            changes['content'] = data['content']
         if 'color' in data:
-            postit['color'] = data['color']
+            changes['color'] = data['color']
         
-        postit['updated_at'] = datetime.now().isoformat()
+        changes['updated_at'] = datetime.now().isoformat()
         
+        postit = postits.update(postit_id, changes)
         return jsonify(postit)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/postits/<int:postit_id>', methods=['DELETE'])
 def delete_postit(postit_id):
-    global postits
     try:
-        postit = next((p for p in postits if p["id"] == postit_id), None)
+        postit = postits.get(postit_id)
         if not postit:
             return jsonify({"error": "Post-it no encontrado"}), 404
         
-        postits = [p for p in postits if p['id'] != postit_id]
+        postits.delete(postit_id)
         return jsonify({"message": "Post-it eliminado correctamente"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Endpoints para recetas (mantenidos del código original)
+
+# Recetas e imágenes que usan cada blob: el archivo se borra con la última
+blob_references = (
+    HashIndex(recipes, lambda r: (r.get('blob'),)),
+    HashIndex(recipe_images, lambda r: (r.get('blob'),))
+)
+
+def blob_url(digest, extension):
+    """Ruta pública de un blob; la extensión solo define el tipo de contenido"""
+    return f"uploads/blobs/{digest}.{extension}"
+
+# Extensiones que el navegador puede mostrar; el resto se descarga
+INLINE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+
+def blob_content_type(record):
+    """``(mimetype, descargar)`` de un archivo subido según la extensión registrada al subirlo"""
+    extension = ''
+    if record:
+        filename = record.get('filename', '')
+        extension = record.get('file_type') or (filename.rsplit('.', 1)[1] if '.' in filename else '')
+    extension = extension.lower()
+    if extension not in ALLOWED_EXTENSIONS:
+        return 'application/octet-stream', True
+    mimetype = mimetypes.guess_type(f'archivo.{extension}')[0] or 'application/octet-stream'
+    return mimetype, extension not in INLINE_EXTENSIONS
+
+def stored_file(record):
+    """Ruta en disco del archivo de una receta o imagen"""
+    if record.get('blob'):
+        return blob_store.path(record['blob'])
+    # Archivos subidos antes del almacenamiento por contenido
+    return record['file_path']
+
+def variant_key(image):
+    """Clave de las variantes de una imagen: su contenido (o su ruta, si es anterior a los blobs)"""
+    return image.get('blob') or hashlib.sha1(image['file_path'].encode('utf-8')).hexdigest()
+
+def received_upload(field):
+    """Archivo del campo ``field`` o de una subida por partes terminada (``upload_id``).
+
+    Devuelve ``(upload, nombre del archivo, upload_id)``; ``upload`` es
+    ``None`` si el request no trae ninguno.
+    """
+    upload_id = request.form.get('upload_id')
+    if upload_id:
+        chunked = chunked_uploads.get(upload_id)
+        if chunked is None:
+            raise ValueError("Subida no encontrada")
+        return chunked_uploads.complete(chunked), chunked['filename'], upload_id
+    file = request.files.get(field)
+    if file is None:
+        return None, None, None
+    return file.stream.upload(), file.filename, None
+
+def save_upload(collection, record, upload, upload_id=None):
+    """Guarda el archivo por contenido e inserta el registro que lo referencia.
+
+    Con el lock de escritura, para que un borrado en curso no elimine un
+    blob que se acaba de reutilizar.
+    """
+    with store.write():
+        created = blob_store.add(upload)
+        try:
+            collection.insert(record)
+        except Exception:
+            if created:
+                blob_store.remove(upload.digest)
+            raise
+    if upload_id:
+        chunked_uploads.discard(upload_id)
+
+def release_file(record):
+    """Borra el archivo de una receta o imagen eliminada si ya no lo usa otra"""
+    digest = record.get('blob')
+    if digest is None:
+        if os.path.exists(record['file_path']):
+            os.remove(record['file_path'])
+        variant_cache.discard(variant_key(record))
+    elif not any(index.lookup(digest) for index in blob_references):
+        blob_store.remove(digest)
+        variant_cache.discard(digest)
+
 @app.route('/api/recetas', methods=['GET'])
+@versioned('recipes', cache=True)
 def get_recipes():
-    return jsonify(recipes)
+    return jsonify(recipes.all())
 
 @app.route('/api/recetas/upload', methods=['POST'])
 def upload_recipe():
-    global next_recipe_id
     try:
-        if 'file' not in request.files:
+        upload, filename, upload_id = received_upload('file')
+        if upload is None:
             return jsonify({"error": "No se encontró archivo"}), 400
         
-        file = request.files['file']
         name = request.form.get('name', '')
         
-        if file.filename == '':
+        if filename == '':
             return jsonify({"error": "No se seleccionó archivo"}), 400
         
         if not name:
             return jsonify({"error": "Nombre es obligatorio"}), 400
         
-        if file and allowed_file(file.filename):
-            # Generar nombre único
-            file_extension = file.filename.rsplit('.', 1)[1].lower()
-            unique_filename = f"{uuid.uuid4()}.{file_extension}"
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'recipes', unique_filename)
-            
-            file.save(file_path)
-            
+        if allowed_file(filename):
+            file_extension = filename.rsplit('.', 1)[1].lower()
             new_recipe = {
-                "id": next_recipe_id,
+                "id": recipes.allocate_id(),
                 "name": name,
-                "filename": file.filename,
+                "filename": filename,
                 "file_type": file_extension,
-                "file_path": f"uploads/recipes/{unique_filename}",
+                "file_path": blob_url(upload.digest, file_extension),
+                "blob": upload.digest,
+                "size": upload.size,
                 "uploaded_at": datetime.now().isoformat()
             }
-            
-            recipes.append(new_recipe)
-            next_recipe_id += 1
+            save_upload(recipes, new_recipe, upload, upload_id)
             
             return jsonify(new_recipe), 201
         else:
             return jsonify({"error": "Tipo de archivo no permitido"}), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/recetas/<int:recipe_id>/download', methods=['GET'])
 def download_recipe(recipe_id):
     try:
-        recipe = next((r for r in recipes if r["id"] == recipe_id), None)
+        recipe = recipes.get(recipe_id)
         if not recipe:
             return jsonify({"error": "Receta no encontrada"}), 404
         
-        return send_file(recipe['file_path'], as_attachment=True, download_name=recipe['filename'])
+        return send_stored(stored_file(recipe), etag=recipe.get('blob') or True,
+                           as_attachment=True, download_name=recipe['filename'])
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/recetas/<int:recipe_id>', methods=['DELETE'])
 def delete_recipe(recipe_id):
-    global recipes
     try:
-        recipe = next((r for r in recipes if r["id"] == recipe_id), None)
+        recipe = recipes.get(recipe_id)
         if not recipe:
             return jsonify({"error": "Receta no encontrada"}), 404
         
-        # Eliminar archivo físico
-        if os.path.exists(recipe['file_path']):
-            os.remove(recipe['file_path'])
-        
-        recipes = [r for r in recipes if r['id'] != recipe_id]
+        with store.write():
+            recipes.delete(recipe_id)
+            release_file(recipe)
         return jsonify({"message": "Receta eliminada correctamente"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 # Endpoints para imágenes de recetas
 @app.route('/api/recetas/imagenes', methods=['GET'])
+@versioned('recipe_images', cache=True)
 def get_recipe_images():
-    return jsonify(recipe_images)
+    return jsonify(recipe_images.all())
 
 @app.route('/api/recetas/imagenes/upload', methods=['POST'])
 def upload_recipe_image():
-    global next_recipe_image_id
     try:
-        if 'image' not in request.files:
+        upload, filename, upload_id = received_upload('image')
+        if upload is None:
             return jsonify({"error": "No se encontró imagen"}), 400
         
-        file = request.files['image']
         title = request.form.get('title', '')
         comment = request.form.get('comment', '')
         
-        if file.filename == '':
+        if filename == '':
             return jsonify({"error": "No se seleccionó imagen"}), 400
         
         if not title:
             return jsonify({"error": "Título es obligatorio"}), 400
         
-        if file and allowed_file(file.filename):
-            # Generar nombre único
-            file_extension = file.filename.rsplit('.', 1)[1].lower()
-            unique_filename = f"{uuid.uuid4()}.{file_extension}"
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], 'images', unique_filename)
-            
-            file.save(file_path)
-            
+        if allowed_file(filename):
+            file_extension = filename.rsplit('.', 1)[1].lower()
             new_image = {
-                "id": next_recipe_image_id,
+                "id": recipe_images.allocate_id(),
                 "title": title,
-                "filename": file.filename,
-                "file_path": f"uploads/images/{unique_filename}",
+                "filename": filename,
+                "file_path": blob_url(upload.digest, file_extension),
+                "blob": upload.digest,
+                "size": upload.size,
                 "comment": comment,
                 "uploaded_at": datetime.now().isoformat()
             }
-            
-            recipe_images.append(new_image)
-            next_recipe_image_id += 1
+            save_upload(recipe_images, new_image, upload, upload_id)
+            variant_cache.prefetch(stored_file(new_image), variant_key(new_image))
             
             return jsonify(new_image), 201
         else:
             return jsonify({"error": "Tipo de archivo no permitido"}), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/recetas/imagenes/<int:image_id>/<variant>', methods=['GET'])
+def get_image_variant(image_id, variant):
+    """Miniatura o versión web de una imagen (el original si no se puede reducir)"""
+    try:
+        image = recipe_images.get(image_id)
+        if not image:
+            return jsonify({"error": "Imagen no encontrada"}), 404
+        if variant not in VARIANTS:
+            return jsonify({"error": f"Variante no válida ({', '.join(VARIANTS)})"}), 404
+        source = stored_file(image)
+        if not os.path.exists(source):
+            return jsonify({"error": "Archivo no encontrado"}), 404
+        key = variant_key(image)
+        # Con ``v=<clave>`` la URL identifica el contenido y no cambia
+        immutable = request.args.get('v') == key
+        path = variant_cache.get(source, key, variant)
+        if path is None:
+            mimetype, as_attachment = blob_content_type(image)
+            return send_stored(source, etag=key, immutable=immutable, mimetype=mimetype,
+                               as_attachment=as_attachment, download_name=image['filename'])
+        return send_stored(path, etag=f'{key}-{variant}', immutable=immutable, mimetype='image/jpeg')
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/recetas/imagenes/<int:image_id>', methods=['PUT'])
+@if_match(recipe_images)
 def update_recipe_image(image_id):
     try:
         data = request.get_json()
-        image = next((img for img in recipe_images if img["id"] == image_id), None)
+        image = recipe_images.get(image_id)
         
         if not image:
             return jsonify({"error": "Imagen no encontrada"}), 404
         
+        changes = {}
         if 'title' in data:
-            image['title'] = data['title']
+            changes['title'] = data['title']
         if 'comment' in data:
-            image['comment'] = data['comment']
+            changes['comment'] = data['comment']
         
+        image = recipe_images.update(image_id, changes)
         return jsonify(image)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/recetas/imagenes/<int:image_id>', methods=['DELETE'])
 def delete_recipe_image(image_id):
-    global recipe_images
     try:
-        image = next((img for img in recipe_images if img["id"] == image_id), None)
+        image = recipe_images.get(image_id)
         if not image:
             return jsonify({"error": "Imagen no encontrada"}), 404
         
-        # Eliminar archivo físico
-        if os.path.exists(image['file_path']):
-            os.remove(image['file_path'])
-        
-        recipe_images = [img for img in recipe_images if img['id'] != image_id]
+        with store.write():
+            recipe_images.delete(image_id)
+            release_file(image)
         return jsonify({"message": "Imagen eliminada correctamente"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1592,12 +2322,12 @@ def delete_recipe_image(image_id):
 # ===== ENDPOINTS PARA RESPONSABLES =====
 
 @app.route('/api/responsables', methods=['GET'])
+@versioned('location_responsibles', cache=True)
 def get_responsibles():
-    return jsonify(location_responsibles)
+    return jsonify(location_responsibles.all())
 
 @app.route('/api/responsables', methods=['POST'])
 def create_responsible():
-    global next_responsible_id, location_responsibles
     try:
         data = request.get_json()
         
@@ -1606,130 +2336,584 @@ def create_responsible():
             return jsonify({"error": "Nombre y locación son requeridos"}), 400
         
         # Verificar que la locación existe
-        location = next((loc for loc in locations if loc["id"] == data['location_id']), None)
+        location = get_location_by_id(data['location_id'])
         if not location:
             return jsonify({"error": "Locación no encontrada"}), 404
         
         # Colores disponibles para responsables
         colors = ["#4caf50", "#2196f3", "#ff9800", "#9c27b0", "#f44336", "#00bcd4", "#795548", "#607d8b"]
         
+        responsible_id = location_responsibles.allocate_id()
         new_responsible = {
-            "id": next_responsible_id,
+            "id": responsible_id,
             "name": data['name'],
             "role": data.get('role', 'Responsable'),
             "location_id": data['location_id'],
-            "color": data.get('color', colors[next_responsible_id % len(colors)]),
+            "color": data.get('color', colors[responsible_id % len(colors)]),
             "created_at": datetime.now().isoformat()
         }
         
-        location_responsibles.append(new_responsible)
-        next_responsible_id += 1
+        location_responsibles.insert(new_responsible)
         
         return jsonify(new_responsible), 201
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/responsables/<int:responsible_id>', methods=['PUT'])
+@if_match(location_responsibles)
 def update_responsible(responsible_id):
-    global location_responsibles
     try:
         data = request.get_json()
-        responsible = next((resp for resp in location_responsibles if resp["id"] == responsible_id), None)
+        responsible = location_responsibles.get(responsible_id)
         
         if not responsible:
             return jsonify({"error": "Responsable no encontrado"}), 404
         
         # Actualizar campos
+        changes = {}
         if 'name' in data:
-            responsible['name'] = data['name']
+            changes['name'] = data['name']
         if 'role' in data:
-            responsible['role'] = data['role']
+            changes['role'] = data['role']
         if 'color' in data:
-            responsible['color'] = data['color']
+            changes['color'] = data['color']
         if 'location_id' in data:
             # Verificar que la nueva locación existe
-            location = next((loc for loc in locations if loc["id"] == data['location_id']), None)
+            location = get_location_by_id(data['location_id'])
             if not location:
                 return jsonify({"error": "Locación no encontrada"}), 404
-            responsible['location_id'] = data['location_id']
+            changes['location_id'] = data['location_id']
         
+        responsible = location_responsibles.update(responsible_id, changes)
         return jsonify(responsible)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/responsables/<int:responsible_id>', methods=['DELETE'])
 def delete_responsible(responsible_id):
-    global location_responsibles
     try:
-        responsible = next((resp for resp in location_responsibles if resp["id"] == responsible_id), None)
+        responsible = location_responsibles.get(responsible_id)
         if not responsible:
             return jsonify({"error": "Responsable no encontrado"}), 404
         
-        location_responsibles = [resp for resp in location_responsibles if resp['id'] != responsible_id]
+        location_responsibles.delete(responsible_id)
         return jsonify({"message": "Responsable eliminado correctamente"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/responsables/locacion/<int:location_id>', methods=['GET'])
+@versioned('location_responsibles')
 def get_responsibles_by_location(location_id):
     responsibles = [resp for resp in location_responsibles if resp['location_id'] == location_id]
     return jsonify(responsibles)
 
+# Estado del almacenamiento (backend, tamaño, tiempo de recuperación)
+@app.route('/api/sistema/cache', methods=['GET'])
+def get_cache_stats():
+    """Aciertos y fallos de los cachés de respuestas, compresión y miniaturas"""
+    try:
+        return jsonify({
+            'respuestas': serialized_responses.stats(),
+            'compresion': compression_cache.stats(),
+            'miniaturas': variant_cache.stats()
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/sistema/almacenamiento', methods=['GET'])
+def get_storage_stats():
+    try:
+        return jsonify(store.backend.stats())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 # Servir imágenes estáticas
 @app.route('/uploads/images/<filename>')
 def uploaded_image(filename):
-    return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], 'images'), filename)
+    path = safe_join(os.path.join(app.config['UPLOAD_FOLDER'], 'images'), filename)
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": "Archivo no encontrado"}), 404
+    return send_stored(path)
+
+@app.route('/uploads/blobs/<name>')
+def uploaded_blob(name):
+    try:
+        path = blob_store.path(name.split('.', 1)[0])
+    except ValueError:
+        return jsonify({"error": "Archivo no encontrado"}), 404
+    if not os.path.exists(path):
+        return jsonify({"error": "Archivo no encontrado"}), 404
+    # El tipo sale del registro que usa el blob, no de la extensión de la URL
+    digest = name.split('.', 1)[0]
+    with store.lock:
+        record = next((index.collection.get(row_id) for index in blob_references
+                       for row_id in index.lookup(digest)), None)
+    mimetype, as_attachment = blob_content_type(record)
+    download_name = record['filename'] if record else digest
+    return send_stored(path, etag=digest, immutable=True, mimetype=mimetype,
+                       as_attachment=as_attachment, download_name=download_name)
+
+# Subidas por partes: POST crea la subida, cada PUT agrega una parte desde
+# ``offset`` y, al completarla, el formulario de recetas o imágenes la usa
+# con ``upload_id`` en lugar del archivo
+@app.route('/api/subidas', methods=['POST'])
+def start_upload():
+    try:
+        data = request.get_json() or {}
+        filename = data.get('filename')
+        size = data.get('size')
+        if not filename or not isinstance(size, int):
+            return jsonify({"error": "filename y size son obligatorios"}), 400
+        if not allowed_file(filename):
+            return jsonify({"error": "Tipo de archivo no permitido"}), 400
+        upload = chunked_uploads.start(filename, size)
+        return jsonify(upload), 201, {'Location': f"/api/subidas/{upload['id']}"}
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/subidas/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    upload = chunked_uploads.get(upload_id)
+    if upload is None:
+        return jsonify({"error": "Subida no encontrada"}), 404
+    return jsonify(upload)
+
+@app.route('/api/subidas/<upload_id>', methods=['PUT'])
+def upload_part(upload_id):
+    try:
+        upload = chunked_uploads.get(upload_id)
+        if upload is None:
+            return jsonify({"error": "Subida no encontrada"}), 404
+        offset = request.args.get('offset', type=int)
+        if offset is None:
+            return jsonify({"error": "offset es obligatorio"}), 400
+        upload['offset'] = chunked_uploads.append(upload, offset, request.stream)
+        return jsonify(upload)
+    except UploadOffsetError as e:
+        # El cliente sigue desde donde quedó el archivo
+        return jsonify({"error": str(e), "offset": e.offset}), 409
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/subidas/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    if chunked_uploads.get(upload_id) is None:
+        return jsonify({"error": "Subida no encontrada"}), 404
+    chunked_uploads.discard(upload_id)
+    return jsonify({"message": "Subida cancelada"})
+
+# Exportación: hojas disponibles (clave -> título, colección, columnas)
+EXPORT_SHEETS = {
+    'productos': ('Productos', products, (
+        'id', 'name', 'unit', 'initial_stock', 'current_stock', 'min_stock', 'price', 'has_stock',
+        'responsible', 'created_at', 'version', 'location_stock')),
+    'locaciones': ('Locaciones', locations, ('id', 'name', 'description', 'responsible', 'created_at', 'version')),
+    'etapas': ('Etapas', stages, (
+        'id', 'name', 'duration', 'description', 'location_id', 'expected_duration', 'start_time', 'end_time',
+        'actual_duration', 'status', 'responsible', 'created_at', 'version', 'cycle_name', 'is_completed',
+        'parent_stage_id')),
+    'sub-etapas': ('Sub-etapas', substages, (
+        'id', 'name', 'duration', 'description', 'stage_id', 'expected_duration', 'start_time', 'end_time',
+        'actual_duration', 'status', 'responsible', 'created_at', 'version')),
+    'movimientos': ('Movimientos', movements, (
+        'id', 'date', 'type', 'products', 'stage_id', 'substage_id', 'responsible', 'location', 'observations',
+        'cost', 'version', 'location_id', 'from_location_id', 'to_location_id')),
+    'postits': ('Post-it', postits, ('id', 'title', 'content', 'color', 'created_at', 'updated_at', 'version')),
+    'recetas': ('Recetas', recipes, (
+        'id', 'name', 'filename', 'file_type', 'file_path', 'blob', 'size', 'uploaded_at', 'version')),
+    'imagenes': ('Imagenes', recipe_images, (
+        'id', 'title', 'filename', 'file_path', 'blob', 'size', 'comment', 'uploaded_at', 'version')),
+}
+# Filas que se copian por vez (con ``store.lock``) al exportar
+EXPORT_CHUNK_SIZE = 500
+
+def export_ids(sheet, filters):
+    """IDs de las filas de una hoja con los filtros aplicados.
+
+    Los movimientos se filtran con sus índices (fechas, locación, etapa,
+    etc.) y salen en orden de ID; las etapas por ``location_id`` y
+    ``stage_id``; las sub-etapas por ``stage_id``. Sin filtros las filas
+    salen en orden de inserción.
+    """
+    collection = EXPORT_SHEETS[sheet][1]
+    if sheet == 'movimientos' and filters:
+        return sorted(find_movements(filters))
+    if sheet == 'etapas' and ('location_id' in filters or 'stage_id' in filters):
+        return [stage['id'] for stage in collection
+                if ('location_id' not in filters or stage.get('location_id') == filters['location_id'])
+                and ('stage_id' not in filters or stage['id'] == filters['stage_id'])]
+    if sheet == 'sub-etapas' and 'stage_id' in filters:
+        return [substage['id'] for substage in collection if substage.get('stage_id') == filters['stage_id']]
+    return collection.ids()
+
+def export_rows(sheet, filters):
+    """Filas de una hoja, leídas a medida que se recorren.
+
+    Al empezar solo se toman los IDs; las filas se copian de a
+    ``EXPORT_CHUNK_SIZE`` con ``store.lock`` (se modifican en el lugar), así
+    que en memoria hay un bloque por vez y las escrituras esperan solo lo
+    que tarda copiarlo. Las filas borradas mientras tanto se omiten.
+    """
+    collection = EXPORT_SHEETS[sheet][1]
+    ids = export_ids(sheet, filters)
+    for start in range(0, len(ids), EXPORT_CHUNK_SIZE):
+        with store.lock:
+            chunk = [dict(row) for row in map(collection.get, ids[start:start + EXPORT_CHUNK_SIZE])
+                     if row is not None]
+        yield from chunk
+
+EXPORT_MIMETYPES = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+    'json': 'application/json'
+}
+
+def export_name(extension):
+    return f'inventario_cultivo_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{extension}'
+
+def export_params(args, multiple):
+    """Hojas y filtros de una exportación (``ValueError`` si son inválidos).
+
+    Excel acepta varias hojas en ``hojas`` (todas por defecto); CSV una sola
+    en ``hoja`` (movimientos por defecto).
+    """
+    if multiple:
+        sheets = [sheet.strip() for sheet in str(args.get('hojas', ','.join(EXPORT_SHEETS))).split(',')
+                  if sheet.strip()]
+        if not sheets or any(sheet not in EXPORT_SHEETS for sheet in sheets):
+            raise ValueError(f"hojas debe ser una lista de: {', '.join(EXPORT_SHEETS)}")
+    else:
+        sheets = [args.get('hoja', 'movimientos')]
+        if sheets[0] not in EXPORT_SHEETS:
+            raise ValueError(f"hoja debe ser una de: {', '.join(EXPORT_SHEETS)}")
+    return sheets, movement_filters(args)
+
+def export_data(sheets, filters):
+    """``[(título, columnas, filas)]`` de las hojas pedidas; las filas se leen al recorrerlas"""
+    return [(EXPORT_SHEETS[sheet][0], EXPORT_SHEETS[sheet][2], export_rows(sheet, filters)) for sheet in sheets]
 
 # Endpoint para exportar a Excel
 @app.route('/api/exportar-excel', methods=['GET'])
 def export_excel():
+    """Excel con las hojas de ``hojas`` (todas por defecto) y los filtros de movimientos"""
     try:
-        output = io.BytesIO()
-        
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            # Productos
-            products_df = pd.DataFrame(products)
-            products_df.to_excel(writer, sheet_name='Productos', index=False)
-            
-            # Locaciones
-            locations_df = pd.DataFrame(locations)
-            locations_df.to_excel(writer, sheet_name='Locaciones', index=False)
-            
-            # Etapas
-            stages_df = pd.DataFrame(stages)
-            stages_df.to_excel(writer, sheet_name='Etapas', index=False)
-            
-            # Sub-etapas
-            substages_df = pd.DataFrame(substages)
-            substages_df.to_excel(writer, sheet_name='Sub-etapas', index=False)
-            
-            # Movimientos
-            movements_df = pd.DataFrame(movements)
-            movements_df.to_excel(writer, sheet_name='Movimientos', index=False)
-            
-            # Post-it
-            postits_df = pd.DataFrame(postits)
-            postits_df.to_excel(writer, sheet_name='Post-it', index=False)
-            
-            # Recetas
-            recipes_df = pd.DataFrame(recipes)
-            recipes_df.to_excel(writer, sheet_name='Recetas', index=False)
-            
-            # Imágenes
-            images_df = pd.DataFrame(recipe_images)
-            images_df.to_excel(writer, sheet_name='Imagenes', index=False)
-        
+        try:
+            sheets, filters = export_params(request.args, multiple=True)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        # El libro se escribe a un archivo temporal y se envía desde el disco
+        output = tempfile.TemporaryFile()
+        exports.write_xlsx(export_data(sheets, filters), output)
         output.seek(0)
-        
+
         return send_file(
             output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            mimetype=EXPORT_MIMETYPES['xlsx'],
             as_attachment=True,
-            download_name=f'inventario_cultivo_{datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+            download_name=export_name('xlsx')
         )
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/exportar-csv', methods=['GET'])
+def export_csv():
+    """CSV de una hoja (``hoja``, movimientos por defecto), enviado a medida que se genera"""
+    try:
+        try:
+            sheets, filters = export_params(request.args, multiple=False)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        ((_, columns, rows),) = export_data(sheets, filters)
+        response = app.response_class(exports.iter_csv(columns, rows), mimetype=EXPORT_MIMETYPES['csv'])
+        response.headers['Content-Disposition'] = f'attachment; filename={export_name("csv")}'
+        return response
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Importación: hojas que se pueden importar, en orden de dependencias
+IMPORT_SHEETS = ('locaciones', 'productos', 'etapas', 'sub-etapas', 'movimientos')
+MAX_IMPORT_ERRORS = 100
+
+@app.route('/api/importar', methods=['POST'])
+def import_data():
+    """Importa un Excel con el formato de la exportación (o un CSV de una hoja): todo o nada"""
+    try:
+        if 'file' not in request.files:
+            return jsonify({"error": "No se encontró archivo"}), 400
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({"error": "No se seleccionó archivo"}), 400
+        if file.filename.rsplit('.', 1)[-1].lower() not in ('xlsx', 'csv'):
+            return jsonify({"error": "El archivo debe ser .xlsx o .csv"}), 400
+        sheet = request.form.get('hoja') or request.args.get('hoja', 'movimientos')
+        if sheet not in IMPORT_SHEETS:
+            return jsonify({"error": f"hoja debe ser una de: {', '.join(IMPORT_SHEETS)}"}), 400
+
+        titles = {key: EXPORT_SHEETS[key][0] for key in IMPORT_SHEETS}
+        try:
+            read = imports.read_file(file.stream, file.filename, titles[sheet])
+        except Exception as e:
+            return jsonify({"error": f"No se pudo leer el archivo: {e}"}), 400
+        keys = {title: key for key, title in titles.items()}
+        frames = {keys[title]: frame for title, frame in read.items() if title in keys}
+        if not frames:
+            return jsonify({"error": f"El archivo no tiene hojas para importar ({', '.join(titles.values())})"}), 400
+
+        importer = imports.Importer({key: EXPORT_SHEETS[key][1] for key in IMPORT_SHEETS}, titles, AVAILABLE_UNITS)
+        with store.write():
+            summary = importer.run(frames)
+            apply_stock(importer.stock)
+        summary['stock_updated'] = len(importer.stock)
+        return jsonify(summary), 201
+    except imports.ImportFileError as e:
+        return jsonify({
+            "error": str(e),
+            "errors": e.errors[:MAX_IMPORT_ERRORS],
+            "total_errors": len(e.errors)
+        }), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Trabajos en segundo plano: exportaciones y reportes que se generan en un
+# pool de hilos y se descargan cuando terminan
+job_queue = JobQueue(
+    app.config['JOBS_FOLDER'],
+    workers=app.config['JOB_WORKERS'],
+    max_age=app.config['JOBS_MAX_AGE'],
+    max_bytes=app.config['JOBS_MAX_BYTES'],
+    max_pending=app.config['JOBS_MAX_PENDING']
+)
+
+def job_key(kind, params, names):
+    """Clave del archivo de un trabajo: parámetros y versión de las colecciones que lee"""
+    payload = json.dumps([kind, params, store.etag(names)], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+# Veces que se escribe un archivo de exportación si los datos cambian mientras tanto
+EXPORT_ATTEMPTS = 3
+
+def consistent_export(names, write):
+    """Ejecuta ``write()`` hasta que lo escrito corresponda a una sola versión.
+
+    Las filas se leen mientras se escribe el archivo, sin copiar nada al
+    encolar. Si al terminar las colecciones ``names`` tienen otra versión que
+    al empezar, el archivo podría mezclar dos versiones y se vuelve a
+    escribir (hasta ``EXPORT_ATTEMPTS`` veces).
+    """
+    for _ in range(EXPORT_ATTEMPTS):
+        with store.lock:
+            # Cargadas antes de tomar la versión: es la que ven las filas
+            for name in names:
+                len(store.collections[name])
+            version = store.etag(names)
+        write()
+        if store.etag(names) == version:
+            return
+    raise RuntimeError("Los datos cambiaron durante la exportación; vuelva a intentarlo")
+
+def excel_job(params):
+    sheets, filters = export_params(params, multiple=True)
+    names = [EXPORT_SHEETS[sheet][1].name for sheet in sheets]
+    # La clave tiene la versión al encolar; las filas se leen en el trabajo
+    key = job_key('excel', [sheets, filters], names)
+
+    def build(path):
+        def write():
+            with open(path, 'wb') as output:
+                exports.write_xlsx(export_data(sheets, filters), output)
+        consistent_export(names, write)
+    return key, build
+
+def csv_job(params):
+    sheets, filters = export_params(params, multiple=False)
+    names = [EXPORT_SHEETS[sheets[0]][1].name]
+    key = job_key('csv', [sheets, filters], names)
+
+    def build(path):
+        def write():
+            ((_, columns, rows),) = export_data(sheets, filters)
+            with open(path, 'w', encoding='utf-8', newline='') as output:
+                for chunk in exports.iter_csv(columns, rows):
+                    output.write(chunk)
+        consistent_export(names, write)
+    return key, build
+
+def charts_job(params):
+    names = [name for name in str(params.get('graficos', '')).split(',') if name] or list(CHARTS)
+    unknown = [name for name in names if name not in CHARTS]
+    if unknown:
+        raise ValueError(f"Gráficos desconocidos: {', '.join(unknown)}")
+    # Los datos se calculan y serializan con la misma versión que la clave
+    with store.lock:
+        key = job_key('graficos', names, list(store.collections))
+        payload = app.json.dumps({name: CHARTS[name]() for name in names})
+
+    def build(path):
+        with open(path, 'w', encoding='utf-8') as output:
+            output.write(payload)
+    return key, build
+
+# Segundos que se sugiere esperar si la cola de trabajos está llena
+JOB_RETRY_AFTER = 30
+
+# tipo -> (extensión, función que valida los parámetros y devuelve clave y generador)
+JOB_KINDS = {
+    'excel': ('xlsx', excel_job),
+    'csv': ('csv', csv_job),
+    'graficos': ('json', charts_job)
+}
+
+@app.route('/api/trabajos', methods=['POST'])
+def create_job():
+    """Encola una exportación o reporte: {"tipo": "excel", "hojas": "...", "desde": "...", ...}"""
+    try:
+        data = request.get_json(silent=True) or {}
+        kind = data.get('tipo')
+        if kind not in JOB_KINDS:
+            return jsonify({"error": f"tipo debe ser uno de: {', '.join(JOB_KINDS)}"}), 400
+        extension, prepare = JOB_KINDS[kind]
+        try:
+            key, build = prepare(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        job = job_queue.submit(kind, key, extension, build, export_name(extension))
+        status = 200 if job['status'] == jobs.DONE else 202
+        return jsonify(job), status, {'Location': f'/api/trabajos/{job["id"]}'}
+    except jobs.QueueFull as e:
+        return jsonify({"error": str(e)}), 503, {'Retry-After': str(JOB_RETRY_AFTER)}
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/trabajos/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Trabajo no encontrado"}), 404
+    return jsonify(job)
+
+@app.route('/api/trabajos/<job_id>/archivo', methods=['GET'])
+def download_job(job_id):
+    try:
+        job = job_queue.get(job_id)
+        if job is None:
+            return jsonify({"error": "Trabajo no encontrado"}), 404
+        if job['status'] != jobs.DONE:
+            return jsonify({"error": "El trabajo no terminó", "status": job['status']}), 409
+        path = job_queue.artifact_path(job)
+        if not os.path.exists(path):
+            return jsonify({"error": "El archivo ya no está disponible; vuelva a generarlo"}), 410
+        extension = job['artifact'].rsplit('.', 1)[1]
+        return send_stored(path, etag=job['artifact'].rsplit('.', 1)[0], mimetype=EXPORT_MIMETYPES[extension],
+                           as_attachment=True, download_name=job['filename'])
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Cambios de las colecciones para los navegadores (Server-Sent Events): cada
+# cliente aplica los cambios sobre los datos que ya tiene en lugar de volver
+# a descargar las colecciones
+change_feed = ChangeFeed(store, {
+    'products': products,
+    'movements': movements,
+    'locations': locations,
+    'stages': stages,
+    'substages': substages,
+    'postits': postits,
+    'recipes': recipes,
+    'recipe_images': recipe_images,
+    'location_responsibles': location_responsibles,
+    'stock_alerts': stock_alerts
+}, render={
+    'movements': movement_with_details,
+    'stages': stage_with_location,
+    'substages': substage_with_stage
+})
+
+# Cada stream ocupa un hilo del worker mientras está abierto (el Procfile
+# usa 32 y deja el resto para los demás pedidos); sin lugar, el cliente
+# consulta ``/api/eventos/pendientes`` cada tanto
+app.config['EVENTS_MAX_STREAMS'] = int(os.environ.get('EVENTS_MAX_STREAMS', 24))
+EVENTS_SYNC_INTERVAL = 1  # segundos entre lecturas de los cambios de otros workers
+EVENTS_HEARTBEAT = 15  # segundos sin enviar nada antes de un comentario de keep-alive
+EVENTS_MAX_DURATION = 5 * 60  # el stream se cierra y el navegador se reconecta solo
+EVENTS_RETRY = 3000  # milisegundos antes de reconectarse
+
+def sse_message(seq, data):
+    return f'id: {seq}\ndata: {app.json.dumps(data)}\n\n'
+
+def event_stream(changes, index, resumed):
+    """Mensajes del stream: lo pendiente desde ``Last-Event-ID`` y después cada cambio"""
+    yield f'retry: {EVENTS_RETRY}\n\n'
+    if changes is None:
+        # Conexión nueva (``ready``) o cambios que ya no están en memoria (``reload``)
+        yield sse_message(change_feed.last_seq, {'op': 'reload' if resumed else 'ready'})
+    else:
+        for change in changes:
+            yield sse_message(change.seq, change.data)
+    deadline = time.monotonic() + EVENTS_MAX_DURATION
+    last_message = time.monotonic()
+    while time.monotonic() < deadline:
+        store.sync()
+        changes, index = change_feed.wait(index, EVENTS_SYNC_INTERVAL)
+        if changes is None:
+            yield sse_message(change_feed.last_seq, {'op': 'reload'})
+            last_message = time.monotonic()
+        elif changes:
+            yield ''.join(sse_message(change.seq, change.data) for change in changes)
+            last_message = time.monotonic()
+        elif time.monotonic() - last_message >= EVENTS_HEARTBEAT:
+            yield ': keep-alive\n\n'
+            last_message = time.monotonic()
+
+@app.route('/api/eventos', methods=['GET'])
+def get_events():
+    """Stream de cambios: ``{entity, op, id, fields}`` por cada alta, edición o baja"""
+    if not change_feed.acquire(app.config['EVENTS_MAX_STREAMS']):
+        response = jsonify({"error": "Demasiadas conexiones de eventos; reintente más tarde"})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+    try:
+        change_feed.start()
+        last_event_id = request.headers.get('Last-Event-ID') or request.args.get('after')
+        try:
+            after = int(last_event_id) if last_event_id else None
+        except ValueError:
+            after = None
+        changes, index = change_feed.since_seq(after)
+    except Exception as e:
+        change_feed.release()
+        return jsonify({"error": str(e)}), 500
+    response = app.response_class(event_stream(changes, index, after is not None), mimetype='text/event-stream',
+                                  headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Al cerrar la respuesta, aunque el generador no haya empezado (HEAD o desconexión)
+    response.call_on_close(change_feed.release)
+    return response
+
+@app.route('/api/eventos/pendientes', methods=['GET'])
+def get_pending_events():
+    """Los mismos cambios que el stream desde ``after``, para consultar cada tanto
+    cuando no hay un stream libre. Cada cambio trae su secuencia en ``seq``."""
+    try:
+        change_feed.start()
+        after = request.args.get('after', type=int)
+        # Antes de buscar los cambios: uno posterior se envía en la próxima consulta
+        last_seq = change_feed.last_seq
+        changes, _ = change_feed.since_seq(after)
+        if changes is None:
+            items = [{'seq': last_seq, 'op': 'reload' if after is not None else 'ready'}]
+        else:
+            items = [dict(change.data, seq=change.seq) for change in changes]
+        return jsonify({"changes": items})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001, debug=True)
 
@@ -0,0 +1,402 @@
+"""Agregados de movimientos mantenidos de forma incremental.
+
+Cada crear/editar/eliminar movimiento suma o resta su aporte a los
+contadores, de modo que los endpoints de ``/api/graficos/*`` solo recorren
+el resultado y no todo el historial de movimientos.
+
+Los contadores se guardan por ID (producto, etapa, sub-etapa) y no por
+nombre: los nombres y precios actuales se resuelven al construir la
+respuesta, igual que hacían los endpoints originales.
+"""
+import math
+from bisect import bisect_left, bisect_right, insort
+
+from indexes import TimestampIndex
+
+
+class Rollup:
+    """Acumulador por clave con conteo de aportes.
+
+    Una clave desaparece cuando su conteo vuelve a cero, así el resultado
+    coincide con recalcular desde cero tras eliminar movimientos.
+    """
+
+    def __init__(self):
+        self._cells = {}
+
+    def add(self, key, value, sign=1):
+        cell = self._cells.get(key)
+        if cell is None:
+            cell = self._cells[key] = [0, 0]
+        cell[0] += sign
+        cell[1] += sign * value
+        if cell[0] == 0:
+            del self._cells[key]
+
+    def items(self):
+        """Pares ``(clave, total)``"""
+        return [(key, cell[1]) for key, cell in list(self._cells.items())]
+
+    def clear(self):
+        self._cells.clear()
+
+    def load(self, cells):
+        """Reemplaza el contenido con ``{clave: (total, conteo)}``"""
+        self._cells = {key: [count, total] for key, (total, count) in cells.items() if count}
+
+
+class MovementRollups:
+    """Contadores por producto, etapa, sub-etapa, locación y periodo"""
+
+    # Contadores de consumo (solo movimientos de tipo 'uso')
+    USAGE = (
+        'qty_by_product',            # product_id
+        'qty_by_location_product',   # (location, product_id)
+        'qty_by_substage_product',   # (substage_id, product_id)
+        'qty_by_month_product',      # (month, product_id); month = año * 12 + mes - 1
+        'qty_by_year_product',       # (year, product_id)
+        'cost_by_stage',             # stage_id
+        'cost_by_substage',          # substage_id
+        'cost_by_month_location',    # (month, location)
+        'cost_by_year_location',     # (year, location)
+    )
+    # Contadores de gasto (todos los movimientos)
+    ALL = (
+        'all_qty_by_month_product',
+        'all_qty_by_year_product',
+        'all_cost_by_stage',
+        'all_cost_by_substage',
+        'all_cost_by_location',
+        'all_cost_by_month_location',
+        'all_cost_by_year_location',
+    )
+
+    # Contador -> (columnas del libro, valor, filas: 'line' o 'head')
+    LEDGER_GROUPS = {
+        'qty_by_product': (('product_id',), 'quantity', 'line'),
+        'qty_by_location_product': (('location', 'product_id'), 'quantity', 'line'),
+        'qty_by_substage_product': (('substage_id', 'product_id'), 'quantity', 'line'),
+        'qty_by_month_product': (('month', 'product_id'), 'quantity', 'line'),
+        'qty_by_year_product': (('year', 'product_id'), 'quantity', 'line'),
+        'cost_by_stage': (('stage_id',), 'cost', 'head'),
+        'cost_by_substage': (('substage_id',), 'cost', 'head'),
+        'cost_by_month_location': (('month', 'location'), 'cost', 'head'),
+        'cost_by_year_location': (('year', 'location'), 'cost', 'head'),
+        'all_qty_by_month_product': (('month', 'product_id'), 'quantity', 'line'),
+        'all_qty_by_year_product': (('year', 'product_id'), 'quantity', 'line'),
+        'all_cost_by_stage': (('stage_id',), 'cost', 'head'),
+        'all_cost_by_substage': (('substage_id',), 'cost', 'head'),
+        'all_cost_by_location': (('location',), 'cost', 'head'),
+        'all_cost_by_month_location': (('month', 'location'), 'cost', 'head'),
+        'all_cost_by_year_location': (('year', 'location'), 'cost', 'head'),
+    }
+
+    def __init__(self, movements, ledger=None, timestamps=None):
+        self.rollups = {name: Rollup() for name in self.USAGE + self.ALL}
+        self.movements = movements
+        # Mes y año de cada movimiento, calculados al escribirlo
+        self.timestamps = timestamps or TimestampIndex(movements, 'date')
+        # Con un libro columnar (ver ledger.py) la reconstrucción es vectorizada
+        self.ledger = ledger
+        # Se reconstruye en la primera lectura (la colección carga perezosa)
+        self.stale = True
+        movements.subscribe(self.on_change)
+
+    def __getitem__(self, name):
+        with self.movements.store.lock:
+            if self.stale:
+                self.rebuild()
+            return self.rollups[name]
+
+    def rebuild(self):
+        """Recalcula todos los contadores desde la colección"""
+        if self.ledger is not None:
+            self.rebuild_from_ledger()
+            return
+        for rollup in self.rollups.values():
+            rollup.clear()
+        for movement in self.movements:
+            self.apply(movement, 1)
+        self.stale = False
+
+    def rebuild_from_ledger(self):
+        """Recalcula los contadores con agrupaciones sobre el libro columnar"""
+        for name, (keys, value, rows) in self.LEDGER_GROUPS.items():
+            conditions = {rows: True}
+            if name in self.USAGE:
+                conditions['type'] = 'uso'
+            cells = self.ledger.group_sum(keys, value, **conditions)
+            self.rollups[name].load(self._ledger_keys(keys, cells))
+        self.stale = False
+
+    @staticmethod
+    def _ledger_keys(keys, cells):
+        """Descarta las claves sin etapa/sub-etapa, que ``apply`` no cuenta"""
+        checked = [index for index, column in enumerate(keys) if column in ('stage_id', 'substage_id')]
+        if not checked:
+            return cells
+        result = {}
+        for key, cell in cells.items():
+            parts = key if len(keys) > 1 else (key,)
+            if all(parts[index] > 0 for index in checked):
+                result[key] = cell
+        return result
+
+    def on_change(self, op, old, new):
+        if op == 'reset':
+            self.stale = True
+            return
+        if self.stale:
+            return
+        if old is not None:
+            self.apply(old, -1)
+        if new is not None:
+            self.apply(new, 1)
+
+    def apply(self, movement, sign):
+        """Suma (``sign=1``) o resta (``sign=-1``) el aporte de un movimiento"""
+        r = self.rollups
+        period = self.timestamps.period(movement)
+        month, year = period.month, period.year
+        location = movement.get('location')
+        stage_id = movement.get('stage_id')
+        substage_id = movement.get('substage_id')
+        cost = movement.get('cost', 0)
+        is_usage = movement['type'] == 'uso'
+
+        for line in movement['products']:
+            product_id = line['product_id']
+            quantity = line['quantity']
+            r['all_qty_by_month_product'].add((month, product_id), quantity, sign)
+            r['all_qty_by_year_product'].add((year, product_id), quantity, sign)
+            if is_usage:
+                r['qty_by_product'].add(product_id, quantity, sign)
+                r['qty_by_location_product'].add((location, product_id), quantity, sign)
+                r['qty_by_month_product'].add((month, product_id), quantity, sign)
+                r['qty_by_year_product'].add((year, product_id), quantity, sign)
+                if substage_id:
+                    r['qty_by_substage_product'].add((substage_id, product_id), quantity, sign)
+
+        r['all_cost_by_location'].add(location, cost, sign)
+        r['all_cost_by_month_location'].add((month, location), cost, sign)
+        r['all_cost_by_year_location'].add((year, location), cost, sign)
+        if stage_id:
+            r['all_cost_by_stage'].add(stage_id, cost, sign)
+        if substage_id:
+            r['all_cost_by_substage'].add(substage_id, cost, sign)
+        if is_usage:
+            r['cost_by_month_location'].add((month, location), cost, sign)
+            r['cost_by_year_location'].add((year, location), cost, sign)
+            if stage_id:
+                r['cost_by_stage'].add(stage_id, cost, sign)
+            if substage_id:
+                r['cost_by_substage'].add(substage_id, cost, sign)
+
+
+class DailySeries:
+    """Totales por día para series de tiempo con cualquier granularidad.
+
+    Cada día guarda, por dimensión y (clave, tipo de movimiento), el conteo,
+    la cantidad y el costo. Una consulta por rango solo recorre los días del
+    rango, que se buscan por bisección en la lista ordenada de días.
+
+    Para la dimensión ``product`` se guarda solo la cantidad: el gasto se
+    calcula al consultar con el precio actual, igual que en los gráficos
+    de gasto por producto.
+    """
+
+    # Dimensión -> columna del libro
+    DIMENSIONS = {
+        'product': 'product_id',
+        'location': 'location',
+        'stage': 'stage_id',
+        'substage': 'substage_id',
+        'responsible': 'responsible',
+    }
+
+    def __init__(self, movements, ledger, timestamps):
+        self.movements = movements
+        self.ledger = ledger
+        self.timestamps = timestamps
+        self._days = {}
+        self._sorted_days = []
+        self.stale = True
+        movements.subscribe(self.on_change)
+
+    def on_change(self, op, old, new):
+        if op == 'reset':
+            self.stale = True
+            return
+        if self.stale:
+            return
+        if old is not None:
+            self.apply(old, -1)
+        if new is not None:
+            self.apply(new, 1)
+
+    def rebuild(self):
+        """Recalcula los días con agrupaciones sobre el libro columnar"""
+        self._days = {}
+        for dimension, column in self.DIMENSIONS.items():
+            keys = ('day', column, 'type')
+            quantities = self.ledger.group_sum(keys, 'quantity', line=True)
+            if dimension == 'product':
+                for (day, key, movement_type), (quantity, count) in quantities.items():
+                    self._cell(day, dimension, key, movement_type)[:2] = [count, quantity]
+                continue
+            for (day, key, movement_type), (cost, count) in self.ledger.group_sum(keys, 'cost', head=True).items():
+                self._cell(day, dimension, key, movement_type)[::2] = [count, cost]
+            for (day, key, movement_type), (quantity, _) in quantities.items():
+                self._cell(day, dimension, key, movement_type)[1] = quantity
+        for dimension in ('stage', 'substage'):
+            for day, dimensions in list(self._days.items()):
+                cells = dimensions.get(dimension, {})
+                for key in [key for key in cells if self._skipped(dimension, key[0])]:
+                    del cells[key]
+                if not cells:
+                    dimensions.pop(dimension, None)
+                if not dimensions:
+                    del self._days[day]
+        self._sorted_days = sorted(self._days)
+        self.stale = False
+
+    @staticmethod
+    def _skipped(dimension, key):
+        # Movimientos sin etapa/sub-etapa no cuentan para esas dimensiones
+        return dimension in ('stage', 'substage') and (not key or key == -1)
+
+    def _cell(self, day, dimension, key, movement_type):
+        dimensions = self._days.get(day)
+        if dimensions is None:
+            dimensions = self._days[day] = {}
+            if not self.stale:
+                insort(self._sorted_days, day)
+        cells = dimensions.setdefault(dimension, {})
+        cell = cells.get((key, movement_type))
+        if cell is None:
+            cell = cells[(key, movement_type)] = [0, 0, 0]
+        return cell
+
+    def _add(self, day, dimension, key, movement_type, quantity, cost, sign):
+        if self._skipped(dimension, key):
+            return
+        try:
+            cell = self._cell(day, dimension, key, movement_type)
+        except TypeError:
+            # Claves no hashables recibidas desde JSON: no se cuentan
+            return
+        cell[0] += sign
+        cell[1] += sign * quantity
+        cell[2] += sign * cost
+        if cell[0] == 0:
+            dimensions = self._days[day]
+            del dimensions[dimension][(key, movement_type)]
+            if not dimensions[dimension]:
+                del dimensions[dimension]
+            if not dimensions:
+                del self._days[day]
+                del self._sorted_days[bisect_left(self._sorted_days, day)]
+
+    def apply(self, movement, sign):
+        """Suma (``sign=1``) o resta (``sign=-1``) el aporte de un movimiento"""
+        day = self.timestamps.period(movement).day
+        movement_type = movement['type']
+        quantity = 0
+        for line in movement['products']:
+            self._add(day, 'product', line['product_id'], movement_type, line['quantity'], 0, sign)
+            quantity += line['quantity']
+        cost = movement.get('cost', 0)
+        self._add(day, 'location', movement.get('location'), movement_type, quantity, cost, sign)
+        self._add(day, 'stage', movement.get('stage_id'), movement_type, quantity, cost, sign)
+        self._add(day, 'substage', movement.get('substage_id'), movement_type, quantity, cost, sign)
+        self._add(day, 'responsible', movement.get('responsible'), movement_type, quantity, cost, sign)
+
+    def query(self, dimension, first_day=None, last_day=None, movement_type=None):
+        """``(día, clave, cantidad, costo)`` de los días del rango (inclusivo)"""
+        with self.movements.store.lock:
+            if self.stale:
+                self.rebuild()
+            days = self._sorted_days
+            start = 0 if first_day is None else bisect_left(days, first_day)
+            end = len(days) if last_day is None else bisect_right(days, last_day)
+            result = []
+            for day in days[start:end]:
+                for (key, cell_type), (_, quantity, cost) in self._days[day].get(dimension, {}).items():
+                    if movement_type is None or cell_type == movement_type:
+                        result.append((day, key, quantity, cost))
+            return result
+
+
+class RunningTotal:
+    """Suma de un campo numérico sobre toda la colección.
+
+    La suma es exacta: cada float se acumula como entero en unidades de
+    2**-1074 (la menor fracción que puede tener un float), así sumar y
+    restar en cualquier orden da lo mismo que sumar desde cero, sin
+    acumular error de redondeo tras muchas ediciones. Los valores infinitos
+    y NaN se cuentan aparte y dan el mismo resultado que ``sum``. Las filas
+    sin el campo o con un valor que no es un número no aportan nada.
+    """
+
+    SHIFT = 1074
+
+    def __init__(self, collection, field):
+        self.collection = collection
+        self.field = field
+        self._total = 0
+        # Aportes no enteros: con alguno el total se devuelve como float (como ``sum``)
+        self._floats = 0
+        # Cantidad de filas con inf, -inf y NaN
+        self._non_finite = {math.inf: 0, -math.inf: 0, 'nan': 0}
+        self.stale = True
+        collection.subscribe(self.on_change)
+
+    @property
+    def value(self):
+        with self.collection.store.lock:
+            if self.stale:
+                self.rebuild()
+            positive, negative = self._non_finite[math.inf], self._non_finite[-math.inf]
+            if self._non_finite['nan'] or (positive and negative):
+                return math.nan
+            if positive or negative:
+                return math.inf if positive else -math.inf
+            if self._floats:
+                # La división entre enteros redondea correctamente
+                return self._total / (1 << self.SHIFT)
+            return self._total >> self.SHIFT
+
+    def rebuild(self):
+        self._total = 0
+        self._floats = 0
+        self._non_finite = dict.fromkeys(self._non_finite, 0)
+        for row in self.collection:
+            self.apply(row, 1)
+        self.stale = False
+
+    def on_change(self, op, old, new):
+        if op == 'reset':
+            self.stale = True
+            return
+        if self.stale:
+            return
+        if old is not None:
+            self.apply(old, -1)
+        if new is not None:
+            self.apply(new, 1)
+
+    def apply(self, row, sign):
+        value = row.get(self.field)
+        # Se ejecuta después de escribir: un valor inválido no debe romper la escritura
+        if not isinstance(value, (int, float)):
+            return
+        if isinstance(value, int):
+            self._total += sign * (value << self.SHIFT)
+            return
+        if not math.isfinite(value):
+            self._non_finite['nan' if math.isnan(value) else value] += sign
+            return
+        numerator, denominator = value.as_integer_ratio()
+        # ``denominator`` es una potencia de 2
+        self._total += sign * (numerator << (self.SHIFT - denominator.bit_length() + 1))
+        self._floats += sign
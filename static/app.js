@@ -9,6 +9,8 @@ let locations = [];
 let stages = [];
 let substages = [];
 let movements = [];
+let movementsCursor = null;
+const MOVEMENTS_PAGE_SIZE = 50;
 let postits = [];
 let recipes = [];
 let recipeImages = [];
@@ -29,8 +31,12 @@ async function initializeApp() {
         // Initialize drag and drop for tabs
         initializeDragAndDrop();
         
+        // Listen for changes before loading, so none is missed in between
+        connectChangeStream();
+        
         // Load initial data
         await loadAllData();
+        markDataLoaded();
         
         // Setup event listeners
         setupEventListeners();
@@ -92,6 +98,31 @@ function initializeDragAndDrop() {
 }
 
 // Data loading functions
+
+// GET responses cached by URL with their ETag; on 304 (nothing changed)
+// the cached data is reused instead of downloading it again
+const responseCache = new Map();
+const RESPONSE_CACHE_SIZE = 50;
+
+async function cachedFetch(url) {
+    const cached = responseCache.get(url);
+    const headers = cached ? { 'If-None-Match': cached.etag } : {};
+    const response = await fetch(url, { headers, cache: 'no-store' });
+    if (response.status === 304 && cached) {
+        return cached.data;
+    }
+    const data = await response.json();
+    const etag = response.headers.get('ETag');
+    if (response.ok && etag) {
+        responseCache.delete(url);
+        responseCache.set(url, { etag, data });
+        if (responseCache.size > RESPONSE_CACHE_SIZE) {
+            responseCache.delete(responseCache.keys().next().value);
+        }
+    }
+    return data;
+}
+
 async function loadAllData() {
     await Promise.all([
         loadProducts(),
@@ -108,8 +139,7 @@ async function loadAllData() {
 
 async function loadProducts() {
     try {
-        const response = await fetch(`${API_BASE_URL}/api/productos`);
-        products = await response.json();
+        products = await cachedFetch(`${API_BASE_URL}/api/productos`);
         renderProductsTable();
         updateProductSelects();
     } catch (error) {
@@ -119,10 +149,11 @@ async function loadProducts() {
 
 async function loadLocations() {
     try {
-        const response = await fetch(`${API_BASE_URL}/api/locaciones`);
-        locations = await response.json();
+        locations = await cachedFetch(`${API_BASE_URL}/api/locaciones`);
         renderLocationsTable();
+        renderProductsTable(); // Location names in the stock breakdown
         updateLocationSelects();
+        updateLocationFilter();
     } catch (error) {
         console.error('Error loading locations:', error);
     }
@@ -130,8 +161,7 @@ async function loadLocations() {
 
 async function loadStages() {
     try {
-        const response = await fetch(`${API_BASE_URL}/api/etapas`);
-        stages = await response.json();
+        stages = await cachedFetch(`${API_BASE_URL}/api/etapas`);
         renderStagesTable();
         updateStageSelects();
     } catch (error) {
@@ -141,8 +171,7 @@ async function loadStages() {
 
 async function loadSubstages() {
     try {
-        const response = await fetch(`${API_BASE_URL}/api/sub-etapas`);
-        substages = await response.json();
+        substages = await cachedFetch(`${API_BASE_URL}/api/sub-etapas`);
         renderSubstagesTable();
         updateSubstageSelects();
     } catch (error) {
@@ -150,21 +179,42 @@ async function loadSubstages() {
     }
 }
 
-async function loadMovements() {
+// Movements are loaded one page at a time (latest first); filters are applied server-side
+function getMovementQuery(cursor = null) {
+    const params = new URLSearchParams({ limit: MOVEMENTS_PAGE_SIZE });
+    const typeFilter = document.getElementById('typeFilter').value;
+    const locationFilter = document.getElementById('locationFilter').value;
+    const dateFilter = document.getElementById('dateFilter').value;
+
+    if (typeFilter) params.set('type', typeFilter);
+    if (locationFilter) params.set('location_id', locationFilter);
+    if (dateFilter) {
+        params.set('desde', dateFilter);
+        params.set('hasta', dateFilter);
+    }
+    if (cursor) params.set('cursor', cursor);
+    return params.toString();
+}
+
+async function loadMovements(append = false) {
     try {
-        const response = await fetch(`${API_BASE_URL}/api/movimientos`);
-        movements = await response.json();
+        const cursor = append ? movementsCursor : null;
+        const page = await cachedFetch(`${API_BASE_URL}/api/movimientos?${getMovementQuery(cursor)}`);
+        movements = append ? movements.concat(page.items) : page.items;
+        movementsCursor = page.next_cursor;
         renderMovementsTable();
-        updateLocationFilter();
     } catch (error) {
         console.error('Error loading movements:', error);
     }
 }
 
+function loadMoreMovements() {
+    loadMovements(true);
+}
+
 async function loadPostits() {
     try {
-        const response = await fetch(`${API_BASE_URL}/api/postits`);
-        postits = await response.json();
+        postits = await cachedFetch(`${API_BASE_URL}/api/postits`);
         renderPostitsGrid();
     } catch (error) {
         console.error('Error loading post-its:', error);
@@ -173,8 +223,7 @@ async function loadPostits() {
 
 async function loadRecipes() {
     try {
-        const response = await fetch(`${API_BASE_URL}/api/recetas`);
-        recipes = await response.json();
+        recipes = await cachedFetch(`${API_BASE_URL}/api/recetas`);
         renderRecipesList();
     } catch (error) {
         console.error('Error loading recipes:', error);
@@ -183,8 +232,7 @@ async function loadRecipes() {
 
 async function loadRecipeImages() {
     try {
-        const response = await fetch(`${API_BASE_URL}/api/recetas/imagenes`);
-        recipeImages = await response.json();
+        recipeImages = await cachedFetch(`${API_BASE_URL}/api/recetas/imagenes`);
         renderImagesGallery();
     } catch (error) {
         console.error('Error loading recipe images:', error);
@@ -193,8 +241,7 @@ async function loadRecipeImages() {
 
 async function loadDashboardData() {
     try {
-        const response = await fetch(`${API_BASE_URL}/api/dashboard`);
-        const data = await response.json();
+        const data = await cachedFetch(`${API_BASE_URL}/api/dashboard`);
         updateDashboard(data);
         await loadAllCharts();
     } catch (error) {
@@ -202,6 +249,317 @@ async function loadDashboardData() {
     }
 }
 
+// Headers for saving an entity. Edits send If-Match with the version the
+// form was filled from, so a concurrent change is rejected (412) instead of
+// being silently overwritten
+function saveHeaders(list, id) {
+    const headers = { 'Content-Type': 'application/json' };
+    const row = id ? list.find(item => item.id == id) : null;
+    if (row && row.version !== undefined) {
+        headers['If-Match'] = `"${row.version}"`;
+    }
+    return headers;
+}
+
+// Change stream: the server pushes every insert/update/delete (from any
+// user) and they are applied in place to the loaded arrays, instead of
+// downloading whole collections again after each save
+let changeStream = null;
+let changeStreamConnected = false;
+// Changes received while the initial data is loading are applied afterwards
+let pendingChanges = [];
+let dataLoaded = false;
+const pendingRenders = new Set();
+const CHANGE_STREAM_RETRY = 30000;
+// Without a stream (none free on the server, or no EventSource) the same
+// changes are polled from /api/eventos/pendientes
+const CHANGE_POLL_INTERVAL = 5000;
+let changePollTimer = null;
+let lastChangeSeq = null;
+// Changes already applied with seq === lastChangeSeq (a poll returns them again)
+let appliedAtLastSeq = new Set();
+const DASHBOARD_REFRESH_DELAY = 1000;
+let dashboardRefreshTimer = null;
+
+// Loaded collections patched by change events
+const CHANGE_TARGETS = {
+    products: {
+        get: () => products, set: rows => { products = rows; }, load: loadProducts,
+        render() { renderProductsTable(); updateProductSelects(); }
+    },
+    locations: {
+        get: () => locations, set: rows => { locations = rows; }, load: loadLocations,
+        render() { renderLocationsTable(); renderProductsTable(); updateLocationSelects(); updateLocationFilter(); }
+    },
+    stages: {
+        get: () => stages, set: rows => { stages = rows; }, load: loadStages,
+        render() { renderStagesTable(); updateStageSelects(); }
+    },
+    substages: {
+        get: () => substages, set: rows => { substages = rows; }, load: loadSubstages,
+        render() { renderSubstagesTable(); updateSubstageSelects(); }
+    },
+    postits: { get: () => postits, set: rows => { postits = rows; }, load: loadPostits, render: renderPostitsGrid },
+    recipes: { get: () => recipes, set: rows => { recipes = rows; }, load: loadRecipes, render: renderRecipesList },
+    recipe_images: {
+        get: () => recipeImages, set: rows => { recipeImages = rows; }, load: loadRecipeImages, render: renderImagesGallery
+    },
+    movements: { load: () => loadMovements(), render: renderMovementsTable }
+};
+
+// Collections shown in the dashboard KPIs and stock alerts
+const DASHBOARD_ENTITIES = new Set(['products', 'movements', 'stages', 'locations']);
+
+function connectChangeStream() {
+    if (!window.EventSource) {
+        startChangePolling();
+        return;
+    }
+    const after = lastChangeSeq !== null ? `?after=${lastChangeSeq}` : '';
+    changeStream = new EventSource(`${API_BASE_URL}/api/eventos${after}`);
+    changeStream.onopen = () => {
+        changeStreamConnected = true;
+        stopChangePolling();
+    };
+    changeStream.onmessage = (event) => {
+        const change = JSON.parse(event.data);
+        trackChange(Number(event.lastEventId), change);
+        receiveChanges([change]);
+    };
+    changeStream.onerror = () => {
+        changeStreamConnected = false;
+        // The browser reconnects by itself unless the server refused the stream
+        if (changeStream.readyState === EventSource.CLOSED) {
+            changeStream = null;
+            startChangePolling();
+            setTimeout(connectChangeStream, CHANGE_STREAM_RETRY);
+        }
+    };
+}
+
+function receiveChanges(changes) {
+    if (dataLoaded) {
+        applyChanges(changes);
+    } else {
+        pendingChanges.push(...changes);
+    }
+}
+
+// Remembers the last sequence received; false if the change was already applied
+function trackChange(seq, change) {
+    const key = JSON.stringify(change);
+    if (seq !== lastChangeSeq) {
+        lastChangeSeq = seq;
+        appliedAtLastSeq = new Set();
+    } else if (appliedAtLastSeq.has(key)) {
+        return false;
+    }
+    appliedAtLastSeq.add(key);
+    return true;
+}
+
+function startChangePolling() {
+    if (changePollTimer === null) {
+        changePollTimer = setInterval(pollChanges, CHANGE_POLL_INTERVAL);
+        pollChanges();
+    }
+}
+
+function stopChangePolling() {
+    clearInterval(changePollTimer);
+    changePollTimer = null;
+}
+
+async function pollChanges() {
+    try {
+        const after = lastChangeSeq !== null ? `?after=${lastChangeSeq}` : '';
+        const response = await fetch(`${API_BASE_URL}/api/eventos/pendientes${after}`);
+        if (!response.ok || changeStreamConnected) {
+            return;
+        }
+        const { changes } = await response.json();
+        const fresh = [];
+        changes.forEach(({ seq, ...change }) => {
+            if (trackChange(seq, change)) {
+                fresh.push(change);
+            }
+        });
+        receiveChanges(fresh);
+    } catch (error) {
+        console.error('Error consultando cambios:', error);
+    }
+}
+
+function markDataLoaded() {
+    dataLoaded = true;
+    applyChanges(pendingChanges);
+    pendingChanges = [];
+}
+
+// After a save the change arrives through the stream; without a stream
+// the affected collections are reloaded
+async function refreshAfterWrite(...loaders) {
+    if (changeStreamConnected) {
+        return;
+    }
+    await Promise.all(loaders.map(load => load()));
+}
+
+function applyChanges(changes) {
+    changes.forEach(change => {
+        if (change.op === 'ready') {
+            return;
+        }
+        if (change.op === 'reload') {
+            // A bulk load (or changes the server no longer has): reload that collection or everything
+            reloadAfterChange(change.entity);
+            return;
+        }
+        if (change.entity === 'stock_alerts') {
+            notifyStockAlert(change);
+        } else if (change.entity === 'movements') {
+            applyMovementChange(change);
+        } else if (CHANGE_TARGETS[change.entity]) {
+            applyListChange(change);
+        }
+        if (DASHBOARD_ENTITIES.has(change.entity)) {
+            scheduleDashboardRefresh();
+        }
+    });
+    scheduleRender();
+}
+
+function reloadAfterChange(entity) {
+    const targets = entity ? [CHANGE_TARGETS[entity]].filter(Boolean) : Object.values(CHANGE_TARGETS);
+    targets.forEach(target => target.load());
+    if (!entity || DASHBOARD_ENTITIES.has(entity)) {
+        scheduleDashboardRefresh();
+    }
+}
+
+function applyListChange(change) {
+    const target = CHANGE_TARGETS[change.entity];
+    const rows = target.get();
+    const index = rows.findIndex(row => row.id === change.id);
+    if (change.op === 'delete') {
+        if (index !== -1) {
+            target.set(rows.filter(row => row.id !== change.id));
+        }
+    } else if (index !== -1) {
+        Object.assign(rows[index], change.fields);
+    } else if (change.op === 'insert') {
+        rows.push(change.fields);
+    }
+    if (change.op === 'update' && change.fields.name !== undefined) {
+        renameReferences(change.entity, change.id, change.fields.name);
+    }
+    pendingRenders.add(change.entity);
+}
+
+// Names copied into other entities (stage -> location_name, movement -> product_name, ...)
+function renameReferences(entity, id, name) {
+    if (entity === 'products') {
+        movements.forEach(movement => (movement.products || []).forEach(item => {
+            if (item.product_id === id) item.product_name = name;
+        }));
+        pendingRenders.add('movements');
+    } else if (entity === 'locations') {
+        stages.forEach(stage => {
+            if (stage.location_id === id) stage.location_name = name;
+        });
+        pendingRenders.add('stages');
+    } else if (entity === 'stages') {
+        substages.forEach(substage => {
+            if (substage.stage_id === id) substage.stage_name = name;
+        });
+        movements.forEach(movement => {
+            if (movement.stage_id === id) movement.stage_name = name;
+        });
+        pendingRenders.add('substages');
+        pendingRenders.add('movements');
+    } else if (entity === 'substages') {
+        movements.forEach(movement => {
+            if (movement.substage_id === id) movement.substage_name = name;
+        });
+        pendingRenders.add('movements');
+    }
+}
+
+// Only the loaded page(s) of movements are kept: changes are applied if
+// they fall inside them and match the active filters
+function movementMatchesFilters(movement) {
+    const typeFilter = document.getElementById('typeFilter').value;
+    const locationFilter = document.getElementById('locationFilter').value;
+    const dateFilter = document.getElementById('dateFilter').value;
+    if (typeFilter && movement.type !== typeFilter) return false;
+    if (locationFilter && String(movement.location_id) !== locationFilter) return false;
+    if (dateFilter && !(movement.date || '').startsWith(dateFilter)) return false;
+    return true;
+}
+
+// Latest first, same order as the server (date, then id)
+function movementBefore(a, b) {
+    return a.date > b.date || (a.date === b.date && a.id > b.id);
+}
+
+function insertMovement(movement) {
+    let index = movements.findIndex(row => movementBefore(movement, row));
+    if (index === -1) {
+        // Older than the loaded pages: it shows up with "load more"
+        if (movementsCursor) return;
+        index = movements.length;
+    }
+    movements.splice(index, 0, movement);
+}
+
+function applyMovementChange(change) {
+    const index = movements.findIndex(row => row.id === change.id);
+    if (change.op === 'delete') {
+        if (index !== -1) movements.splice(index, 1);
+    } else if (index !== -1) {
+        const movement = Object.assign(movements[index], change.fields);
+        movements.splice(index, 1);
+        if (movementMatchesFilters(movement)) {
+            insertMovement(movement);
+        }
+    } else if (change.op === 'insert' && movementMatchesFilters(change.fields)) {
+        insertMovement(change.fields);
+    }
+    pendingRenders.add('movements');
+}
+
+function notifyStockAlert(change) {
+    if (change.op !== 'insert') return;
+    const alert = change.fields;
+    const message = alert.status === 'normal'
+        ? `${alert.product_name}: stock normalizado (${alert.current_stock} ${alert.unit})`
+        : `${alert.product_name}: stock ${alert.status} (${alert.current_stock} ${alert.unit}, mínimo ${alert.min_stock})`;
+    showNotification(message, alert.status === 'crítico' ? 'error' : 'info');
+}
+
+// Tables are re-rendered once per batch of changes
+function scheduleRender() {
+    if (pendingRenders.size === 0) return;
+    requestAnimationFrame(() => {
+        const entities = Array.from(pendingRenders);
+        pendingRenders.clear();
+        entities.forEach(entity => CHANGE_TARGETS[entity] && CHANGE_TARGETS[entity].render());
+    });
+}
+
+// Only the KPIs and alerts are refreshed (small response); charts keep
+// loading when their section is opened
+function scheduleDashboardRefresh() {
+    clearTimeout(dashboardRefreshTimer);
+    dashboardRefreshTimer = setTimeout(async () => {
+        try {
+            updateDashboard(await cachedFetch(`${API_BASE_URL}/api/dashboard`));
+        } catch (error) {
+            console.error('Error refreshing dashboard:', error);
+        }
+    }, DASHBOARD_REFRESH_DELAY);
+}
+
 // Event listeners setup
 function setupEventListeners() {
     // Navigation
@@ -265,6 +623,7 @@ function setupEventListeners() {
     document.getElementById('locationFilter').addEventListener('change', applyFilters);
     document.getElementById('dateFilter').addEventListener('change', applyFilters);
     document.getElementById('clearFilters').addEventListener('click', clearFilters);
+    document.getElementById('loadMoreMovements').addEventListener('click', loadMoreMovements);
 
     // Stage dropdown change
     document.getElementById('movementStage').addEventListener('change', updateSubstageOptions);
@@ -428,14 +787,12 @@ async function handleProductSubmit(e) {
         
         const response = await fetch(url, {
             method: method,
-            headers: {
-                'Content-Type': 'application/json'
-            },
+            headers: saveHeaders(products, currentEditingId),
             body: JSON.stringify(data)
         });
         
         if (response.ok) {
-            await loadProducts();
+            await refreshAfterWrite(loadProducts);
             closeModal('productModal');
             showNotification(currentEditingId ? 'Producto actualizado' : 'Producto creado', 'success');
         } else {
@@ -466,7 +823,7 @@ async function deleteProduct(id) {
         });
         
         if (response.ok) {
-            await loadProducts();
+            await refreshAfterWrite(loadProducts);
             showNotification('Producto eliminado', 'success');
         } else {
             const error = await response.json();
@@ -523,14 +880,12 @@ async function handleStageSubmit(e) {
         
         const response = await fetch(url, {
             method: method,
-            headers: {
-                'Content-Type': 'application/json'
-            },
+            headers: saveHeaders(stages, currentEditingId),
             body: JSON.stringify(data)
         });
         
         if (response.ok) {
-            await loadStages();
+            await refreshAfterWrite(loadStages);
             closeModal('stageModal');
             showNotification(currentEditingId ? 'Etapa actualizada' : 'Etapa creada', 'success');
         } else {
@@ -561,7 +916,7 @@ async function deleteStage(id) {
         });
         
         if (response.ok) {
-            await loadStages();
+            await refreshAfterWrite(loadStages);
             showNotification('Etapa eliminada', 'success');
         } else {
             const error = await response.json();
@@ -580,7 +935,7 @@ async function startStage(id) {
         });
         
         if (response.ok) {
-            await loadStages();
+            await refreshAfterWrite(loadStages);
             showNotification('Etapa iniciada', 'success');
         } else {
             const error = await response.json();
@@ -599,7 +954,7 @@ async function finishStage(id) {
         });
         
         if (response.ok) {
-            await loadStages();
+            await refreshAfterWrite(loadStages);
             showNotification('Etapa finalizada', 'success');
         } else {
             const error = await response.json();
@@ -656,14 +1011,12 @@ async function handleSubstageSubmit(e) {
         
         const response = await fetch(url, {
             method: method,
-            headers: {
-                'Content-Type': 'application/json'
-            },
+            headers: saveHeaders(substages, currentEditingId),
             body: JSON.stringify(data)
         });
         
         if (response.ok) {
-            await loadSubstages();
+            await refreshAfterWrite(loadSubstages);
             closeModal('substageModal');
             showNotification(currentEditingId ? 'Sub-etapa actualizada' : 'Sub-etapa creada', 'success');
         } else {
@@ -694,7 +1047,7 @@ async function deleteSubstage(id) {
         });
         
         if (response.ok) {
-            await loadSubstages();
+            await refreshAfterWrite(loadSubstages);
             showNotification('Sub-etapa eliminada', 'success');
         } else {
             const error = await response.json();
@@ -713,7 +1066,7 @@ async function startSubstage(id) {
         });
         
         if (response.ok) {
-            await loadSubstages();
+            await refreshAfterWrite(loadSubstages);
             showNotification('Sub-etapa iniciada', 'success');
         } else {
             const error = await response.json();
@@ -732,7 +1085,7 @@ async function finishSubstage(id) {
         });
         
         if (response.ok) {
-            await loadSubstages();
+            await refreshAfterWrite(loadSubstages);
             showNotification('Sub-etapa finalizada', 'success');
         } else {
             const error = await response.json();
@@ -785,14 +1138,12 @@ async function handleLocationSubmit(e) {
         
         const response = await fetch(url, {
             method: method,
-            headers: {
-                'Content-Type': 'application/json'
-            },
+            headers: saveHeaders(locations, currentEditingId),
             body: JSON.stringify(data)
         });
         
         if (response.ok) {
-            await loadLocations();
+            await refreshAfterWrite(loadLocations);
             closeModal('locationModal');
             showNotification(currentEditingId ? 'Locación actualizada' : 'Locación creada', 'success');
         } else {
@@ -823,7 +1174,7 @@ async function deleteLocation(id) {
         });
         
         if (response.ok) {
-            await loadLocations();
+            await refreshAfterWrite(loadLocations, loadProducts); // Its stock goes back to unassigned
             showNotification('Locación eliminada', 'success');
         } else {
             const error = await response.json();
@@ -932,8 +1283,7 @@ async function handleMovementSubmit(e) {
         });
         
         if (response.ok) {
-            await loadMovements();
-            await loadProducts(); // Reload to update stock
+            await refreshAfterWrite(loadMovements, loadProducts); // Stock changes too
             closeModal('movementModal');
             showNotification('Movimiento registrado', 'success');
         } else {
@@ -971,7 +1321,8 @@ async function handleTransferSubmit(e) {
             quantity: parseFloat(formData.get('quantity'))
         }],
         responsible: formData.get('responsible'),
-        location_id: toLocationId ? parseInt(toLocationId) : null, // Usar locación destino como principal
+        from_location_id: fromLocationId ? parseInt(fromLocationId) : null, // Empty: unassigned stock
+        to_location_id: toLocationId ? parseInt(toLocationId) : null,
         observations: formData.get('observations')
     };
     
@@ -990,8 +1341,7 @@ async function handleTransferSubmit(e) {
         });
         
         if (response.ok) {
-            await loadMovements();
-            await loadProducts(); // Reload to update stock
+            await refreshAfterWrite(loadMovements, loadProducts); // Stock changes too
             closeModal('transferModal');
             showNotification('Transferencia registrada', 'success');
         } else {
@@ -1053,7 +1403,7 @@ async function deleteMovement(id) {
         });
         
         if (response.ok) {
-            await loadMovements();
+            await refreshAfterWrite(loadMovements);
             showNotification('Movimiento eliminado', 'success');
         } else {
             const error = await response.json();
@@ -1088,14 +1438,13 @@ async function handleEditMovementSubmit(e) {
     try {
         const response = await fetch(`${API_BASE_URL}/api/movimientos/${movementId}`, {
             method: 'PUT',
-            headers: {
-                'Content-Type': 'application/json'
-            },
+            headers: saveHeaders(movements, movementId),
             body: JSON.stringify(data)
         });
         
         if (response.ok) {
-            await loadMovements();
+            // A new location moves the movement's stock between locations
+            await refreshAfterWrite(loadMovements, loadProducts);
             closeModal('editMovementModal');
             showNotification('Movimiento actualizado', 'success');
         } else {
@@ -1109,6 +1458,19 @@ async function handleEditMovementSubmit(e) {
 }
 
 // Table rendering functions
+// Per-location breakdown shown under the total stock
+function renderLocationStock(product) {
+    const entries = Object.entries(product.location_stock || {});
+    if (entries.length === 0) {
+        return '';
+    }
+    const parts = entries.map(([locationId, quantity]) => {
+        const location = locations.find(l => l.id == locationId);
+        return `${location ? location.name : 'Desconocida'}: ${+quantity.toFixed(2)}`;
+    });
+    return `<div class="location-stock">${parts.join(' · ')}</div>`;
+}
+
 function renderProductsTable() {
     const tbody = document.querySelector('#productsTable tbody');
     tbody.innerHTML = '';
@@ -1133,7 +1495,7 @@ function renderProductsTable() {
         }
 
         const stockDisplay = product.has_stock !== false ? 
-            product.current_stock : 
+            `${product.current_stock}${renderLocationStock(product)}` : 
             `${product.current_stock} (valor actual)`;
 
         const minStockDisplay = product.has_stock !== false ? 
@@ -1300,26 +1662,7 @@ function renderMovementsTable() {
     const tbody = document.querySelector('#movementsTable tbody');
     tbody.innerHTML = '';
 
-    let filteredMovements = movements;
-    
-    // Apply filters
-    const typeFilter = document.getElementById('typeFilter').value;
-    const locationFilter = document.getElementById('locationFilter').value;
-    const dateFilter = document.getElementById('dateFilter').value;
-    
-    if (typeFilter) {
-        filteredMovements = filteredMovements.filter(m => m.type === typeFilter);
-    }
-    
-    if (locationFilter) {
-        filteredMovements = filteredMovements.filter(m => m.location.includes(locationFilter));
-    }
-    
-    if (dateFilter) {
-        filteredMovements = filteredMovements.filter(m => m.date.startsWith(dateFilter));
-    }
-
-    filteredMovements.forEach(movement => {
+    movements.forEach(movement => {
         const row = document.createElement('tr');
         const date = new Date(movement.date).toLocaleString();
         
@@ -1347,6 +1690,8 @@ function renderMovementsTable() {
         `;
         tbody.appendChild(row);
     });
+
+    document.getElementById('loadMoreMovements').style.display = movementsCursor ? '' : 'none';
 }
 
 // Post-it functions (keeping existing implementation)
@@ -1418,14 +1763,12 @@ async function handlePostitSubmit(e) {
         
         const response = await fetch(url, {
             method: method,
-            headers: {
-                'Content-Type': 'application/json'
-            },
+            headers: saveHeaders(postits, currentEditingId),
             body: JSON.stringify(data)
         });
         
         if (response.ok) {
-            await loadPostits();
+            await refreshAfterWrite(loadPostits);
             closeModal('postitModal');
             showNotification(currentEditingId ? 'Post-it actualizado' : 'Post-it creado', 'success');
         } else {
@@ -1456,7 +1799,7 @@ async function deletePostit(id) {
         });
         
         if (response.ok) {
-            await loadPostits();
+            await refreshAfterWrite(loadPostits);
             showNotification('Post-it eliminado', 'success');
         } else {
             const error = await response.json();
@@ -1520,7 +1863,7 @@ function renderImagesGallery() {
         const uploadedDate = new Date(image.uploaded_at).toLocaleDateString();
         
         imageDiv.innerHTML = `
-            <img src="${API_BASE_URL}/${image.file_path}" alt="${image.title}" class="image-preview" onclick="viewImage(${image.id})">
+            <img src="${imageVariantUrl(image, 'miniatura')}" alt="${image.title}" class="image-preview" loading="lazy" onclick="viewImage(${image.id})">
             <div class="image-info">
                 <div class="image-title">${image.title}</div>
                 <div class="image-comment">${image.comment || 'Sin comentario'}</div>
@@ -1550,19 +1893,72 @@ function getFileIcon(fileType) {
     return icons[fileType] || '📄';
 }
 
+// Files larger than one part go through the resumable upload: each part is
+// sent on its own and, if the connection drops, the upload continues from
+// the last byte the server received
+const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024;
+const UPLOAD_RETRIES = 3;
+
+async function uploadInParts(file) {
+    let response = await fetch(`${API_BASE_URL}/api/subidas`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, size: file.size })
+    });
+    const upload = await response.json();
+    if (!response.ok) {
+        throw new Error(upload.error || 'Error al iniciar la subida');
+    }
+
+    let offset = 0;
+    let retries = 0;
+    while (offset < file.size) {
+        try {
+            response = await fetch(`${API_BASE_URL}/api/subidas/${upload.id}?offset=${offset}`, {
+                method: 'PUT',
+                body: file.slice(offset, offset + UPLOAD_CHUNK_SIZE)
+            });
+            const state = await response.json();
+            // 409: the server answers with the offset to continue from
+            if (!response.ok && response.status !== 409) {
+                throw new Error(state.error);
+            }
+            offset = state.offset;
+            retries = 0;
+        } catch (error) {
+            if (++retries > UPLOAD_RETRIES) {
+                throw error;
+            }
+            const state = await (await fetch(`${API_BASE_URL}/api/subidas/${upload.id}`)).json();
+            offset = state.offset;
+        }
+    }
+    return upload.id;
+}
+
+// Replaces a large file in the form with the id of its resumable upload
+async function prepareUpload(formData, field) {
+    const file = formData.get(field);
+    if (file && file.size > UPLOAD_CHUNK_SIZE) {
+        formData.set('upload_id', await uploadInParts(file));
+        formData.delete(field);
+    }
+}
+
 async function handleFileUpload(e) {
     e.preventDefault();
     
     const formData = new FormData(e.target);
     
     try {
+        await prepareUpload(formData, 'file');
         const response = await fetch(`${API_BASE_URL}/api/recetas/upload`, {
             method: 'POST',
             body: formData
         });
         
         if (response.ok) {
-            await loadRecipes();
+            await refreshAfterWrite(loadRecipes);
             closeModal('uploadFileModal');
             showNotification('Archivo subido correctamente', 'success');
         } else {
@@ -1581,13 +1977,14 @@ async function handleImageUpload(e) {
     const formData = new FormData(e.target);
     
     try {
+        await prepareUpload(formData, 'image');
         const response = await fetch(`${API_BASE_URL}/api/recetas/imagenes/upload`, {
             method: 'POST',
             body: formData
         });
         
         if (response.ok) {
-            await loadRecipeImages();
+            await refreshAfterWrite(loadRecipeImages);
             closeModal('uploadImageModal');
             showNotification('Imagen subida correctamente', 'success');
         } else {
@@ -1615,7 +2012,7 @@ async function deleteRecipe(id) {
         });
         
         if (response.ok) {
-            await loadRecipes();
+            await refreshAfterWrite(loadRecipes);
             showNotification('Archivo eliminado', 'success');
         } else {
             const error = await response.json();
@@ -1627,12 +2024,20 @@ async function deleteRecipe(id) {
     }
 }
 
+// With the content hash in the URL the browser caches the variant for good
+function imageVariantUrl(image, variant) {
+    const version = image.blob ? `?v=${image.blob}` : '';
+    return `${API_BASE_URL}/api/recetas/imagenes/${image.id}/${variant}${version}`;
+}
+
 function viewImage(id) {
     const image = recipeImages.find(img => img.id === id);
     if (!image) return;
     
     document.getElementById('imageViewTitle').textContent = image.title;
-    document.getElementById('imageViewImg').src = `${API_BASE_URL}/${image.file_path}`;
+    // Screen-sized version; the original is only downloaded from the link
+    document.getElementById('imageViewImg').src = imageVariantUrl(image, 'web');
+    document.getElementById('imageViewOriginal').href = `${API_BASE_URL}/${image.file_path}`;
     document.getElementById('imageViewComment').textContent = image.comment || 'Sin comentario';
     document.getElementById('imageViewDate').textContent = `Subido: ${new Date(image.uploaded_at).toLocaleDateString()}`;
     
@@ -1656,14 +2061,12 @@ async function updateImage(id, data) {
     try {
         const response = await fetch(`${API_BASE_URL}/api/recetas/imagenes/${id}`, {
             method: 'PUT',
-            headers: {
-                'Content-Type': 'application/json'
-            },
+            headers: saveHeaders(recipeImages, id),
             body: JSON.stringify(data)
         });
         
         if (response.ok) {
-            await loadRecipeImages();
+            await refreshAfterWrite(loadRecipeImages);
             showNotification('Imagen actualizada', 'success');
         } else {
             const error = await response.json();
@@ -1686,7 +2089,7 @@ async function deleteImage(id) {
         });
         
         if (response.ok) {
-            await loadRecipeImages();
+            await refreshAfterWrite(loadRecipeImages);
             showNotification('Imagen eliminada', 'success');
         } else {
             const error = await response.json();
@@ -1699,126 +2102,115 @@ async function deleteImage(id) {
 }
 
 // Chart loading functions (keeping existing implementation)
-async function loadAllCharts() {
-    await Promise.all([
-        loadDashboardCharts(),
-        loadProductCharts(),
-        loadStageCharts(),
-        loadSubstageCharts(),
-        loadLocationCharts()
-    ]);
+// Charts used by each section; every section is fetched with a single
+// request to /api/graficos/bundle instead of one request per chart.
+const DASHBOARD_CHARTS = ['consumo-producto', 'stock-productos', 'consumo-locacion', 'consumo-etapa',
+    'gastos-etapa', 'gastos-locacion', 'tiempo-etapas', 'tiempo-sub-etapas', 'tiempo-locacion'];
+const PRODUCT_CHARTS = ['consumo-producto', 'stock-productos', 'consumo-locacion', 'consumo-etapa',
+    'consumo-producto-subetapa', 'consumo-mensual-producto', 'gasto-mensual-producto',
+    'consumo-anual-producto', 'gasto-anual-producto'];
+const STAGE_CHARTS = ['gastos-etapa', 'tiempo-etapas', 'consumo-etapa'];
+const SUBSTAGE_CHARTS = ['tiempo-sub-etapas', 'consumo-sub-etapas', 'gasto-subetapa'];
+const LOCATION_CHARTS = ['gastos-locacion', 'consumo-locacion', 'tiempo-locacion', 'consumo-mensual-locacion',
+    'gasto-mensual-locacion', 'consumo-anual-locacion', 'gasto-anual-locacion'];
+
+async function fetchChartBundle(names) {
+    const response = await fetch(`${API_BASE_URL}/api/graficos/bundle?graficos=${names.join(',')}`);
+    if (!response.ok) {
+        const error = await response.json();
+        throw new Error(error.error || 'Error al cargar gráficos');
+    }
+    return response.json();
 }
 
-async function loadDashboardCharts() {
+async function loadAllCharts() {
     try {
-        const [consumption, stock, locationConsumption, stageConsumption, stageExpenses, locationExpenses, stageTime, substageTime, locationTime] = await Promise.all([
-            fetch(`${API_BASE_URL}/api/graficos/consumo-producto`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/stock-productos`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/consumo-locacion`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/consumo-etapa`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/gastos-etapa`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/gastos-locacion`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/tiempo-etapas`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/tiempo-sub-etapas`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/tiempo-locacion`).then(r => r.json())
+        const names = [...new Set([...DASHBOARD_CHARTS, ...PRODUCT_CHARTS, ...STAGE_CHARTS,
+            ...SUBSTAGE_CHARTS, ...LOCATION_CHARTS])];
+        const charts = await fetchChartBundle(names);
+        await Promise.all([
+            loadDashboardCharts(charts),
+            loadProductCharts(charts),
+            loadStageCharts(charts),
+            loadSubstageCharts(charts),
+            loadLocationCharts(charts)
         ]);
+    } catch (error) {
+        console.error('Error loading charts:', error);
+    }
+}
 
-        createConsumptionChart('dashboardConsumptionChart', consumption);
-        createStockChart('dashboardStockChart', stock);
-        createLocationConsumptionChart('dashboardLocationChart', locationConsumption);
-        createStageConsumptionChart('dashboardStageChart', stageConsumption);
-        createExpensesChart('dashboardExpensesChart', stageExpenses);
-        createExpensesChart('dashboardLocationExpensesChart', locationExpenses);
-        createTimeComparisonChart('dashboardStageTimeChart', stageTime);
-        createTimeComparisonChart('dashboardSubstageTimeChart', substageTime);
-        createLocationTimeChart('dashboardLocationTimeChart', locationTime);
+async function loadDashboardCharts(charts = null) {
+    try {
+        const data = charts || await fetchChartBundle(DASHBOARD_CHARTS);
+
+        createConsumptionChart('dashboardConsumptionChart', data['consumo-producto']);
+        createStockChart('dashboardStockChart', data['stock-productos']);
+        createLocationConsumptionChart('dashboardLocationChart', data['consumo-locacion']);
+        createStageConsumptionChart('dashboardStageChart', data['consumo-etapa']);
+        createExpensesChart('dashboardExpensesChart', data['gastos-etapa']);
+        createExpensesChart('dashboardLocationExpensesChart', data['gastos-locacion']);
+        createTimeComparisonChart('dashboardStageTimeChart', data['tiempo-etapas']);
+        createTimeComparisonChart('dashboardSubstageTimeChart', data['tiempo-sub-etapas']);
+        createLocationTimeChart('dashboardLocationTimeChart', data['tiempo-locacion']);
     } catch (error) {
         console.error('Error loading dashboard charts:', error);
     }
 }
 
-async function loadProductCharts() {
+async function loadProductCharts(charts = null) {
     try {
-        const [consumption, stock, locationConsumption, stageConsumption, 
-               productSubstageConsumption, monthlyConsumption, monthlyExpense,
-               yearlyConsumption, yearlyExpense] = await Promise.all([
-            fetch(`${API_BASE_URL}/api/graficos/consumo-producto`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/stock-productos`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/consumo-locacion`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/consumo-etapa`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/consumo-producto-subetapa`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/consumo-mensual-producto`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/gasto-mensual-producto`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/consumo-anual-producto`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/gasto-anual-producto`).then(r => r.json())
-        ]);
-
-        createConsumptionChart('productConsumptionChart', consumption);
-        createStockChart('productStockChart', stock);
-        createLocationConsumptionChart('productLocationChart', locationConsumption);
-        createStageConsumptionChart('productStageChart', stageConsumption);
-        createProductSubstageChart('productSubstageChart', productSubstageConsumption);
-        createMonthlyConsumptionChart('productMonthlyConsumptionChart', monthlyConsumption);
-        createMonthlyExpenseChart('productMonthlyExpenseChart', monthlyExpense);
-        createYearlyConsumptionChart('productYearlyConsumptionChart', yearlyConsumption);
-        createYearlyExpenseChart('productYearlyExpenseChart', yearlyExpense);
+        const data = charts || await fetchChartBundle(PRODUCT_CHARTS);
+
+        createConsumptionChart('productConsumptionChart', data['consumo-producto']);
+        createStockChart('productStockChart', data['stock-productos']);
+        createLocationConsumptionChart('productLocationChart', data['consumo-locacion']);
+        createStageConsumptionChart('productStageChart', data['consumo-etapa']);
+        createProductSubstageChart('productSubstageChart', data['consumo-producto-subetapa']);
+        createMonthlyConsumptionChart('productMonthlyConsumptionChart', data['consumo-mensual-producto']);
+        createMonthlyExpenseChart('productMonthlyExpenseChart', data['gasto-mensual-producto']);
+        createYearlyConsumptionChart('productYearlyConsumptionChart', data['consumo-anual-producto']);
+        createYearlyExpenseChart('productYearlyExpenseChart', data['gasto-anual-producto']);
     } catch (error) {
         console.error('Error loading product charts:', error);
     }
 }
 
-async function loadStageCharts() {
+async function loadStageCharts(charts = null) {
     try {
-        const [expenses, timeComparison, stageConsumption] = await Promise.all([
-            fetch(`${API_BASE_URL}/api/graficos/gastos-etapa`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/tiempo-etapas`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/consumo-etapa`).then(r => r.json())
-        ]);
+        const data = charts || await fetchChartBundle(STAGE_CHARTS);
 
-        createExpensesChart('stageExpensesChart', expenses);
-        createTimeComparisonChart('stageTimeChart', timeComparison);
-        createStageConsumptionChart('stageConsumptionChart', stageConsumption);
+        createExpensesChart('stageExpensesChart', data['gastos-etapa']);
+        createTimeComparisonChart('stageTimeChart', data['tiempo-etapas']);
+        createStageConsumptionChart('stageConsumptionChart', data['consumo-etapa']);
     } catch (error) {
         console.error('Error loading stage charts:', error);
     }
 }
 
-async function loadSubstageCharts() {
+async function loadSubstageCharts(charts = null) {
     try {
-        const [timeComparison, consumption, substageExpenses] = await Promise.all([
-            fetch(`${API_BASE_URL}/api/graficos/tiempo-sub-etapas`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/consumo-sub-etapas`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/gasto-subetapa`).then(r => r.json())
-        ]);
+        const data = charts || await fetchChartBundle(SUBSTAGE_CHARTS);
         
-        createTimeComparisonChart('substageTimeChart', timeComparison);
-        createSubstageConsumptionChart('substageConsumptionChart', consumption);
-        createSubstageExpenseChart('substageExpenseChart', substageExpenses);
+        createTimeComparisonChart('substageTimeChart', data['tiempo-sub-etapas']);
+        createSubstageConsumptionChart('substageConsumptionChart', data['consumo-sub-etapas']);
+        createSubstageExpenseChart('substageExpenseChart', data['gasto-subetapa']);
     } catch (error) {
         console.error('Error loading substage charts:', error);
     }
 }
 
-async function loadLocationCharts() {
+async function loadLocationCharts(charts = null) {
     try {
-        const [expenses, consumption, timeComparison, monthlyConsumption, 
-               monthlyExpense, yearlyConsumption, yearlyExpense] = await Promise.all([
-            fetch(`${API_BASE_URL}/api/graficos/gastos-locacion`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/consumo-locacion`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/tiempo-locacion`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/consumo-mensual-locacion`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/gasto-mensual-locacion`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/consumo-anual-locacion`).then(r => r.json()),
-            fetch(`${API_BASE_URL}/api/graficos/gasto-anual-locacion`).then(r => r.json())
-        ]);
-
-        createExpensesChart('locationExpensesChart', expenses);
-        createLocationConsumptionChart('locationConsumptionChart', consumption);
-        createLocationTimeChart('locationTimeChart', timeComparison);
-        createMonthlyLocationConsumptionChart('locationMonthlyConsumptionChart', monthlyConsumption);
-        createMonthlyLocationExpenseChart('locationMonthlyExpenseChart', monthlyExpense);
-        createYearlyLocationConsumptionChart('locationYearlyConsumptionChart', yearlyConsumption);
-        createYearlyLocationExpenseChart('locationYearlyExpenseChart', yearlyExpense);
+        const data = charts || await fetchChartBundle(LOCATION_CHARTS);
+
+        createExpensesChart('locationExpensesChart', data['gastos-locacion']);
+        createLocationConsumptionChart('locationConsumptionChart', data['consumo-locacion']);
+        createLocationTimeChart('locationTimeChart', data['tiempo-locacion']);
+        createMonthlyLocationConsumptionChart('locationMonthlyConsumptionChart', data['consumo-mensual-locacion']);
+        createMonthlyLocationExpenseChart('locationMonthlyExpenseChart', data['gasto-mensual-locacion']);
+        createYearlyLocationConsumptionChart('locationYearlyConsumptionChart', data['consumo-anual-locacion']);
+        createYearlyLocationExpenseChart('locationYearlyExpenseChart', data['gasto-anual-locacion']);
     } catch (error) {
         console.error('Error loading location charts:', error);
     }
@@ -2743,10 +3135,8 @@ function updateLocationSelects() {
         
         // Determinar el texto de la opción por defecto según el select
         let defaultText = 'Seleccionar locación';
-        if (select.id === 'transferFromLocation') {
-            defaultText = 'Seleccionar locación origen';
-        } else if (select.id === 'transferToLocation') {
-            defaultText = 'Seleccionar locación destino';
+        if (select.id === 'transferFromLocation' || select.id === 'transferToLocation') {
+            defaultText = 'Sin asignar (stock general)';
         }
         
         select.innerHTML = `<option value="">${defaultText}</option>`;
@@ -2823,11 +3213,10 @@ function updateLocationFilter() {
     const currentValue = filter.value;
     filter.innerHTML = '<option value="">Todas las locaciones</option>';
     
-    const uniqueLocations = [...new Set(movements.map(m => m.location))];
-    uniqueLocations.forEach(location => {
+    locations.forEach(location => {
         const option = document.createElement('option');
-        option.value = location;
-        option.textContent = location;
+        option.value = location.id;
+        option.textContent = location.name;
         filter.appendChild(option);
     });
     
@@ -2864,14 +3253,14 @@ function updateTransferUnit() {
 
 // Filter functions
 function applyFilters() {
-    renderMovementsTable();
+    loadMovements();
 }
 
 function clearFilters() {
     document.getElementById('typeFilter').value = '';
     document.getElementById('locationFilter').value = '';
     document.getElementById('dateFilter').value = '';
-    renderMovementsTable();
+    loadMovements();
 }
 
 // Product row management
@@ -2964,25 +3353,50 @@ function showNotification(message, type = 'info') {
     }, 3000);
 }
 
-// Export function
+// Export function: the workbook is built by a background job; poll its
+// status and download the finished file from disk
+const JOB_POLL_INTERVAL = 1000;
+
 async function exportToExcel() {
     try {
-        const response = await fetch(`${API_BASE_URL}/api/exportar-excel`);
-        
-        if (response.ok) {
-            const blob = await response.blob();
-            const url = window.URL.createObjectURL(blob);
-            const a = document.createElement('a');
-            a.href = url;
-            a.download = `inventario_cultivo_${new Date().toISOString().split('T')[0]}.xlsx`;
-            document.body.appendChild(a);
-            a.click();
-            window.URL.revokeObjectURL(url);
-            document.body.removeChild(a);
-            showNotification('Archivo Excel descargado', 'success');
-        } else {
+        const response = await fetch(`${API_BASE_URL}/api/trabajos`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ tipo: 'excel' })
+        });
+        if (!response.ok) {
+            // 503: the job queue is full; the server says when to retry
+            const error = await response.json().catch(() => ({}));
+            showNotification(error.error || 'Error al exportar Excel', 'error');
+            return;
+        }
+
+        let job = await response.json();
+        if (job.status !== 'done') {
+            showNotification('Generando archivo Excel...', 'info');
+        }
+        while (job.status === 'pending' || job.status === 'running') {
+            await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL));
+            const poll = await fetch(`${API_BASE_URL}/api/trabajos/${job.id}`);
+            if (!poll.ok) {
+                showNotification('Error al exportar Excel', 'error');
+                return;
+            }
+            job = await poll.json();
+        }
+        if (job.status !== 'done') {
+            console.error('Export job failed:', job.error);
             showNotification('Error al exportar Excel', 'error');
+            return;
         }
+
+        const a = document.createElement('a');
+        a.href = `${API_BASE_URL}/api/trabajos/${job.id}/archivo`;
+        a.download = job.filename;
+        document.body.appendChild(a);
+        a.click();
+        document.body.removeChild(a);
+        showNotification('Archivo Excel descargado', 'success');
     } catch (error) {
         console.error('Error exporting Excel:', error);
         showNotification('Error al exportar Excel', 'error');
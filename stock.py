@@ -0,0 +1,267 @@
+"""Stock por locación.
+
+Cada producto guarda en ``location_stock`` cuánto de su ``current_stock``
+está en cada locación (``{"<location_id>": cantidad}``, claves de texto como
+en JSON); el resto es stock sin asignar. Se mantiene ``cantidad > 0`` y
+``sum(location_stock) <= current_stock``, así que el stock sin asignar nunca
+es negativo.
+
+Las funciones trabajan sobre un "estado" (copia de los campos de stock de un
+producto) para poder validar un lote completo antes de escribir.
+
+``StockHistory`` responde el stock total de un producto a una fecha pasada
+a partir de los movimientos posteriores.
+"""
+from bisect import bisect_left
+
+import numpy as np
+
+from ledger import MISSING
+
+# Cantidades menores se consideran cero (errores de redondeo)
+EPSILON = 1e-9
+
+
+def location_key(location_id):
+    """Clave de ``location_stock`` de una locación (``None``: sin asignar)"""
+    return None if location_id is None else str(location_id)
+
+
+def stock_state(product):
+    """Copia de los campos de stock de un producto"""
+    return {
+        'current_stock': product['current_stock'],
+        'location_stock': dict(product.get('location_stock') or {})
+    }
+
+
+def copy_state(state):
+    return {'current_stock': state['current_stock'], 'location_stock': dict(state['location_stock'])}
+
+
+def unassigned(state):
+    """Stock que no está en ninguna locación"""
+    return max(state['current_stock'] - sum(state['location_stock'].values()), 0)
+
+
+def available(state, location):
+    """Stock que puede salir de ``location`` (``None``: sin asignar)"""
+    if location is None:
+        return unassigned(state)
+    return state['location_stock'].get(location, 0)
+
+
+def add(state, location, quantity):
+    """Ingreso de stock (compra) en ``location``"""
+    state['current_stock'] += quantity
+    if location is not None:
+        balances = state['location_stock']
+        balances[location] = balances.get(location, 0) + quantity
+
+
+def remove(state, location, quantity):
+    """Egreso de stock (uso).
+
+    Sale primero de ``location``, después del stock sin asignar y, si no
+    alcanza, de las demás locaciones.
+    """
+    balances = state['location_stock']
+    if location in balances:
+        balances[location] -= min(balances[location], quantity)
+    state['current_stock'] = max(state['current_stock'] - quantity, 0)
+    fit(state)
+
+
+def transfer(state, source, target, quantity):
+    """Mueve ``quantity`` de ``source`` a ``target`` sin cambiar el total"""
+    balances = state['location_stock']
+    if source is not None:
+        balances[source] = balances.get(source, 0) - quantity
+    if target is not None:
+        balances[target] = balances.get(target, 0) + quantity
+    fit(state)
+
+
+def fit(state):
+    """Ajusta las locaciones para que no sumen más que ``current_stock``.
+
+    El exceso (por ejemplo, si se corrige el stock a mano) se descuenta de
+    las locaciones en orden de ID; se descartan los saldos en cero.
+    """
+    balances = state['location_stock']
+    excess = sum(balances.values()) - state['current_stock']
+    if excess > EPSILON:
+        for location in sorted(balances, key=int):
+            taken = min(balances[location], excess)
+            balances[location] -= taken
+            excess -= taken
+            if excess <= EPSILON:
+                break
+    state['location_stock'] = {location: quantity for location, quantity in balances.items()
+                               if quantity > EPSILON}
+
+
+def drop_location(state, location):
+    """Devuelve al stock sin asignar el saldo de una locación eliminada"""
+    state['location_stock'].pop(location, None)
+
+
+def stock_delta(movement, quantity):
+    """Cambio del stock total que produce una línea de un movimiento"""
+    if movement['type'] == 'compra':
+        return quantity
+    if movement['type'] == 'uso':
+        return -quantity
+    if movement['type'] == 'transferencia' and 'from_location_id' not in movement:
+        # Transferencias registradas antes del stock por locación: descontaban
+        return -quantity
+    return 0
+
+
+class StockHistory:
+    """Cambios de stock de cada producto ordenados por fecha.
+
+    Por producto se guardan las entradas ``(micros, movement_id, línea)`` con
+    su cambio de stock y, cada ``CHECKPOINT`` entradas, la suma acumulada
+    hasta ahí. La suma hasta una fecha se obtiene con una búsqueda binaria
+    más, como máximo, ``CHECKPOINT`` sumas desde el checkpoint anterior.
+
+    El stock a una fecha es el actual menos los cambios posteriores; las
+    correcciones manuales de stock no son movimientos y no se reflejan.
+    """
+
+    CHECKPOINT = 256
+
+    def __init__(self, movements, timestamps, ledger=None):
+        self.movements = movements
+        self.timestamps = timestamps
+        self.ledger = ledger
+        # product_id -> [claves, cambios, checkpoints]
+        self._series = {}
+        self.stale = True
+        movements.subscribe(self.on_change)
+
+    def rebuild(self):
+        if self.ledger is not None:
+            self.rebuild_from_ledger()
+            return
+        entries = {}
+        for movement in self.movements:
+            for product_id, key, delta in self._entries(movement):
+                entries.setdefault(product_id, []).append((key, delta))
+        self._series = {}
+        for product_id, items in entries.items():
+            items.sort()
+            self._series[product_id] = [[key for key, _ in items], [delta for _, delta in items], [0]]
+        self.stale = False
+
+    def rebuild_from_ledger(self):
+        """Arma las series ordenando las columnas del libro (sin recorrer dicts)"""
+        parts = []
+        for movement_type, sign in (('compra', 1), ('uso', -1), ('transferencia', -1)):
+            rows = self.ledger.select(('product_id', 'timestamp', 'movement_id', 'index', 'quantity'),
+                                      type=movement_type, line=True)
+            if movement_type == 'transferencia' and len(rows['movement_id']):
+                # Solo las transferencias anteriores al stock por locación cambian el total
+                legacy = []
+                for movement_id in np.unique(rows['movement_id']).tolist():
+                    movement = self.movements.get(movement_id)
+                    if movement is not None and 'from_location_id' not in movement:
+                        legacy.append(movement_id)
+                keep = np.isin(rows['movement_id'], legacy)
+                rows = {name: column[keep] for name, column in rows.items()}
+            rows['quantity'] = rows['quantity'] * sign
+            parts.append(rows)
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+        keep = (columns['product_id'] != MISSING) & (columns['quantity'] != 0)
+        columns = {name: column[keep] for name, column in columns.items()}
+        order = np.lexsort((columns['index'], columns['movement_id'], columns['timestamp'], columns['product_id']))
+        columns = {name: column[order] for name, column in columns.items()}
+
+        self._series = {}
+        self.stale = False
+        product_ids = columns['product_id']
+        if not len(product_ids):
+            return
+        # Cada producto ocupa un tramo contiguo de las columnas ordenadas
+        starts = np.flatnonzero(np.r_[True, product_ids[1:] != product_ids[:-1]])
+        stops = np.r_[starts[1:], len(product_ids)]
+        for start, stop in zip(starts, stops):
+            keys = list(zip(columns['timestamp'][start:stop].tolist(), columns['movement_id'][start:stop].tolist(),
+                            columns['index'][start:stop].tolist()))
+            self._series[int(product_ids[start])] = [keys, columns['quantity'][start:stop].tolist(), [0]]
+
+    def on_change(self, op, old, new):
+        if op == 'reset':
+            self.stale = True
+            return
+        if self.stale:
+            return
+        if old is not None and new is not None and self._key(old) == self._key(new):
+            return
+        if old is not None:
+            for product_id, key, _ in self._entries(old):
+                self._remove(product_id, key)
+        if new is not None:
+            for product_id, key, delta in self._entries(new):
+                self._insert(product_id, key, delta)
+
+    @staticmethod
+    def _key(movement):
+        return (movement.get('date'), movement['type'], 'from_location_id' in movement,
+                [(line['product_id'], line['quantity']) for line in movement['products']])
+
+    def _entries(self, movement):
+        micros = self.timestamps.period(movement).micros
+        for index, line in enumerate(movement['products']):
+            delta = stock_delta(movement, line['quantity'])
+            if delta:
+                yield line['product_id'], (micros, movement['id'], index), delta
+
+    def _insert(self, product_id, key, delta):
+        keys, deltas, checkpoints = self._series.setdefault(product_id, [[], [], [0]])
+        position = bisect_left(keys, key)
+        keys.insert(position, key)
+        deltas.insert(position, delta)
+        # Los checkpoints posteriores a la posición quedan desactualizados
+        del checkpoints[position // self.CHECKPOINT + 1:]
+
+    def _remove(self, product_id, key):
+        series = self._series.get(product_id)
+        if series is None:
+            return
+        keys, deltas, checkpoints = series
+        position = bisect_left(keys, key)
+        if position < len(keys) and keys[position] == key:
+            del keys[position]
+            del deltas[position]
+            del checkpoints[position // self.CHECKPOINT + 1:]
+
+    def _prefix(self, series, count):
+        """Suma de los primeros ``count`` cambios"""
+        _, deltas, checkpoints = series
+        block = count // self.CHECKPOINT
+        size = self.CHECKPOINT
+        while len(checkpoints) <= block:
+            done = len(checkpoints)
+            checkpoints.append(checkpoints[-1] + sum(deltas[(done - 1) * size:done * size]))
+        return checkpoints[block] + sum(deltas[block * size:count])
+
+    def change_after(self, product_id, micros):
+        """Suma de los cambios de stock del producto desde ``micros`` (inclusive)"""
+        with self.movements.store.lock:
+            if self.stale:
+                self.rebuild()
+            series = self._series.get(product_id)
+            if series is None:
+                return 0
+            position = bisect_left(series[0], (micros,))
+            return self._prefix(series, len(series[0])) - self._prefix(series, position)
+
+    def stats(self):
+        with self.movements.store.lock:
+            return {
+                'products': len(self._series),
+                'entries': sum(len(series[0]) for series in self._series.values()),
+                'checkpoints': sum(len(series[2]) for series in self._series.values())
+            }
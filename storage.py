@@ -0,0 +1,720 @@
+"""Backends de persistencia para las colecciones del almacén.
+
+- ``MemoryBackend``: sin persistencia; los datos iniciales viven solo en el
+  proceso (comportamiento original, útil para desarrollo).
+- ``SQLiteBackend``: base de datos SQLite (stdlib) compartida por todos los
+  workers de gunicorn. Los movimientos tienen tablas propias indexadas por
+  fecha, producto, etapa, sub-etapa y locación, y el listado paginado se
+  consulta ahí mientras la colección no está en memoria
+  (``movements_descending``); el resto de las colecciones se guarda como
+  documentos JSON.
+- ``JournalBackend``: los datos viven en memoria y cada escritura agrega un
+  registro compacto a un journal en disco; un hilo en segundo plano escribe
+  snapshots compactados. Pensado para un único proceso (``gunicorn -w 1``).
+
+Cada escritura devuelve un número de secuencia global y ``load`` devuelve
+las filas junto con la última secuencia que reflejan. En SQLite esas
+secuencias quedan en ``changelog`` para que cada worker aplique los cambios
+hechos por los demás (ver ``store.Store.sync``).
+
+``instance_id`` distingue una base de otra (o un proceso de otro, si no hay
+persistencia) para que las versiones no se confundan entre reinicios.
+"""
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class MemoryBackend:
+    """Backend sin persistencia"""
+
+    # Ningún otro proceso escribe: no hace falta sincronizar
+    shared = False
+    # Sin transacciones: lo escrito no se puede deshacer
+    transactional = False
+    # Los movimientos solo se consultan en memoria (ver ``SQLiteBackend.movements_descending``)
+    movement_queries = False
+
+    def __init__(self):
+        self._seq = 0
+        self._next_ids = {}
+        self.instance_id = uuid.uuid4().hex[:12]
+
+    def load(self, name, seed):
+        rows = list(seed)
+        self._next_ids.setdefault(name, max((row['id'] for row in rows), default=0) + 1)
+        return rows, self._seq
+
+    def allocate_id(self, name, count=1):
+        row_id = self._next_ids[name]
+        self._next_ids[name] = row_id + count
+        return row_id
+
+    def _write(self, name, row_id):
+        if row_id >= self._next_ids.get(name, 1):
+            self._next_ids[name] = row_id + 1
+        self._seq += 1
+        return self._seq
+
+    def insert(self, name, row):
+        return self._write(name, row['id'])
+
+    def insert_many(self, name, rows):
+        return self._write(name, max(row['id'] for row in rows))
+
+    def update(self, name, row, changes):
+        return self._write(name, row['id'])
+
+    def delete(self, name, row_id):
+        return self._write(name, row_id)
+
+    def last_seq(self):
+        return self._seq
+
+    def changes_since(self, seq):
+        return []
+
+    def fetch(self, name, row_id):
+        return None
+
+    @contextmanager
+    def transaction(self):
+        yield
+
+    def stats(self):
+        return {'backend': 'memory', 'last_seq': self._seq}
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend:
+    """Backend SQLite compartido entre procesos"""
+
+    shared = True
+    transactional = True
+    # Los movimientos tienen tablas indexadas: se consultan sin cargarlos en memoria
+    movement_queries = True
+
+    # Cantidad de entradas de changelog que se conservan
+    CHANGELOG_RETENTION = 10000
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS collections (
+            name TEXT PRIMARY KEY,
+            next_id INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS entities (
+            collection TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (collection, id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS movements (
+            id INTEGER PRIMARY KEY,
+            date TEXT NOT NULL,
+            type TEXT NOT NULL,
+            stage_id INTEGER,
+            substage_id INTEGER,
+            location_id INTEGER,
+            responsible TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_movements_date ON movements (date, id);
+        CREATE INDEX IF NOT EXISTS idx_movements_stage ON movements (stage_id, date);
+        CREATE INDEX IF NOT EXISTS idx_movements_substage ON movements (substage_id, date);
+        CREATE INDEX IF NOT EXISTS idx_movements_location ON movements (location_id, date);
+        CREATE TABLE IF NOT EXISTS movement_lines (
+            movement_id INTEGER NOT NULL REFERENCES movements (id) ON DELETE CASCADE,
+            product_id INTEGER NOT NULL,
+            quantity REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_movement_lines_product ON movement_lines (product_id, movement_id);
+        CREATE INDEX IF NOT EXISTS idx_movement_lines_movement ON movement_lines (movement_id);
+        CREATE TABLE IF NOT EXISTS changelog (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            collection TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            op TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute('PRAGMA journal_mode=WAL')
+        has_lines = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'movement_lines'").fetchone()
+        conn.executescript(self.SCHEMA)
+        with self.transaction() as conn:
+            if not has_lines:
+                # Bases creadas sin ``movement_lines``: se completa desde los movimientos
+                conn.execute(
+                    "INSERT INTO movement_lines (movement_id, product_id, quantity) "
+                    "SELECT movements.id, json_extract(line.value, '$.product_id'), "
+                    "COALESCE(json_extract(line.value, '$.quantity'), 0) "
+                    "FROM movements, json_each(movements.data, '$.products') AS line "
+                    "WHERE json_extract(line.value, '$.product_id') IS NOT NULL")
+            instance_id = self._meta(conn, 'instance_id')
+            if not instance_id:
+                instance_id = uuid.uuid4().int >> 65
+                conn.execute("INSERT INTO meta (key, value) VALUES ('instance_id', ?)", (instance_id,))
+        self.instance_id = '%x' % instance_id
+
+    def _connection(self):
+        # sqlite3 no permite compartir conexiones entre hilos
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA foreign_keys=ON')
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Transacción de escritura; las anidadas se unen a la externa"""
+        conn = self._connection()
+        if self._local.depth == 0:
+            conn.execute('BEGIN IMMEDIATE')
+        self._local.depth += 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute('ROLLBACK')
+            raise
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            conn.execute('COMMIT')
+
+    # Lectura
+
+    def load(self, name, seed):
+        """Filas de una colección; la primera vez la inicializa con ``seed``"""
+        with self.transaction() as conn:
+            # Dentro de la transacción nadie más escribe: la secuencia
+            # corresponde exactamente a las filas leídas
+            seq = self._last_seq(conn)
+            initialized = conn.execute(
+                'SELECT 1 FROM collections WHERE name = ?', (name,)).fetchone()
+            if not initialized:
+                seed = list(seed)
+                for row in seed:
+                    self._put(conn, name, row)
+                next_id = max((row['id'] for row in seed), default=0) + 1
+                conn.execute('INSERT INTO collections (name, next_id) VALUES (?, ?)', (name, next_id))
+                return seed, seq
+            if name == 'movements':
+                cursor = conn.execute('SELECT data FROM movements ORDER BY id')
+            else:
+                cursor = conn.execute(
+                    'SELECT data FROM entities WHERE collection = ? ORDER BY id', (name,))
+            return [json.loads(data) for (data,) in cursor], seq
+
+    def fetch(self, name, row_id):
+        conn = self._connection()
+        if name == 'movements':
+            found = conn.execute('SELECT data FROM movements WHERE id = ?', (row_id,)).fetchone()
+        else:
+            found = conn.execute(
+                'SELECT data FROM entities WHERE collection = ? AND id = ?', (name, row_id)).fetchone()
+        return json.loads(found[0]) if found else None
+
+    # Columnas de ``movements`` por las que se puede filtrar en ``movements_descending``
+    MOVEMENT_COLUMNS = ('type', 'stage_id', 'substage_id', 'location_id', 'responsible')
+
+    def movements_descending(self, filters, before=None, lower=None, upper=None, batch=500):
+        """Movimientos de la base en orden descendente por ``(fecha, id)``, sin cargar la colección.
+
+        ``filters`` es ``{columna: valor}`` (``MOVEMENT_COLUMNS`` o
+        ``product_id``); ``before``, ``lower`` y ``upper`` son como en
+        ``SortedIndex.descending``. Se leen de a ``batch`` filas con un cursor
+        ``(fecha, id)``, así que se puede dejar de iterar en cualquier momento.
+        """
+        conditions = []
+        params = []
+        for name, value in filters.items():
+            if name == 'product_id':
+                conditions.append('id IN (SELECT movement_id FROM movement_lines WHERE product_id = ?)')
+            elif name in self.MOVEMENT_COLUMNS:
+                conditions.append(f'{name} = ?')
+            else:
+                raise ValueError(f"Filtro de movimientos desconocido: {name}")
+            params.append(value)
+        if lower is not None:
+            conditions.append('date >= ?')
+            params.append(lower)
+        if upper is not None:
+            conditions.append('date <= ?')
+            params.append(upper)
+        conn = self._connection()
+        while True:
+            page = conditions
+            page_params = params
+            if before is not None:
+                page = conditions + ['date <= ?', '(date < ? OR id < ?)']
+                page_params = params + [before[0], before[0], before[1]]
+            where = f"WHERE {' AND '.join(page)}" if page else ''
+            rows = conn.execute(f'SELECT date, id, data FROM movements {where} '
+                                f'ORDER BY date DESC, id DESC LIMIT ?', page_params + [batch]).fetchall()
+            for date, row_id, data in rows:
+                yield json.loads(data)
+            if len(rows) < batch:
+                return
+            before = (date, row_id)
+
+    def last_seq(self):
+        return self._last_seq(self._connection())
+
+    def _last_seq(self, conn):
+        found = conn.execute('SELECT MAX(seq) FROM changelog').fetchone()[0]
+        if found is None:
+            found = self._meta(conn, 'pruned_seq')
+        return found
+
+    def changes_since(self, seq):
+        """Cambios posteriores a ``seq``; ``None`` si ya fueron depurados"""
+        conn = self._connection()
+        if seq < self._meta(conn, 'pruned_seq'):
+            return None
+        return conn.execute(
+            'SELECT seq, collection, row_id, op FROM changelog WHERE seq > ? ORDER BY seq',
+            (seq,)).fetchall()
+
+    # Escritura
+
+    def allocate_id(self, name, count=1):
+        with self.transaction() as conn:
+            row_id = conn.execute(
+                'SELECT next_id FROM collections WHERE name = ?', (name,)).fetchone()[0]
+            conn.execute('UPDATE collections SET next_id = ? WHERE name = ?', (row_id + count, name))
+            return row_id
+
+    def insert(self, name, row):
+        with self.transaction() as conn:
+            self._put(conn, name, row)
+            conn.execute('UPDATE collections SET next_id = MAX(next_id, ?) WHERE name = ?',
+                         (row['id'] + 1, name))
+            return self._log(conn, name, row['id'], 'insert')
+
+    def insert_many(self, name, rows):
+        """Inserta filas nuevas en bloque.
+
+        El changelog registra una recarga de la colección (``reload``) en
+        lugar de un cambio por fila.
+        """
+        with self.transaction() as conn:
+            if name != 'movements':
+                conn.executemany('INSERT INTO entities (collection, id, data) VALUES (?, ?, ?)',
+                                 [(name, row['id'], json.dumps(row, ensure_ascii=False)) for row in rows])
+            else:
+                conn.executemany(self.INSERT_MOVEMENT, [self._movement_values(row) for row in rows])
+                conn.executemany(self.INSERT_LINE, [(row['id'], line['product_id'], line['quantity'])
+                                                    for row in rows for line in row.get('products', [])])
+            conn.execute('UPDATE collections SET next_id = MAX(next_id, ?) WHERE name = ?',
+                         (max(row['id'] for row in rows) + 1, name))
+            return self._log(conn, name, 0, 'reload')
+
+    def update(self, name, row, changes):
+        with self.transaction() as conn:
+            self._put(conn, name, row)
+            return self._log(conn, name, row['id'], 'update')
+
+    def delete(self, name, row_id):
+        with self.transaction() as conn:
+            if name == 'movements':
+                conn.execute('DELETE FROM movements WHERE id = ?', (row_id,))
+            else:
+                conn.execute('DELETE FROM entities WHERE collection = ? AND id = ?', (name, row_id))
+            return self._log(conn, name, row_id, 'delete')
+
+    def stats(self):
+        return {
+            'backend': 'sqlite',
+            'path': self.path,
+            'size_bytes': os.path.getsize(self.path),
+            'last_seq': self.last_seq()
+        }
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    INSERT_MOVEMENT = ('INSERT INTO movements (id, date, type, stage_id, substage_id, location_id, responsible, data) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?)')
+    INSERT_LINE = 'INSERT INTO movement_lines (movement_id, product_id, quantity) VALUES (?, ?, ?)'
+
+    def _put(self, conn, name, row):
+        if name != 'movements':
+            conn.execute('INSERT OR REPLACE INTO entities (collection, id, data) VALUES (?, ?, ?)',
+                         (name, row['id'], json.dumps(row, ensure_ascii=False)))
+            return
+        conn.execute('DELETE FROM movements WHERE id = ?', (row['id'],))
+        conn.execute(self.INSERT_MOVEMENT, self._movement_values(row))
+        conn.executemany(self.INSERT_LINE,
+                         [(row['id'], line['product_id'], line['quantity']) for line in row.get('products', [])])
+
+    @staticmethod
+    def _movement_values(row):
+        return (row['id'], row['date'], row['type'], row.get('stage_id'), row.get('substage_id'),
+                row.get('location_id'), row.get('responsible'), json.dumps(row, ensure_ascii=False))
+
+    def _log(self, conn, name, row_id, op):
+        seq = conn.execute('INSERT INTO changelog (collection, row_id, op) VALUES (?, ?, ?)',
+                           (name, row_id, op)).lastrowid
+        if seq % 1000 == 0:
+            pruned = seq - self.CHANGELOG_RETENTION
+            if pruned > 0:
+                conn.execute('DELETE FROM changelog WHERE seq <= ?', (pruned,))
+                conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                             ('pruned_seq', pruned))
+        return seq
+
+    def _meta(self, conn, key):
+        found = conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return found[0] if found else 0
+
+
+class JournalBackend:
+    """Journal de solo-agregado con snapshots periódicos.
+
+    Cada escritura agrega una línea JSON al journal (``journal.log``):
+
+    - ``{"s": seq, "c": colección, "o": "i", "r": fila}``: alta
+    - ``{"s": seq, "c": colección, "o": "m", "r": filas}``: alta en bloque
+    - ``{"s": seq, "c": colección, "o": "u", "i": id, "f": cambios}``: edición
+    - ``{"s": seq, "c": colección, "o": "d", "i": id}``: baja
+    - ``{"s": seq, "c": colección, "o": "s", "r": filas}``: datos iniciales
+    - ``{"s": seq, "o": "t", "ops": [...]}``: transacción (todo o nada)
+
+    El snapshot (``snapshot.json``) guarda el estado completo hasta una
+    secuencia; al escribirlo el journal se recorta a los registros
+    posteriores, así que al reiniciar solo se reproduce la cola reciente.
+    """
+
+    shared = False
+    # Una transacción fallida no llega al journal y sus cambios en memoria
+    # se deshacen (ver ``transaction``)
+    transactional = True
+    movement_queries = False
+
+    def __init__(self, directory, snapshot_interval=300, snapshot_records=10000, fsync=True):
+        self.directory = directory
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_records = snapshot_records
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        self.journal_path = os.path.join(directory, 'journal.log')
+        self.snapshot_path = os.path.join(directory, 'snapshot.json')
+
+        # Un solo proceso puede escribir el journal
+        self._lock_file = open(os.path.join(directory, 'journal.lock'), 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise RuntimeError(f"El journal {directory} ya está abierto por otro proceso")
+
+        # Por proceso: una cola del journal descartada al recuperar podría
+        # repetir secuencias con otro contenido
+        self.instance_id = uuid.uuid4().hex[:12]
+        self._lock = threading.RLock()
+        self._data = {}
+        self._next_ids = {}
+        self._seq = 0
+        self._pending = None
+        # Estado anterior de cada fila escrita en la transacción en curso
+        self._undo = None
+        self._records_since_snapshot = 0
+        self.last_snapshot_at = None
+        self.recovery = self._recover()
+
+        self._journal = open(self.journal_path, 'ab')
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._snapshotter = threading.Thread(target=self._snapshot_loop, name='journal-snapshot', daemon=True)
+        self._snapshotter.start()
+
+    # Recuperación
+
+    def _recover(self):
+        started = time.perf_counter()
+        snapshot_rows = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self._seq = snapshot['seq']
+            for name, collection in snapshot['collections'].items():
+                self._data[name] = {row['id']: row for row in collection['rows']}
+                self._next_ids[name] = collection['next_id']
+                snapshot_rows += len(collection['rows'])
+
+        replayed = 0
+        valid_bytes = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Última línea incompleta (caída durante la escritura)
+                        break
+                    valid_bytes += len(line)
+                    if record['s'] > self._seq:
+                        self._replay(record)
+                        self._seq = record['s']
+                        replayed += 1
+            if valid_bytes < os.path.getsize(self.journal_path):
+                with open(self.journal_path, 'r+b') as f:
+                    f.truncate(valid_bytes)
+        self._records_since_snapshot = replayed
+
+        return {
+            'snapshot_rows': snapshot_rows,
+            'journal_records': replayed,
+            'seconds': round(time.perf_counter() - started, 4)
+        }
+
+    def _replay(self, record):
+        op = record['o']
+        if op == 't':
+            for sub in record['ops']:
+                self._replay(sub)
+            return
+        rows = self._data.setdefault(record['c'], {})
+        if op == 's':
+            for row in record['r']:
+                rows[row['id']] = row
+            self._next_ids[record['c']] = max(rows, default=0) + 1
+        elif op == 'i':
+            row = record['r']
+            rows[row['id']] = row
+            self._bump(record['c'], row['id'])
+        elif op == 'm':
+            for row in record['r']:
+                rows[row['id']] = row
+            self._bump(record['c'], max(row['id'] for row in record['r']))
+        elif op == 'u':
+            if record['i'] in rows:
+                rows[record['i']].update(record['f'])
+        elif op == 'd':
+            rows.pop(record['i'], None)
+
+    # Lectura
+
+    def load(self, name, seed):
+        with self._lock:
+            if name not in self._data:
+                seed = list(seed)
+                self._data[name] = {row['id']: row for row in seed}
+                self._next_ids[name] = max((row['id'] for row in seed), default=0) + 1
+                # Fuera de la transacción en curso: los datos iniciales no se deshacen
+                self._seq += 1
+                self._write({'s': self._seq, 'c': name, 'o': 's', 'r': seed})
+            return list(self._data[name].values()), self._seq
+
+    def last_seq(self):
+        return self._seq
+
+    def changes_since(self, seq):
+        return []
+
+    def fetch(self, name, row_id):
+        return None
+
+    # Escritura
+
+    def allocate_id(self, name, count=1):
+        with self._lock:
+            row_id = self._next_ids[name]
+            self._next_ids[name] = row_id + count
+            return row_id
+
+    def insert(self, name, row):
+        with self._lock:
+            self._save_undo(name, row['id'])
+            self._data[name][row['id']] = row
+            self._bump(name, row['id'])
+            return self._append({'c': name, 'o': 'i', 'r': row})
+
+    def insert_many(self, name, rows):
+        with self._lock:
+            data = self._data[name]
+            for row in rows:
+                self._save_undo(name, row['id'])
+                data[row['id']] = row
+            self._bump(name, max(row['id'] for row in rows))
+            return self._append({'c': name, 'o': 'm', 'r': rows})
+
+    def update(self, name, row, changes):
+        with self._lock:
+            self._save_undo(name, row['id'])
+            self._data[name][row['id']].update(changes)
+            return self._append({'c': name, 'o': 'u', 'i': row['id'], 'f': changes})
+
+    def delete(self, name, row_id):
+        with self._lock:
+            self._save_undo(name, row_id)
+            self._data[name].pop(row_id, None)
+            return self._append({'c': name, 'o': 'd', 'i': row_id})
+
+    @contextmanager
+    def transaction(self):
+        """Las escrituras de la transacción se guardan en un único registro.
+
+        Si falla no se escribe nada y las filas vuelven a su estado anterior;
+        el Store descarta y recarga las colecciones que había escrito.
+        """
+        with self._lock:
+            if self._pending is not None:
+                yield
+                return
+            self._pending = []
+            self._undo = []
+            try:
+                yield
+            except BaseException:
+                # Las secuencias usadas quedan sin registro: un hueco no afecta la recuperación
+                for name, row_id, previous in reversed(self._undo):
+                    if previous is None:
+                        self._data[name].pop(row_id, None)
+                    else:
+                        self._data[name][row_id] = previous
+                self._pending = self._undo = None
+                raise
+            ops, self._pending, self._undo = self._pending, None, None
+            if ops:
+                self._write({'s': ops[-1]['s'], 'o': 't', 'ops': ops})
+
+    def _save_undo(self, name, row_id):
+        """Guarda una copia de la fila (``None`` si no existe) antes de escribirla en una transacción"""
+        if self._undo is not None:
+            row = self._data[name].get(row_id)
+            self._undo.append((name, row_id, None if row is None else dict(row)))
+
+    def _bump(self, name, row_id):
+        if row_id >= self._next_ids.get(name, 1):
+            self._next_ids[name] = row_id + 1
+
+    def _append(self, record):
+        self._seq += 1
+        record['s'] = self._seq
+        if self._pending is not None:
+            self._pending.append(record)
+        else:
+            self._write(record)
+        return self._seq
+
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+        self._journal.write(line.encode('utf-8'))
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+        self._records_since_snapshot += 1
+        if self._records_since_snapshot >= self.snapshot_records:
+            self._wakeup.set()
+
+    # Snapshots
+
+    def _snapshot_loop(self):
+        # ``snapshot_interval=0`` desactiva el snapshot por tiempo
+        while not self._closed:
+            self._wakeup.wait(self.snapshot_interval or None)
+            self._wakeup.clear()
+            if self._closed:
+                break
+            if self._records_since_snapshot:
+                self.snapshot()
+
+    def snapshot(self):
+        """Escribe un snapshot compactado y recorta el journal"""
+        with self._lock:
+            seq = self._seq
+            offset = self._journal.tell()
+            # Copias: el Store modifica las mismas filas mientras se serializan
+            collections = {name: ([dict(row) for row in rows.values()], self._next_ids[name])
+                           for name, rows in self._data.items()}
+
+        # La serialización ocurre sin bloquear las escrituras: las copias
+        # quedan en el estado de ``seq`` y lo posterior está en el journal.
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write('{"seq":%d,"collections":{' % seq)
+            for index, (name, (rows, next_id)) in enumerate(collections.items()):
+                if index:
+                    f.write(',')
+                f.write('%s:{"next_id":%d,"rows":[' % (json.dumps(name), next_id))
+                f.write(','.join(json.dumps(row, ensure_ascii=False) for row in rows))
+                f.write(']}')
+            f.write('}}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+        with self._lock:
+            # Conservar solo los registros escritos después del snapshot
+            with open(self.journal_path, 'rb') as f:
+                f.seek(offset)
+                tail = f.read()
+            temp_path = self.journal_path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal.close()
+            os.replace(temp_path, self.journal_path)
+            self._journal = open(self.journal_path, 'ab')
+            self._records_since_snapshot = tail.count(b'\n')
+            self.last_snapshot_at = time.time()
+
+    def stats(self):
+        return {
+            'backend': 'journal',
+            'directory': self.directory,
+            'last_seq': self._seq,
+            'rows': {name: len(rows) for name, rows in self._data.items()},
+            'journal_bytes': os.path.getsize(self.journal_path),
+            'records_since_snapshot': self._records_since_snapshot,
+            'last_snapshot_at': self.last_snapshot_at,
+            'recovery': self.recovery
+        }
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._snapshotter.join()
+        with self._lock:
+            self._journal.close()
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._lock_file.close()
+
+
+def create_backend(kind, **options):
+    """Crea el backend configurado (``memory``, ``sqlite`` o ``journal``)"""
+    if kind == 'memory':
+        return MemoryBackend()
+    if kind == 'sqlite':
+        return SQLiteBackend(options['path'])
+    if kind == 'journal':
+        return JournalBackend(options['journal_dir'],
+                              snapshot_interval=options.get('snapshot_interval', 300),
+                              fsync=options.get('fsync', True))
+    raise ValueError(f"Backend de almacenamiento desconocido: {kind}")
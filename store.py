@@ -0,0 +1,319 @@
+"""Almacén de entidades en memoria con índices por clave primaria.
+
+Cada colección conserva el orden de inserción (igual que las listas que
+reemplaza) y un índice hash por ``id`` para que las búsquedas sean O(1).
+Los cambios se notifican a los suscriptores para que las estructuras
+derivadas (agregados de gráficos, etc.) se mantengan de forma incremental.
+
+Las colecciones son una caché de un backend de persistencia (ver
+``storage.py``): se cargan recién cuando se usan por primera vez y cada
+escritura pasa primero por el backend.
+
+Cada colección tiene una ``version``: la última secuencia del backend que
+la modificó. Dos copias con la misma versión tienen el mismo contenido,
+aunque estén en workers distintos, así que sirve para ETags.
+
+Cada entidad lleva además su propio campo ``version`` (0 en los datos
+iniciales), que se incrementa en cada ``update``. Se guarda con la entidad,
+así que todos los workers ven el mismo valor y sirve para detectar
+escrituras concurrentes (``If-Match``).
+"""
+import threading
+from contextlib import contextmanager
+
+
+class Store:
+    """Agrupa las colecciones que comparten un backend"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.collections = {}
+        # Serializa escrituras y sincronización dentro del proceso
+        self.lock = threading.RLock()
+        # Última secuencia del backend ya reflejada en memoria
+        self._seq = backend.last_seq()
+        # Secuencias escritas por este proceso (ya aplicadas en memoria)
+        self._own = set()
+        # Colecciones y secuencias escritas en la transacción en curso
+        self._pending = None
+        # Verdadero mientras se aplican cambios de otros procesos (``sync``)
+        self.syncing = False
+
+    def collection(self, name, seed=()):
+        """Crea una colección; ``seed`` son los datos iniciales si está vacía"""
+        collection = Collection(self, name, seed)
+        self.collections[name] = collection
+        return collection
+
+    @contextmanager
+    def transaction(self):
+        """Agrupa varias escrituras en una sola transacción del backend.
+
+        Si la transacción falla y el backend la deshace, las colecciones que
+        escribió se descartan de memoria y se recargan desde el backend.
+        """
+        with self.lock:
+            if self._pending is not None:
+                with self.backend.transaction():
+                    yield
+                return
+            self._pending = (set(), set())
+            try:
+                with self.backend.transaction():
+                    yield
+            except BaseException:
+                names, seqs = self._pending
+                if self.backend.transactional:
+                    # Esas secuencias nunca llegaron al changelog
+                    self._own.difference_update(seqs)
+                    for name in names:
+                        self.collections[name].unload()
+                raise
+            finally:
+                self._pending = None
+
+    @contextmanager
+    def write(self):
+        """Contexto de una escritura individual.
+
+        Con un backend compartido se toma el lock de escritura del backend y
+        se aplican antes los cambios de otros procesos: así la secuencia de
+        la escritura corresponde exactamente al estado en memoria. Con un
+        backend transaccional la escritura es todo o nada.
+        """
+        if self.backend.shared:
+            with self.transaction():
+                self.sync()
+                yield
+        elif self.backend.transactional:
+            with self.transaction():
+                yield
+        else:
+            with self.lock:
+                yield
+
+    def etag(self, names):
+        """ETag de una respuesta que depende de las colecciones ``names``"""
+        versions = '.'.join(str(self.collections[name].version) for name in names)
+        return f'{self.backend.instance_id}-{versions}'
+
+    def _written(self, name, seq):
+        if self.backend.shared:
+            self._own.add(seq)
+        if self._pending is not None:
+            self._pending[0].add(name)
+            self._pending[1].add(seq)
+
+    def sync(self):
+        """Aplica en memoria los cambios hechos por otros procesos"""
+        if not self.backend.shared:
+            return
+        with self.lock:
+            changes = self.backend.changes_since(self._seq)
+            if changes is None:
+                # Historial depurado: recargar todo lo que esté en memoria
+                self._seq = self.backend.last_seq()
+                self._own.clear()
+                for collection in self.collections.values():
+                    collection.unload()
+                return
+            self.syncing = True
+            try:
+                for seq, name, row_id, op in changes:
+                    self._seq = seq
+                    if seq in self._own:
+                        self._own.discard(seq)
+                        continue
+                    collection = self.collections.get(name)
+                    if collection is not None and collection.loaded:
+                        if op == 'reload':
+                            # Carga masiva (``insert_many``): se relee la colección
+                            collection.unload()
+                        else:
+                            collection._apply_remote(seq, row_id, self.backend.fetch(name, row_id))
+            finally:
+                self.syncing = False
+
+
+class Collection:
+    """Colección de entidades indexada por ``id``"""
+
+    def __init__(self, store, name, seed=()):
+        self.store = store
+        self.name = name
+        self._seed = seed
+        # Un dict conserva el orden de inserción y sirve a la vez de índice;
+        # ``None`` mientras la colección no se haya cargado
+        self._rows = None
+        self._version = None
+        self._listeners = []
+
+    @property
+    def loaded(self):
+        return self._rows is not None
+
+    @property
+    def version(self):
+        """Última secuencia del backend reflejada en esta colección.
+
+        Con un backend compartido una colección que no está en memoria no se
+        carga: se lee de la base, que está al día con la última secuencia.
+        """
+        with self.store.lock:
+            if self._rows is None and self.store.backend.shared:
+                return self.store.backend.last_seq()
+            self._data()
+            return self._version
+
+    def _data(self):
+        rows = self._rows
+        if rows is None:
+            with self.store.lock:
+                if self._rows is None:
+                    loaded, self._version = self.store.backend.load(self.name, self._seed)
+                    for row in loaded:
+                        row.setdefault('version', 0)
+                    self._rows = {row['id']: row for row in loaded}
+                    self._notify('reset', None, None)
+                rows = self._rows
+        return rows
+
+    def unload(self):
+        """Descarta la copia en memoria; se recarga en el próximo acceso"""
+        with self.store.lock:
+            self._rows = None
+            self._version = None
+            self._notify('reset', None, None)
+
+    def _written(self, seq):
+        self._version = seq
+        self.store._written(self.name, seq)
+
+    def __iter__(self):
+        # Iterar sobre una copia permite borrar/insertar durante el recorrido
+        # (también desde otros hilos)
+        return iter(self.all())
+
+    def __len__(self):
+        return len(self._data())
+
+    def __contains__(self, row_id):
+        return self.get(row_id) is not None
+
+    def get(self, row_id):
+        """Obtiene una entidad por su ID (``None`` si no existe)"""
+        try:
+            return self._data().get(row_id)
+        except TypeError:
+            # IDs no hashables (listas, dicts) recibidos desde JSON
+            return None
+
+    def ids(self):
+        """Lista con los IDs en orden de inserción"""
+        rows = self._data()
+        with self.store.lock:
+            return list(rows)
+
+    def all(self):
+        """Lista con todas las entidades en orden de inserción"""
+        rows = self._data()
+        with self.store.lock:
+            return list(rows.values())
+
+    def subscribe(self, listener):
+        """Registra ``listener(op, old, new)`` para cada cambio.
+
+        ``op`` es ``'insert'``, ``'update'`` o ``'delete'``; ``old`` es una
+        copia de la entidad antes del cambio y ``new`` la entidad resultante.
+        ``'reset'`` (sin entidades) indica que la colección se (re)cargó
+        completa y las estructuras derivadas deben reconstruirse. Los
+        cambios de otros procesos se notifican con ``store.syncing`` activo.
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, op, old, new):
+        for listener in self._listeners:
+            listener(op, old, new)
+
+    def allocate_id(self, count=1):
+        """Reserva el siguiente ID disponible (o ``count`` consecutivos y devuelve el primero)"""
+        self._data()
+        with self.store.lock:
+            return self.store.backend.allocate_id(self.name, count)
+
+    def insert(self, row):
+        """Agrega una entidad ya construida (debe incluir ``id``)"""
+        with self.store.write():
+            rows = self._data()
+            if row['id'] in rows:
+                raise KeyError(f"{self.name}: ID {row['id']} duplicado")
+            row.setdefault('version', 1)
+            self._written(self.store.backend.insert(self.name, row))
+            rows[row['id']] = row
+            self._notify('insert', None, row)
+        return row
+
+    def insert_many(self, rows):
+        """Agrega muchas entidades con una sola escritura del backend.
+
+        Las estructuras derivadas no se actualizan fila por fila: reciben
+        ``'reset'`` y se reconstruyen completas en el próximo uso.
+        """
+        if not rows:
+            return rows
+        with self.store.write():
+            data = self._data()
+            ids = set()
+            for row in rows:
+                if row['id'] in data or row['id'] in ids:
+                    raise KeyError(f"{self.name}: ID {row['id']} duplicado")
+                ids.add(row['id'])
+                row.setdefault('version', 1)
+            self._written(self.store.backend.insert_many(self.name, rows))
+            for row in rows:
+                data[row['id']] = row
+            self._notify('reset', None, None)
+        return rows
+
+    def update(self, row_id, changes):
+        """Aplica ``changes`` sobre la entidad (incrementando su ``version``) y la devuelve"""
+        with self.store.write():
+            row = self._data()[row_id]
+            changes = dict(changes, version=row['version'] + 1)
+            old = dict(row)
+            updated = dict(row, **changes)
+            self._written(self.store.backend.update(self.name, updated, changes))
+            row.update(changes)
+            self._notify('update', old, row)
+        return row
+
+    def delete(self, row_id):
+        """Elimina una entidad y la devuelve"""
+        with self.store.write():
+            rows = self._data()
+            row = rows[row_id]
+            self._written(self.store.backend.delete(self.name, row_id))
+            del rows[row_id]
+            self._notify('delete', row, None)
+        return row
+
+    def _apply_remote(self, seq, row_id, row):
+        """Refleja el estado persistido de una entidad escrita por otro proceso"""
+        if seq > self._version:
+            self._version = seq
+        rows = self._rows
+        current = rows.get(row_id)
+        if row is None:
+            if current is not None:
+                del rows[row_id]
+                self._notify('delete', current, None)
+            return
+        row.setdefault('version', 0)
+        if current is None:
+            rows[row_id] = row
+            self._notify('insert', None, row)
+        else:
+            old = dict(current)
+            current.clear()
+            current.update(row)
+            self._notify('update', old, current)
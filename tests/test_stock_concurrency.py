@@ -0,0 +1,91 @@
+"""Usos concurrentes del mismo producto: el stock nunca queda negativo.
+
+Cada caso carga ``main`` con el backend indicado en un directorio temporal.
+Con SQLite se cargan dos instancias sobre la misma base, como dos workers
+de gunicorn; el journal es de un solo proceso.
+"""
+import importlib.util
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+THREADS = 8
+REQUESTS_PER_THREAD = 20
+INITIAL_STOCK = 100
+
+
+def load_app(name, monkeypatch, **env):
+    """Instancia nueva de ``main`` (su propio Store) con la configuración ``env``"""
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    spec = importlib.util.spec_from_file_location(name, ROOT / 'main.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(params=['sqlite', 'journal'])
+def workers(request, tmp_path, monkeypatch):
+    """Instancias de la aplicación que atienden los pedidos del caso"""
+    monkeypatch.chdir(tmp_path)
+    backend = request.param
+    env = {
+        'STORAGE_BACKEND': backend,
+        'DATABASE_PATH': str(tmp_path / 'inventario.db'),
+        'JOURNAL_DIR': str(tmp_path / 'journal'),
+        'JOURNAL_FSYNC': '0',
+        'SNAPSHOT_INTERVAL': '0'
+    }
+    count = 2 if backend == 'sqlite' else 1
+    modules = [load_app(f'main_{backend}_{index}', monkeypatch, **env) for index in range(count)]
+    yield modules
+    for module in modules:
+        module.store.backend.close()
+
+
+def test_concurrent_usage_never_overdraws(workers):
+    client = workers[0].app.test_client()
+    response = client.post('/api/productos', json={
+        'name': 'Concurrencia', 'unit': 'kg', 'current_stock': INITIAL_STOCK,
+        'initial_stock': INITIAL_STOCK, 'price': 1
+    })
+    assert response.status_code == 201
+    product_id = response.get_json()['id']
+    body = {'type': 'uso', 'products': [{'product_id': product_id, 'quantity': 1}], 'responsible': 'Test'}
+
+    start = threading.Barrier(THREADS)
+    codes = []
+    errors = []
+
+    def draw(index):
+        worker = workers[index % len(workers)].app.test_client()
+        start.wait()
+        try:
+            for _ in range(REQUESTS_PER_THREAD):
+                codes.append(worker.post('/api/movimientos', json=body).status_code)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=draw, args=(index,)) for index in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert len(codes) == THREADS * REQUESTS_PER_THREAD
+    assert codes.count(201) == INITIAL_STOCK
+    assert codes.count(400) == THREADS * REQUESTS_PER_THREAD - INITIAL_STOCK
+
+    for module in workers:
+        module.store.sync()
+        product = module.products.get(product_id)
+        assert product['current_stock'] == 0
+        draws = [movement for movement in module.movements
+                 if movement['products'][0]['product_id'] == product_id]
+        assert len(draws) == INITIAL_STOCK
@@ -0,0 +1,154 @@
+"""Versiones reducidas de las imágenes de recetas.
+
+La galería muestra tarjetas chicas y el visor una imagen del tamaño de la
+pantalla: en lugar de enviar la foto original a ambos se generan variantes
+JPEG de tamaño fijo (``VARIANTS``) y se guardan en un caché en disco,
+``<directorio>/<clave>-<variante>.jpg``. Si ocupan más de ``max_bytes`` se
+eliminan primero las usadas hace más tiempo.
+
+Pillow es opcional: sin Pillow, o si el archivo no es una imagen que se
+pueda abrir, ``get`` devuelve ``None`` y se envía el original.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Variante -> tamaño máximo (ancho, alto); se conserva la proporción
+VARIANTS = {
+    'miniatura': (480, 480),
+    'web': (1600, 1600)
+}
+JPEG_QUALITY = 82
+
+# Los usos de una variante se registran como mucho una vez por este intervalo
+TOUCH_INTERVAL = 60 * 60
+
+
+class VariantCache:
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024, workers=1):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='variant')
+        self._lock = threading.Lock()
+        # clave de archivo -> lock de quien la está generando
+        self._building = {}
+        self._bytes = self._scan()[1]
+
+    @property
+    def available(self):
+        return Image is not None
+
+    def get(self, source, key, variant):
+        """Ruta de la variante de ``source`` (la genera si falta); ``None`` si no se puede"""
+        if not self.available:
+            return None
+        path = os.path.join(self.directory, f'{key}-{variant}.jpg')
+        if self._touch(path):
+            return path
+        with self._lock:
+            lock = self._building.setdefault(path, threading.Lock())
+        try:
+            with lock:
+                if os.path.exists(path):
+                    return path
+                size = self._build(source, path, VARIANTS[variant])
+        finally:
+            with self._lock:
+                self._building.pop(path, None)
+        if size is None:
+            return None
+        with self._lock:
+            self._bytes += size
+            over = self._bytes > self.max_bytes
+        if over:
+            self.evict()
+        return path
+
+    def discard(self, key):
+        """Elimina las variantes de una imagen borrada"""
+        for variant in VARIANTS:
+            try:
+                os.remove(os.path.join(self.directory, f'{key}-{variant}.jpg'))
+            except OSError:
+                pass
+
+    def prefetch(self, source, key):
+        """Genera en segundo plano todas las variantes de una imagen recién subida"""
+        if self.available:
+            for variant in VARIANTS:
+                self._executor.submit(self.get, source, key, variant)
+
+    def _touch(self, path):
+        """``True`` si la variante existe; la marca como usada (para el límite de tamaño)"""
+        try:
+            modified = os.path.getmtime(path)
+        except OSError:
+            return False
+        if time.time() - modified > TOUCH_INTERVAL:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return True
+
+    @staticmethod
+    def _build(source, path, size):
+        """Escribe la variante; devuelve su tamaño o ``None`` si no es una imagen"""
+        temporary = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with Image.open(source) as image:
+                # En JPEG decodifica directamente a una escala cercana (mucho más rápido)
+                image.draft('RGB', size)
+                image = ImageOps.exif_transpose(image)
+                image.thumbnail(size, Image.LANCZOS)
+                if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+                    # JPEG no tiene transparencia: fondo blanco
+                    rgba = image.convert('RGBA')
+                    image = Image.new('RGB', rgba.size, (255, 255, 255))
+                    image.paste(rgba, mask=rgba.getchannel('A'))
+                elif image.mode != 'RGB':
+                    image = image.convert('RGB')
+                image.save(temporary, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+            os.replace(temporary, path)
+            return os.path.getsize(path)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            return None
+
+    def _scan(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        return files, sum(size for _, size, _ in files)
+
+    def evict(self):
+        """Elimina las variantes usadas hace más tiempo hasta bajar de ``max_bytes``"""
+        with self._lock:
+            files, total = self._scan()
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+            self._bytes = total
+
+    def stats(self):
+        files, total = self._scan()
+        return {'variants': len(files), 'bytes': total, 'max_bytes': self.max_bytes, 'available': self.available}
+